@@ -0,0 +1,526 @@
+"""
+Local stand-ins for stash, IQDB and the boorus, used by the load benchmark.
+
+Every fake is a threaded HTTP server with its own latency, error rate and rate limit. Requests over
+the rate limit are answered with 429 and a Retry-After header, like the real sites do. The content
+is generated from the image and post ids, so every run sees the same images, matches and tags.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from graphql import build_schema, graphql_sync
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stash.graphql')
+
+BOORUS = ('danbooru', 'gelbooru', 'konachan', 'yandere', 'sankaku')
+
+# hosts the booru adapters send their requests to, by booru
+BOORU_HOSTS = {
+    'danbooru': ('danbooru.donmai.us',),
+    'gelbooru': ('gelbooru.com',),
+    'konachan': ('konachan.com',),
+    'yandere': ('yande.re',),
+    'sankaku': ('chan.sankakucomplex.com', 'capi-v2.sankakucomplex.com'),
+}
+
+# post urls as IQDB lists them, protocol relative
+POST_URLS = {
+    'danbooru': '//danbooru.donmai.us/posts/{id}',
+    'gelbooru': '//gelbooru.com/index.php?page=post&amp;s=view&amp;id={id}',
+    'konachan': '//konachan.com/post/show/{id}',
+    'yandere': '//yande.re/post/show/{id}',
+    'sankaku': '//chan.sankakucomplex.com/post/show/{id}',
+}
+
+IMAGE_MARKER = re.compile(rb'BENCH-IMAGE (\d+)\n')
+
+# tag types as gelbooru, moebooru and sankaku number them
+GENERAL, ARTIST, COPYRIGHT, CHARACTER = 0, 1, 3, 4
+
+ARTISTS, CHARACTERS, COPYRIGHTS, GENERALS = 97, 211, 23, 50
+
+class Behaviour:
+    """
+    Latency, errors and rate limit of a fake service.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, throttle: Optional[float] = None, seed: int = 0):
+        """
+        :param latency: Seconds every response is delayed.
+        :param jitter: Up to this many seconds are added to the latency at random.
+        :param error_rate: Share of the requests answered with 500.
+        :param throttle: Requests per second above which requests are answered with 429. (optional)
+        :param seed: Seed of the random errors and jitter.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self._tokens = throttle or 0.0
+        self._updated = time.monotonic()
+
+    def delay(self) -> float:
+        with self.lock:
+            return self.latency + (self.random.uniform(0, self.jitter) if self.jitter > 0 else 0.0)
+
+    def fails(self) -> bool:
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def throttled(self) -> bool:
+        if self.throttle is None:
+            return False
+
+        # token bucket holding a second worth of requests
+        with self.lock:
+            now = time.monotonic()
+            self._tokens = min(self.throttle, self._tokens + (now - self._updated) * self.throttle)
+            self._updated = now
+
+            if self._tokens < 1:
+                return True
+
+            self._tokens -= 1
+            return False
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that answers requests with a fake service, counting what it answered.
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, name: str, behaviour: Behaviour):
+        self.name = name
+        self.behaviour = behaviour
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0}
+        self.stats_lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), _Handler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=f"fake-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, key: str):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def handle_request_data(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple[int, str, bytes]:
+        """
+        Answer a request with a status code, a content type and a body.
+        """
+        raise NotImplementedError
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, method: str):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.count('requests')
+
+        time.sleep(server.behaviour.delay())
+        headers = {}
+
+        if server.behaviour.throttled():
+            server.count('throttled')
+            status, content_type, content = 429, 'text/plain', b'Too Many Requests'
+            headers['Retry-After'] = '1'
+        elif server.behaviour.fails():
+            server.count('errors')
+            status, content_type, content = 500, 'text/plain', b'Internal Server Error'
+        else:
+            url = urllib.parse.urlsplit(self.path)
+            query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+            status, content_type, content = server.handle_request_data(method, url.path, query, self.headers, body)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+def _json(data) -> tuple[int, str, bytes]:
+    return 200, 'application/json', json.dumps(data).encode()
+
+def _not_found() -> tuple[int, str, bytes]:
+    return 404, 'text/plain', b'Not Found'
+
+def post_tags(post_id: int) -> dict[int, list[str]]:
+    """
+    Tags of a fake post by type, the same for every booru.
+    """
+    return {
+        ARTIST: [f"artist_{post_id % ARTISTS}"],
+        CHARACTER: [f"character_{post_id % CHARACTERS}", f"character_{(post_id * 7) % CHARACTERS}"],
+        COPYRIGHT: [f"series_{post_id % COPYRIGHTS}"],
+        GENERAL: ["1girl", "solo", f"general_{post_id % GENERALS}"],
+    }
+
+def tag_type(name: str) -> int:
+    prefix = name.split('_', 1)[0]
+    return {'artist': ARTIST, 'character': CHARACTER, 'series': COPYRIGHT}.get(prefix, GENERAL)
+
+def all_tags() -> list[str]:
+    return (
+        [f"artist_{i}" for i in range(ARTISTS)] + [f"character_{i}" for i in range(CHARACTERS)] +
+        [f"series_{i}" for i in range(COPYRIGHTS)] + ["1girl", "solo"] + [f"general_{i}" for i in range(GENERALS)]
+    )
+
+def image_content(image_id: int, size: int) -> bytes:
+    marker = f"BENCH-IMAGE {image_id}\n".encode()
+    return marker + b'\0' * max(0, size - len(marker))
+
+class FakeStash(FakeServer):
+    """
+    Stash GraphQL endpoint with a library of generated images, plus the login and image downloads.
+    """
+
+    def __init__(self, behaviour: Behaviour, images: int, image_size: int, thumbnail_size: int):
+        super().__init__('stash', behaviour)
+        self.image_size = image_size
+        self.thumbnail_size = thumbnail_size
+        with open(SCHEMA_PATH, 'r') as f:
+            self.schema = build_schema(f.read())
+
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.images = {
+            image_id: {'id': image_id, 'created_at': (created + timedelta(seconds=image_id)).isoformat(), 'tags': set(), 'performers': set(), 'studio': None, 'urls': []}
+            for image_id in range(1, images + 1)
+        }
+        self.entities = {'tags': {}, 'performers': {}, 'studios': {}}
+        self.lock = threading.Lock()
+        self.root = _StashRoot(self)
+
+    def handle_request_data(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple[int, str, bytes]:
+        if path == '/graphql' and method == 'POST':
+            request = json.loads(body)
+            result = graphql_sync(self.schema, request['query'], root_value=self.root, variable_values=request.get('variables'), operation_name=request.get('operationName'))
+
+            response = {'data': result.data}
+            if result.errors:
+                response['errors'] = [error.formatted for error in result.errors]
+            return _json(response)
+
+        if path == '/login':
+            return 200, 'text/plain', b'OK'
+
+        kind, _, image_id = path.strip('/').partition('/')
+        if kind in ('image', 'thumbnail') and image_id.isdigit() and int(image_id) in self.images:
+            return 200, 'image/jpeg', image_content(int(image_id), self.image_size if kind == 'image' else self.thumbnail_size)
+
+        return _not_found()
+
+    def image_result(self, image: dict) -> dict:
+        return {
+            'id': image['id'],
+            'created_at': image['created_at'],
+            'updated_at': image['created_at'],
+            'urls': image['urls'],
+            'paths': {'image': f"{self.url}/image/{image['id']}", 'thumbnail': f"{self.url}/thumbnail/{image['id']}", 'preview': None},
+            'visual_files': [],
+            'tags': [],
+            'performers': [],
+            'studio': None,
+        }
+
+    def matches(self, image: dict, image_filter: Optional[dict]) -> bool:
+        for key, criterion in (image_filter or {}).items():
+            if criterion is None:
+                continue
+
+            if key == 'AND':
+                if not self.matches(image, criterion):
+                    return False
+            elif key == 'id':
+                if not _compare(image['id'], criterion['modifier'], criterion['value'], criterion.get('value2')):
+                    return False
+            elif key == 'tags':
+                ids = {int(tag_id) for tag_id in criterion.get('value') or []}
+                if criterion['modifier'] == 'EXCLUDES' and image['tags'] & ids:
+                    return False
+                if criterion['modifier'] in ('INCLUDES', 'INCLUDES_ALL') and not ids <= image['tags']:
+                    return False
+            elif key in ('created_at', 'updated_at'):
+                value2 = _timestamp(criterion['value2']) if criterion.get('value2') else None
+                if not _compare(_timestamp(image['created_at']), criterion['modifier'], _timestamp(criterion['value']), value2):
+                    return False
+
+        # every image is in every gallery, other criteria are not filtered on
+        return True
+
+    def find_entities(self, kind: str, name_filter: Optional[dict], find_filter: Optional[dict]) -> dict:
+        with self.lock:
+            entities = list(self.entities[kind].values())
+
+        if name_filter and name_filter.get('name'):
+            entities = [entity for entity in entities if entity['name'] == name_filter['name']['value']]
+
+        page, per_page = _page(find_filter)
+        return {'count': len(entities), kind: entities[(page - 1) * per_page:page * per_page] if per_page > 0 else entities}
+
+    def create_entity(self, kind: str, fields: dict) -> dict:
+        with self.lock:
+            entity = {'id': len(self.entities[kind]) + 1, 'aliases': [], 'alias_list': [], 'disambiguation': None, **fields}
+            self.entities[kind][entity['id']] = entity
+            return entity
+
+    def update_image(self, image_id: int, tag_ids=None, performer_ids=None, studio_id=None, urls=None) -> Optional[dict]:
+        with self.lock:
+            image = self.images.get(image_id)
+            if image is None:
+                return None
+
+            if tag_ids is not None:
+                image['tags'] = {int(tag_id) for tag_id in tag_ids}
+            if performer_ids is not None:
+                image['performers'] = {int(performer_id) for performer_id in performer_ids}
+            if studio_id is not None:
+                image['studio'] = int(studio_id)
+            if urls is not None:
+                image['urls'] = list(urls)
+
+        return self.image_result(image)
+
+    def tagged_images(self, tag_name: str) -> int:
+        tag_ids = [tag['id'] for tag in self.entities['tags'].values() if tag['name'] == tag_name]
+        return sum(1 for image in self.images.values() if image['tags'] & set(tag_ids))
+
+class _StashRoot:
+    """
+    Resolvers of the Query and Mutation fields, called by graphql-core with the field arguments.
+    """
+
+    def __init__(self, stash: FakeStash):
+        self.stash = stash
+
+    def version(self, info):
+        return {'version': 'v0.0.0-bench', 'hash': 'bench', 'build_time': '2024-01-01 00:00:00'}
+
+    def findImages(self, info, image_filter=None, image_ids=None, filter=None):
+        images = [image for image in self.stash.images.values() if self.stash.matches(image, image_filter)]
+        images.sort(key=lambda image: image['id'], reverse=(filter or {}).get('direction') == 'DESC')
+
+        page, per_page = _page(filter)
+        selected = images[(page - 1) * per_page:page * per_page] if per_page > 0 else images
+        return {'count': len(images), 'images': [self.stash.image_result(image) for image in selected]}
+
+    def findTags(self, info, tag_filter=None, filter=None):
+        return self.stash.find_entities('tags', tag_filter, filter)
+
+    def findPerformers(self, info, performer_filter=None, filter=None):
+        return self.stash.find_entities('performers', performer_filter, filter)
+
+    def findStudios(self, info, studio_filter=None, filter=None):
+        return self.stash.find_entities('studios', studio_filter, filter)
+
+    def tagCreate(self, info, input):
+        return self.stash.create_entity('tags', {'name': input['name'], 'aliases': input.get('aliases') or []})
+
+    def performerCreate(self, info, input):
+        return self.stash.create_entity('performers', {'name': input['name'], 'disambiguation': input.get('disambiguation'), 'alias_list': input.get('alias_list') or []})
+
+    def studioCreate(self, info, input):
+        return self.stash.create_entity('studios', {'name': input['name']})
+
+    def imageUpdate(self, info, input):
+        return self.stash.update_image(int(input['id']), input.get('tag_ids'), input.get('performer_ids'), input.get('studio_id'), input.get('urls'))
+
+    def bulkImageUpdate(self, info, input):
+        tag_ids = (input.get('tag_ids') or {}).get('ids')
+        performer_ids = (input.get('performer_ids') or {}).get('ids')
+        urls = (input.get('urls') or {}).get('values')
+        images = [self.stash.update_image(int(image_id), tag_ids, performer_ids, input.get('studio_id'), urls) for image_id in input.get('ids') or []]
+        return [image for image in images if image is not None]
+
+def _page(find_filter: Optional[dict]) -> tuple[int, int]:
+    find_filter = find_filter or {}
+    return find_filter.get('page') or 1, find_filter.get('per_page') if find_filter.get('per_page') is not None else 25
+
+def _timestamp(value: str) -> datetime:
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+def _compare(value, modifier: str, expected, expected2=None) -> bool:
+    match modifier:
+        case 'EQUALS':
+            return value == expected
+        case 'NOT_EQUALS':
+            return value != expected
+        case 'GREATER_THAN':
+            return value > expected
+        case 'LESS_THAN':
+            return value < expected
+        case 'BETWEEN':
+            return expected <= value <= expected2
+        case 'NOT_BETWEEN':
+            return not expected <= value <= expected2
+
+    return True
+
+class FakeIqdb(FakeServer):
+    """
+    IQDB search page that matches every uploaded image with a post on one of the boorus.
+    """
+
+    def __init__(self, behaviour: Behaviour, boorus: list[str], no_match_rate: float, seed: int = 0):
+        super().__init__('iqdb', behaviour)
+        self.boorus = boorus
+        self.no_match_rate = no_match_rate
+        self.seed = seed
+
+    def handle_request_data(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple[int, str, bytes]:
+        if method != 'POST':
+            return _not_found()
+
+        marker = IMAGE_MARKER.search(body)
+        if marker is None:
+            return 400, 'text/plain', b'Not an image'
+
+        image_id = int(marker.group(1))
+        results = ''
+
+        if random.Random(self.seed * 1000003 + image_id).random() >= self.no_match_rate:
+            booru = self.boorus[image_id % len(self.boorus)]
+            results = f"""
+<div><table>
+<tr><th>Best match</th></tr>
+<tr><td class="image"><a href="{POST_URLS[booru].format(id=image_id)}"><img src="/{booru}/{image_id}.jpg"></a></td></tr>
+<tr><td><img class="service-icon" src="/icon/{booru}.ico">{booru.capitalize()}</td></tr>
+<tr><td>850×1200 [Safe]</td></tr>
+<tr><td>94% similarity</td></tr>
+</table></div>"""
+
+        page = f"""<html><body><div id="pages">
+<div><table><tr><th>Your image</th></tr><tr><td class="image"><img src="/thu/query_{image_id}.jpg"></td></tr></table></div>{results}
+</div><div id="show1"><a href="#">Show</a></div></body></html>"""
+        return 200, 'text/html; charset=utf-8', page.encode()
+
+class FakeBooru(FakeServer):
+    """
+    JSON API and post pages of one of the boorus.
+    """
+
+    SUMMARY_VERSION = 1
+
+    def __init__(self, booru: str, behaviour: Behaviour):
+        super().__init__(booru, behaviour)
+        self.booru = booru
+
+    def handle_request_data(self, method: str, path: str, query: dict, headers, body: bytes) -> tuple[int, str, bytes]:
+        match self.booru:
+            case 'danbooru':
+                return self._danbooru(path, query)
+            case 'gelbooru':
+                return self._gelbooru(path, query)
+            case 'konachan' | 'yandere':
+                return self._moebooru(path, query)
+            case 'sankaku':
+                return self._sankaku(path)
+
+        return _not_found()
+
+    def _danbooru(self, path: str, query: dict):
+        if path == '/posts.json':
+            ids = query.get('tags', '').removeprefix('id:').split(',')
+            return _json([self._danbooru_post(int(post_id)) for post_id in ids if post_id.isdigit()])
+
+        post = re.fullmatch(r'/posts/(\d+)\.json', path)
+        if post is not None:
+            return _json(self._danbooru_post(int(post.group(1))))
+
+        return _not_found()
+
+    def _danbooru_post(self, post_id: int) -> dict:
+        tags = post_tags(post_id)
+        return {
+            'id': post_id,
+            'tag_string_artist': ' '.join(tags[ARTIST]),
+            'tag_string_character': ' '.join(tags[CHARACTER]),
+            'tag_string_copyright': ' '.join(tags[COPYRIGHT]),
+            'tag_string_general': ' '.join(tags[GENERAL]),
+        }
+
+    def _gelbooru(self, path: str, query: dict):
+        if path != '/index.php':
+            return _not_found()
+
+        if query.get('page') == 'dapi' and query.get('s') == 'post':
+            post_id = int(query.get('id', 0))
+            return _json({'@attributes': {'count': 1}, 'post': [{'id': post_id, 'tags': self._tag_string(post_id)}]})
+
+        if query.get('page') == 'dapi' and query.get('s') == 'tag':
+            names = query.get('names', '').split()
+            return _json({'@attributes': {'count': len(names)}, 'tag': [{'name': name, 'type': tag_type(name)} for name in names]})
+
+        if query.get('page') == 'post' and query.get('s') == 'view':
+            return self._post_page(int(query.get('id', 0)), 'tag-list')
+
+        return _not_found()
+
+    def _moebooru(self, path: str, query: dict):
+        if path == '/post.json':
+            post_id = int(query.get('tags', '').removeprefix('id:') or 0)
+            return _json([{'id': post_id, 'tags': self._tag_string(post_id)}])
+
+        if path == '/tag/summary.json':
+            if query.get('version') == str(self.SUMMARY_VERSION):
+                return _json({'version': self.SUMMARY_VERSION, 'unchanged': True})
+
+            data = ' '.join(f"{tag_type(name)}`{name}`" for name in all_tags())
+            return _json({'version': self.SUMMARY_VERSION, 'data': data})
+
+        post = re.fullmatch(r'/post/show/(\d+).*', path)
+        if post is not None:
+            return self._post_page(int(post.group(1)), 'tag-sidebar')
+
+        return _not_found()
+
+    def _sankaku(self, path: str):
+        post = re.fullmatch(r'/posts/(\d+)', path)
+        if post is None:
+            return _not_found()
+
+        tags = post_tags(int(post.group(1)))
+        return _json({'id': int(post.group(1)), 'tags': [{'name_en': name, 'type': kind} for kind, names in tags.items() for name in names]})
+
+    def _tag_string(self, post_id: int) -> str:
+        return ' '.join(name for names in post_tags(post_id).values() for name in names)
+
+    def _post_page(self, post_id: int, sidebar_id: str):
+        classes = {ARTIST: 'tag-type-artist', CHARACTER: 'tag-type-character', COPYRIGHT: 'tag-type-copyright', GENERAL: 'tag-type-general'}
+        items = ''.join(
+            f'<li class="{classes[kind]}"><a href="/wiki/{name}">?</a> <a href="/tags/{name}">{name}</a></li>'
+            for kind, names in post_tags(post_id).items() for name in names
+        )
+        return 200, 'text/html; charset=utf-8', f'<html><body><ul id="{sidebar_id}">{items}</ul></body></html>'.encode()
@@ -0,0 +1,209 @@
+"""
+End-to-end load benchmark of the tagger against local stand-ins for stash, IQDB and the boorus.
+
+For every concurrency level the fakes are started fresh and the real main() runs in a separate
+process with -t set to the level, so the peak memory of every level is measured on its own.
+Reports images/s, latency percentiles per stage and per image and the peak RSS, and compares them
+with an earlier run saved with --output.
+
+usage: python bench/load/run.py [--images IMAGES] [--concurrency LEVELS] [--latency SERVICE=SECONDS[:JITTER]]
+                                [--error-rate SERVICE=RATE] [--throttle SERVICE=RPS] [--output FILE]
+                                [--compare FILE] [-- TAGGER_ARGS...]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import BOORU_HOSTS, BOORUS, Behaviour, FakeBooru, FakeIqdb, FakeStash
+
+SERVICES = ('stash', 'iqdb') + BOORUS
+
+# a fast local stash, a slow search and boorus in between, roughly like the real sites
+DEFAULT_LATENCY = {'stash': (0.002, 0.002), 'iqdb': (0.25, 0.1), '*': (0.05, 0.03)}
+
+WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+def service_option(value: str, parse=float) -> tuple[str, object]:
+    service, _, setting = value.partition('=')
+
+    if service != '*' and service not in SERVICES:
+        raise argparse.ArgumentTypeError(f"unknown service {service}, choose from *, {', '.join(SERVICES)}")
+
+    try:
+        return service, parse(setting)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid setting {value}")
+
+def latency_option(value: str):
+    def parse(setting: str):
+        latency, _, jitter = setting.partition(':')
+        return float(latency), float(jitter or 0)
+
+    return service_option(value, parse)
+
+def by_service(options: list, defaults: dict) -> dict:
+    settings = dict(defaults)
+    settings.update(options or [])
+    return {service: settings.get(service, settings.get('*')) for service in SERVICES}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the tagger end to end against local stand-ins for stash, IQDB and the boorus.')
+    parser.add_argument('--images', type=int, help='Number of images in the fake stash. (Default 500)', default=500)
+    parser.add_argument('--image-size', type=int, help='Bytes of every image the fake stash serves. (Default 200000)', default=200000)
+    parser.add_argument('--thumbnail-size', type=int, help='Bytes of every thumbnail the fake stash serves. (Default 20000)', default=20000)
+    parser.add_argument('--concurrency', type=lambda value: [int(level) for level in value.split(',')], help='Comma separated values of -t to run the tagger with. (Default 1,4,16)', default=[1, 4, 16])
+    parser.add_argument('--boorus', type=lambda value: value.split(','), help=f"Comma separated boorus the fake IQDB matches images with, in turn. (Default {','.join(BOORUS)})", default=list(BOORUS))
+    parser.add_argument('--no-match-rate', type=float, help='Share of the images the fake IQDB finds nothing for. (Default 0.05)', default=0.05)
+    parser.add_argument('--latency', type=latency_option, action='append', metavar='SERVICE=SECONDS[:JITTER]', help='Latency of a fake service, "*" for every booru. Can be given multiple times. (Default stash=0.002:0.002, iqdb=0.25:0.1, *=0.05:0.03)')
+    parser.add_argument('--error-rate', type=service_option, action='append', metavar='SERVICE=RATE', help='Share of the requests a fake service answers with 500. Can be given multiple times.')
+    parser.add_argument('--throttle', type=service_option, action='append', metavar='SERVICE=RPS', help='Requests per second above which a fake service answers with 429 and Retry-After. Can be given multiple times.')
+    parser.add_argument('--production-rate-limits', action='store_true', help='Keep the rate limits of the real sites instead of lifting them for the fakes.')
+    parser.add_argument('--seed', type=int, help='Seed of the matches, errors and jitter. (Default 0)', default=0)
+    parser.add_argument('--output', type=str, help='Save the results as JSON, to compare later runs with.')
+    parser.add_argument('--compare', type=str, help='Results of an earlier run to compare with, saved with --output.')
+    parser.add_argument('--threshold', type=float, help='Relative change that counts as a regression when comparing. (Default 0.1)', default=0.1)
+    parser.add_argument('tagger_args', nargs=argparse.REMAINDER, help='Extra options for the tagger, after --.')
+
+    args = parser.parse_args()
+    unknown = [booru for booru in args.boorus if booru not in BOORUS]
+    if len(unknown) > 0:
+        parser.error(f"unknown boorus: {', '.join(unknown)}")
+
+    if args.tagger_args[:1] == ['--']:
+        args.tagger_args = args.tagger_args[1:]
+
+    return args
+
+def start_fakes(args) -> dict:
+    latency = by_service(args.latency, DEFAULT_LATENCY)
+    error_rate = by_service(args.error_rate, {'*': 0.0})
+    throttle = by_service(args.throttle, {'*': None})
+
+    def behaviour(index: int, service: str) -> Behaviour:
+        return Behaviour(latency[service][0], latency[service][1], error_rate[service], throttle[service], seed=args.seed * 100 + index)
+
+    fakes = {
+        'stash': FakeStash(behaviour(0, 'stash'), args.images, args.image_size, args.thumbnail_size),
+        'iqdb': FakeIqdb(behaviour(1, 'iqdb'), args.boorus, args.no_match_rate, seed=args.seed),
+    }
+    for index, booru in enumerate(BOORUS):
+        fakes[booru] = FakeBooru(booru, behaviour(index + 2, booru))
+
+    for fake in fakes.values():
+        fake.start()
+
+    return fakes
+
+def tagger_args(args, fakes: dict, concurrency: int, work_dir: str) -> list[str]:
+    tagger = [
+        '-s', fakes['stash'].url, '-k', 'bench', '-u', 'bench', '-p', 'bench', '-a',
+        '-t', str(concurrency),
+        '--iqdb-url', f"{fakes['iqdb'].url}/",
+        '--cache-path', os.path.join(work_dir, 'cache.db'),
+    ]
+
+    for booru, hosts in BOORU_HOSTS.items():
+        for host in hosts:
+            tagger += ['--host-override', f"{host}={fakes[booru].url}"]
+
+    if not args.production_rate_limits:
+        # "*" is the limiter of the fake IQDB, stash keeps its own limits since it is local anyway
+        for host in ['*'] + [host for hosts in BOORU_HOSTS.values() for host in hosts]:
+            tagger += ['--rate-limit', f"{host}=10000:1024"]
+
+    return tagger + args.tagger_args
+
+def run_level(args, concurrency: int) -> dict:
+    fakes = start_fakes(args)
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='tagger-bench-') as work_dir:
+            process = subprocess.run([sys.executable, WORKER, work_dir, *tagger_args(args, fakes, concurrency, work_dir)], stdout=subprocess.PIPE, text=True)
+
+            if process.returncode != 0:
+                raise Exception(f"The tagger failed at concurrency {concurrency} with exit code {process.returncode}.")
+
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+    finally:
+        for fake in fakes.values():
+            fake.stop()
+
+    result['concurrency'] = concurrency
+    result['tagged'] = fakes['stash'].tagged_images('stash-booru-tagger')
+    result['requests'] = {name: fake.stats for name, fake in fakes.items() if fake.stats['requests'] > 0}
+    return result
+
+def print_level(result: dict):
+    print(f"\n-t {result['concurrency']}: {result['processed']} processed, {result['failed']} failed in {result['seconds']:.1f}s, "
+          f"{result['images_per_second']:.2f} images/s, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+    print(f"  {'stage':<10} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in result['stages'].items():
+        if stats['count'] == 0:
+            continue
+        print(f"  {name:<10} {stats['count']:>7} " + " ".join(f"{stats[key] * 1000:>9.1f}" for key in ('p50', 'p90', 'p99', 'max')))
+
+    requests = ", ".join(f"{name} {stats['requests']}" + (f" ({stats['throttled']} throttled, {stats['errors']} errors)" if stats['throttled'] or stats['errors'] else "") for name, stats in result['requests'].items())
+    print(f"  requests: {requests}")
+
+def compare(results: list[dict], baseline: dict, threshold: float) -> bool:
+    """
+    Print the change of every level against the baseline, returns whether anything regressed.
+    """
+    previous = {level['concurrency']: level for level in baseline['levels']}
+    regressed = False
+
+    print(f"\nCompared with {baseline.get('started', 'the baseline')}:")
+    print(f"  {'-t':>4} {'metric':<16} {'baseline':>10} {'now':>10} {'change':>8}")
+
+    for result in results:
+        before = previous.get(result['concurrency'])
+        if before is None:
+            continue
+
+        # higher is better for the throughput, lower for everything else
+        metrics = [('images/s', before['images_per_second'], result['images_per_second'], True), ('peak RSS MB', before['peak_rss_mb'], result['peak_rss_mb'], False)]
+        for name in ('image', 'match', 'tags'):
+            if before['stages'].get(name, {}).get('count') and result['stages'].get(name, {}).get('count'):
+                metrics.append((f"{name} p90 ms", before['stages'][name]['p90'] * 1000, result['stages'][name]['p90'] * 1000, False))
+
+        for name, old, new, higher_is_better in metrics:
+            change = (new - old) / old if old else 0.0
+            worse = change < -threshold if higher_is_better else change > threshold
+            regressed = regressed or worse
+            print(f"  {result['concurrency']:>4} {name:<16} {old:>10.2f} {new:>10.2f} {change:>+7.1%}" + ("  REGRESSION" if worse else ""))
+
+    return regressed
+
+def main():
+    args = parse_args()
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    results = []
+
+    print(f"Tagging {args.images} fake images at -t {', '.join(map(str, args.concurrency))}...")
+    for concurrency in args.concurrency:
+        result = run_level(args, concurrency)
+        print_level(result)
+        results.append(result)
+
+    report = {'started': started, 'options': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}, 'levels': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Runs the tagger against the fakes the load benchmark started, in a process of its own, and prints
+what it measured as JSON on the last line of stdout.
+
+usage: python bench/load/worker.py WORK_DIR TAGGER_ARGS...
+"""
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from functools import wraps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import main as tagger
+from net import RateLimits
+from stash import StashAPI
+from state import RunState
+
+def percentiles(values: list[float]) -> dict:
+    if len(values) == 0:
+        return {'count': 0}
+
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'count': len(values), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1]}
+
+def instrument(timings: defaultdict):
+    """
+    Time every stage handler, and every image from the start of its download until it is done.
+    """
+    build_stages = tagger.build_stages
+    finish_image = tagger.finish_image
+    started = {}
+
+    def timed(name, handler):
+        @wraps(handler)
+        async def run(job):
+            start = time.perf_counter()
+            started.setdefault(job.id, start)
+            try:
+                return await handler(job)
+            finally:
+                timings[name].append(time.perf_counter() - start)
+        return run
+
+    def build_timed_stages(*args, **kwargs):
+        stages = build_stages(*args, **kwargs)
+        for stage in stages:
+            stage.handler = timed(stage.name, stage.handler)
+        return stages
+
+    async def finish_timed_image(counter, job, *args, **kwargs):
+        start = started.pop(job.id, None)
+        if start is not None:
+            timings['image'].append(time.perf_counter() - start)
+        await finish_image(counter, job, *args, **kwargs)
+
+    tagger.build_stages = build_timed_stages
+    tagger.finish_image = finish_timed_image
+
+def run(work_dir: str, tagger_args: list[str]) -> dict:
+    sys.argv = ['main.py', *tagger_args]
+    args = tagger.parse_args()
+
+    # logging every image would cost more than some of the stages being measured
+    logging.basicConfig(level=logging.WARNING, format='[%(asctime)s] [%(levelname)s] %(message)s')
+    tagger.logger = logging.getLogger('main')
+
+    timings = defaultdict(list)
+    instrument(timings)
+
+    run_state = RunState(os.path.join(work_dir, 'tagger.db'))
+    rate_limits = tagger.load_rate_limits(args)
+    stash_api = StashAPI(args.stash_url, args.api_key, args.stash_username, args.stash_password, rate_limiter=rate_limits.limiter(RateLimits.STASH), schema_cache=args.cache_path)
+    stash_api.check_api()
+
+    start = time.perf_counter()
+    try:
+        asyncio.run(tagger.main(stash_api, run_state, rate_limits, args))
+    finally:
+        run_state.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'processed': len(run_state.processed),
+        'failed': len(run_state.failed),
+        'images_per_second': len(run_state.processed) / elapsed if elapsed > 0 else 0.0,
+        'stages': {name: percentiles(values) for name, values in timings.items()},
+        # kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+if __name__ == '__main__':
+    print(json.dumps(run(sys.argv[1], sys.argv[2:])))
@@ -0,0 +1,77 @@
+"""
+Benchmark of the post page tag extraction against the post pages in bench/fixtures.
+
+The pages there are synthetic stand-ins until bench/micro.py --record replaced them with real ones,
+timings on them only compare parsers with each other. --soup also times the previous three-scan
+BeautifulSoup html.parser parse, which needs beautifulsoup4. The tagger itself no longer does.
+
+usage: python bench/parse_tags.py [-n ITERATIONS] [--soup]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from booru.SidebarTags import extract_sidebar_tags
+from booru.Tags import Tags
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def parse_soup(content: bytes) -> Tags:
+    # the scrape the adapters used before the sidebar extractor
+    from bs4 import BeautifulSoup
+
+    def parse_li(li_tag):
+        tags = []
+        for el in li_tag:
+            a_tags = el.find_all('a')
+
+            if len(a_tags) >= 2:
+                tags.append(a_tags[1].text)
+        return tags
+
+    soup = BeautifulSoup(content, 'html.parser')
+    return Tags(
+        artist=parse_li(soup.find_all('li', class_=lambda x: x and 'tag-type-artist' in x)),
+        character=parse_li(soup.find_all('li', class_=lambda x: x and 'tag-type-character' in x)),
+        copyright=parse_li(soup.find_all('li', class_=lambda x: x and 'tag-type-copyright' in x)),
+    )
+
+def time_parse(parse, content: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        parse(content)
+    return (time.perf_counter() - start) / iterations * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parsing tags from the booru post pages in bench/fixtures.')
+    parser.add_argument('-n', '--iterations', type=int, help='Number of times every page is parsed. (Default 200)', default=200)
+    parser.add_argument('--soup', action='store_true', help='Also time the previous BeautifulSoup parse, requires beautifulsoup4.')
+    args = parser.parse_args()
+
+    parsers = {'sidebar (lxml)': extract_sidebar_tags}
+    if args.soup:
+        try:
+            import bs4
+        except ImportError:
+            parser.error("--soup requires beautifulsoup4, install it with pip install beautifulsoup4")
+
+        parsers['soup (html.parser)'] = parse_soup
+
+    print(f"{'page':<24} {'size':>8} " + " ".join(f"{name + ' ms':>22}" for name in parsers))
+
+    for name in sorted(name for name in os.listdir(FIXTURES) if name.endswith('_post.html')):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            content = f.read()
+
+        results = {parser_name: parse(content) for parser_name, parse in parsers.items()}
+        if len(set(map(repr, results.values()))) > 1:
+            raise Exception(f"Parsers disagree on {name}: {results}")
+
+        timings = [time_parse(parse, content, args.iterations) for parse in parsers.values()]
+        print(f"{name:<24} {len(content):>8} " + " ".join(f"{timing:>22.3f}" for timing in timings))
+
+if __name__ == '__main__':
+    main()
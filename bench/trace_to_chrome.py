@@ -0,0 +1,24 @@
+"""
+Converts the span files written with --trace to Chrome trace events, which open in chrome://tracing,
+Perfetto or speedscope. The files of several workers of a run are merged into one trace.
+
+usage: python bench/trace_to_chrome.py TRACE [TRACE ...] -o OUTPUT
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import Tracer
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts span files written with --trace to Chrome trace events.')
+    parser.add_argument('traces', nargs='+', help='Span files written with --trace.')
+    parser.add_argument('-o', '--output', type=str, help='Path of the Chrome trace file.', required=True)
+    args = parser.parse_args()
+
+    Tracer.to_chrome(args.traces, args.output)
+
+if __name__ == '__main__':
+    main()
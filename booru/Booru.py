@@ -1,7 +1,37 @@
 from abc import ABC, abstractmethod
+from typing import Optional
+from net import HttpClients
 from .Tags import Tags
+from .TagTypes import TagTypes
 
 class Booru(ABC):
+    def __init__(self, http: HttpClients, tag_types: Optional[TagTypes] = None):
+        self.http = http
+        self.tag_types = tag_types
+
     @abstractmethod
-    def get_tags(self, url: str) -> Tags:
-        pass
\ No newline at end of file
+    async def get_tags(self, url: str) -> Tags:
+        pass
+
+    def _sort_tags(self, names: list[str], types: dict[str, int]) -> Tags:
+        """
+        Sort the tag names of a post by their type, tags of any other type are left out.
+
+        :param names: Tag names as the post API lists them.
+        :param types: Tag types by tag name.
+        """
+        tags = Tags(artist=[], character=[], copyright=[])
+
+        for name in names:
+            # post pages show tag names with spaces, keep them that way so earlier runs' stash tags still match
+            display_name = name.replace('_', ' ')
+
+            match types.get(name):
+                case TagTypes.ARTIST:
+                    tags.artist.append(display_name)
+                case TagTypes.CHARACTER:
+                    tags.character.append(display_name)
+                case TagTypes.COPYRIGHT:
+                    tags.copyright.append(display_name)
+
+        return tags
@@ -1,27 +1,73 @@
 from .Booru import Booru
 from .Tags import Tags
-import requests
+from metrics import TRACER
+from net import HttpClients
+from utils import RequestBatcher
+import urllib.parse
 
 class Danbooru(Booru):
+    """
+    Tags from the Danbooru API.
+
+    Posts requested at about the same time are fetched together with a single posts.json search
+    for their ids.
+    """
+
     HOST = "danbooru.donmai.us"
 
-    def get_tags(self, url: str) -> Tags:
-        resp = requests.get(self._parse_url(url))
+    def __init__(self, http: HttpClients, batch_size: int = 100, batch_delay: float = 0.1):
+        """
+        Construct a new Danbooru object.
+
+        :param http: Shared http clients.
+        :param batch_size: Number of posts fetched with one request at most.
+        :param batch_delay: Seconds to wait for more posts before fetching a batch.
+        """
+        super().__init__(http)
+        self.posts = RequestBatcher(self._get_posts, max_size=batch_size, max_delay=batch_delay)
+
+    @TRACER.traced('booru')
+    async def get_tags(self, url: str) -> Tags:
+        post_id = self._parse_post_id(url)
+        post = await self.posts.get(post_id)
+
+        # posts that are hidden from searches can still be fetched on their own
+        if post is None:
+            post = await self._get_post(post_id)
+
+        return self._parse_post(post)
+
+    async def _get_posts(self, post_ids: list[int]) -> dict:
+        resp = await self.http.client(self.HOST).get(f"https://{self.HOST}/posts.json", params={
+            "tags": f"id:{','.join(map(str, post_ids))}",
+            "limit": len(post_ids),
+        })
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to get posts. Status code: {resp.status_code}")
+
+        return {post['id']: post for post in resp.json() if 'id' in post}
+
+    async def _get_post(self, post_id: int) -> dict:
+        resp = await self.http.client(self.HOST).get(f"https://{self.HOST}/posts/{post_id}.json")
 
         if resp.status_code != 200:
             raise Exception("Failed to get tags")
-        
-        resp_json = resp.json()
 
+        return resp.json()
+
+    def _parse_post(self, post: dict) -> Tags:
         # check if required tags are present
-        if 'tag_string_character' not in resp_json or 'tag_string_artist' not in resp_json or 'tag_string_copyright' not in resp_json:
+        if 'tag_string_character' not in post or 'tag_string_artist' not in post or 'tag_string_copyright' not in post:
             raise Exception("Invalid response from Danbooru API. Missing required tags.")
         
         return Tags(
-            character=resp_json['tag_string_character'].split(" "),
-            artist=resp_json['tag_string_artist'].split(" "),
-            copyright=resp_json['tag_string_copyright'].split(" "),
+            character=post['tag_string_character'].split(" "),
+            artist=post['tag_string_artist'].split(" "),
+            copyright=post['tag_string_copyright'].split(" "),
         )
     
-    def _parse_url(self, url: str) -> str:
-        return url + ".json"
\ No newline at end of file
+    def _parse_post_id(self, url: str) -> int:
+        # post urls look like /posts/<id>, older ones like /post/show/<id>
+        path = urllib.parse.urlparse(url).path.rstrip('/').split('/')
+        return int(path[-1])
@@ -1,35 +1,130 @@
 from .Booru import Booru
 from .Tags import Tags
-import requests
-from bs4 import BeautifulSoup
+from .TagTypes import TagTypes
+from metrics import TRACER
+from net import HttpClients
+from .SidebarTags import extract_sidebar_tags
+from typing import Optional
+import asyncio
+import html
+import logging
+import urllib.parse
 
 class Gelbooru(Booru):
+    """
+    Tags from the Gelbooru API.
+
+    Gelbooru has no summary of its tags, so tags the dictionary does not know are looked up by
+    name in batches, shared between posts fetched at the same time. The post page is scraped when
+    the API fails.
+    """
+
     HOST = "gelbooru.com"
+    API_URL = "https://gelbooru.com/index.php"
+    # tag names per lookup, they are sent in the query string
+    TAG_BATCH_SIZE = 100
+
+    def __init__(self, http: HttpClients, tag_types: Optional[TagTypes] = None, api_key: Optional[str] = None, user_id: Optional[str] = None):
+        """
+        Construct a new Gelbooru object.
+
+        :param http: Shared http clients.
+        :param tag_types: Tag type dictionary, the post page is scraped without it. (optional)
+        :param api_key: Gelbooru API key. (optional)
+        :param user_id: Gelbooru user id the API key belongs to. (optional)
+        """
+        super().__init__(http, tag_types)
+        self.logger = logging.getLogger(__name__)
+        self.api_key = api_key
+        self.user_id = user_id
+        self._lookups = {}
 
-    def get_tags(self, url: str) -> Tags:
-        resp = requests.get(url)
+    @TRACER.traced('booru')
+    async def get_tags(self, url: str) -> Tags:
+        if self.tag_types is not None:
+            try:
+                return await self._get_api_tags(url)
+            except Exception as e:
+                self.logger.warning(f"Failed to get tags of {url} from the Gelbooru API, falling back to the post page: {str(e)}")
+
+        return await self._get_page_tags(url)
+
+    async def _get_api_tags(self, url: str) -> Tags:
+        post_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)['id'][0]
+        resp = await self.http.client(self.HOST).get(self.API_URL, params=self._api_params('post', id=post_id))
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to get post {post_id}. Status code: {resp.status_code}")
+
+        names = self._parse_post_tags(resp.json(), post_id)
+        # the dictionary may be busy with a large write of another booru, wait for it off the event loop
+        types = await asyncio.to_thread(self.tag_types.get_types, self.HOST, names)
+
+        unknown = [name for name in set(names) if name not in types]
+        if len(unknown) > 0:
+            await self._lookup_tag_types(unknown)
+            types = await asyncio.to_thread(self.tag_types.get_types, self.HOST, names)
+
+        return self._sort_tags(names, types)
+
+    async def _lookup_tag_types(self, names: list[str]):
+        """
+        Look up the types of tags, joining lookups that are already running for some of them.
+
+        :param names: Names of the tags.
+        """
+        tasks = {self._lookups[name] for name in names if name in self._lookups}
+        missing = [name for name in names if name not in self._lookups]
+
+        for i in range(0, len(missing), self.TAG_BATCH_SIZE):
+            batch = missing[i:i + self.TAG_BATCH_SIZE]
+            task = asyncio.create_task(self._load_tag_types(batch))
+            task.add_done_callback(lambda _, batch=batch: [self._lookups.pop(name, None) for name in batch])
+            tasks.add(task)
+
+            for name in batch:
+                self._lookups[name] = task
+
+        await asyncio.gather(*[asyncio.shield(task) for task in tasks])
+
+    async def _load_tag_types(self, names: list[str]):
+        resp = await self.http.client(self.HOST).get(self.API_URL, params=self._api_params('tag', names=' '.join(names), limit=len(names)))
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to look up tags. Status code: {resp.status_code}")
+
+        await asyncio.to_thread(self.tag_types.put_types, self.HOST, self._parse_tag_types(resp.json(), names))
+
+    def _parse_post_tags(self, data: dict, post_id: str) -> list[str]:
+        posts = data.get('post')
+        if not posts:
+            raise Exception(f"Post {post_id} not found.")
+
+        # the api html-escapes tag names, e.g. &#039; for '
+        return [html.unescape(name) for name in posts[0]['tags'].split()]
+
+    def _parse_tag_types(self, data: dict, names: list[str]) -> dict[str, int]:
+        # tags gelbooru does not know are stored as general, so they are not looked up again for every post
+        types = dict.fromkeys(names, TagTypes.GENERAL)
+        for tag in data.get('tag', []):
+            types[html.unescape(tag['name'])] = int(tag['type'])
+
+        return types
+
+    def _api_params(self, kind: str, **params) -> dict:
+        params = {'page': 'dapi', 's': kind, 'q': 'index', 'json': 1, **params}
+
+        if self.api_key is not None and self.user_id is not None:
+            params['api_key'] = self.api_key
+            params['user_id'] = self.user_id
+
+        return params
+
+    async def _get_page_tags(self, url: str) -> Tags:
+        resp = await self.http.client(self.HOST).get(url)
 
         if resp.status_code != 200:
             raise Exception("Failed to get tags")
-        
-        soup = BeautifulSoup(resp.content, 'html.parser')
-
-        # API not used as tags are not separated by type in the API response.
-        html_artist_tags = soup.find_all('li', class_=lambda x: x and 'tag-type-artist' in x)
-        html_copyright_tags = soup.find_all('li', class_=lambda x: x and 'tag-type-copyright' in x)
-        html_character_tags = soup.find_all('li', class_=lambda x: x and 'tag-type-character' in x)
-
-        return Tags(
-            artist=self._parse_li(html_artist_tags),
-            character=self._parse_li(html_character_tags),
-            copyright=self._parse_li(html_copyright_tags),
-        )
-
-    def _parse_li(self, li_tag):
-        tags = []
-        for el in li_tag:
-            a_tags = el.find_all('a')
-
-            if len(a_tags) >= 2:
-                tags.append(a_tags[1].text)
-        return tags
\ No newline at end of file
+
+        # parsing the page is cpu bound, keep it off the event loop
+        return await asyncio.to_thread(extract_sidebar_tags, resp.content)
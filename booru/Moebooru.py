@@ -0,0 +1,144 @@
+from .Booru import Booru
+from .Tags import Tags
+from .TagTypes import TagTypes
+from metrics import TRACER
+from net import HttpClients
+from .SidebarTags import extract_sidebar_tags
+from typing import Optional
+import asyncio
+import json
+import logging
+import time
+import urllib.parse
+
+class Moebooru(Booru):
+    """
+    Base for Moebooru based boorus, which share their post pages and API.
+
+    Tags are read from the post API and sorted by type with the tag summary of the booru. The
+    summary is downloaded in full the first time and afterwards only when its version changed.
+    The post page is scraped when the API fails, or when a post has tags the summary does not know
+    even after a refresh.
+    """
+
+    HOST = None
+
+    # seconds between refreshes of the tag summary, posts with tags it does not know yet are scraped meanwhile
+    SUMMARY_INTERVAL = 600
+
+    def __init__(self, http: HttpClients, tag_types: Optional[TagTypes] = None):
+        super().__init__(http, tag_types)
+        self.logger = logging.getLogger(__name__)
+        self._summary = None
+        self._summary_at = float('-inf')
+
+    @TRACER.traced('booru')
+    async def get_tags(self, url: str) -> Tags:
+        if self.tag_types is not None:
+            try:
+                return await self._get_api_tags(url)
+            except Exception as e:
+                self.logger.warning(f"Failed to get tags of {url} from the {self.HOST} API, falling back to the post page: {str(e)}")
+
+        return await self._get_page_tags(url)
+
+    async def _get_api_tags(self, url: str) -> Tags:
+        post_id = self._parse_post_id(url)
+        resp = await self.http.client(self.HOST).get(f"https://{self.HOST}/post.json", params={"tags": f"id:{post_id}"})
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to get post {post_id}. Status code: {resp.status_code}")
+
+        names = self._parse_post_tags(resp.json(), post_id)
+        types = await asyncio.to_thread(self.tag_types.get_types, self.HOST, names)
+
+        # tags the dictionary does not know yet or that expired come with a newer version of the summary
+        if len(types) < len(set(names)):
+            await self._refresh_tag_types()
+            types = await asyncio.to_thread(self.tag_types.get_types, self.HOST, names)
+
+        # leaving them out would write the image with tags missing
+        unknown = set(names) - types.keys()
+        if len(unknown) > 0:
+            raise Exception(f"{len(unknown)} tags of post {post_id} are not in the tag summary, e.g. {sorted(unknown)[0]}")
+
+        return self._sort_tags(names, types)
+
+    async def _refresh_tag_types(self):
+        """
+        Refresh the tag dictionary from the tag summary, at most once every SUMMARY_INTERVAL seconds.
+
+        Posts that need a refresh while one is running wait for it. A failed refresh is tried again
+        by the next post.
+        """
+        task = self._summary
+        if task is None:
+            if time.monotonic() - self._summary_at < self.SUMMARY_INTERVAL:
+                return
+
+            task = asyncio.create_task(self._load_tag_summary())
+            task.add_done_callback(self._summary_done)
+            self._summary = task
+
+        await asyncio.shield(task)
+
+    def _summary_done(self, task: asyncio.Task):
+        if self._summary is task:
+            self._summary = None
+
+    async def _load_tag_summary(self):
+        # the dictionary may be busy with a large write of another booru, wait for it off the event loop
+        version = await asyncio.to_thread(self.tag_types.get_cursor, self.HOST)
+        params = {"version": version} if version is not None else {}
+
+        self.logger.info(f"Refreshing the {self.HOST} tag dictionary...")
+        resp = await self.http.client(self.HOST).get(f"https://{self.HOST}/tag/summary.json", params=params)
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to get the tag summary. Status code: {resp.status_code}")
+
+        # the summary lists every tag of the booru, keep it off the event loop
+        summary = await asyncio.to_thread(json.loads, resp.content)
+
+        if summary.get('unchanged'):
+            await asyncio.to_thread(self.tag_types.touch, self.HOST)
+            self._summary_at = time.monotonic()
+            return
+
+        types = await asyncio.to_thread(self._parse_summary, summary['data'])
+        await asyncio.to_thread(self.tag_types.put_types, self.HOST, types)
+        await asyncio.to_thread(self.tag_types.set_cursor, self.HOST, summary['version'])
+        self._summary_at = time.monotonic()
+        self.logger.info(f"Loaded {len(types)} {self.HOST} tags, summary version {summary['version']}.")
+
+    def _parse_post_tags(self, posts: list, post_id: str) -> list[str]:
+        if len(posts) == 0:
+            raise Exception(f"Post {post_id} not found.")
+
+        return posts[0]['tags'].split()
+
+    def _parse_summary(self, data: str) -> dict[str, int]:
+        # every tag is written as type`name`alias`alias`... and tags are separated by spaces
+        types = {}
+
+        for entry in data.split(' '):
+            fields = entry.split('`')
+
+            if len(fields) >= 2 and fields[0].isdigit():
+                types[fields[1]] = int(fields[0])
+
+        return types
+
+    def _parse_post_id(self, url: str) -> str:
+        # post urls look like /post/show/<id> with an optional slug after the id
+        path = urllib.parse.urlparse(url).path.split('/')
+        return path[path.index('show') + 1]
+
+    async def _get_page_tags(self, url: str) -> Tags:
+        resp = await self.http.client(self.HOST).get(url)
+
+        if resp.status_code != 200:
+            raise Exception("Failed to get tags")
+
+        # parsing the page is cpu bound, keep it off the event loop
+        return await asyncio.to_thread(extract_sidebar_tags, resp.content)
@@ -1,21 +1,22 @@
 from .Booru import Booru
 from .Tags import Tags
-import requests
-from bs4 import BeautifulSoup
+from metrics import TRACER
 import urllib.parse
 
 class Sankaku(Booru):
     HOST = "chan.sankakucomplex.com"
     API_HOST = "https://capi-v2.sankakucomplex.com"
 
-    def get_tags(self, url: str) -> Tags:
-        resp = requests.get(self._parse_url(url))
+    @TRACER.traced('booru')
+    async def get_tags(self, url: str) -> Tags:
+        resp = await self.http.client(self.HOST).get(self._parse_url(url))
 
         if resp.status_code != 200:
             raise Exception("Failed to get tags")
-        
-        resp_json = resp.json()
 
+        return self._parse_post(resp.json())
+
+    def _parse_post(self, resp_json: dict) -> Tags:
         copyright_tags = []
         artist_tags = []
         character_tags = []
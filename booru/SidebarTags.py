@@ -0,0 +1,88 @@
+import re
+from .Tags import Tags
+
+# ids of the tag sidebar on Moebooru and Gelbooru post pages
+SIDEBAR_IDS = (b'id="tag-sidebar"', b'id="tag-list"')
+
+# opening and closing tags of an element, the name is filled in with the element the sidebar is
+_TAG_PATTERN = rb'<(/?)%s[\s>/]'
+
+TAG_TYPE_CLASSES = {
+    'tag-type-artist': 'artist',
+    'tag-type-character': 'character',
+    'tag-type-copyright': 'copyright',
+}
+
+def extract_sidebar_tags(content: bytes) -> Tags:
+    """
+    Extract the artist, character and copyright tags from the tag sidebar of a post page.
+
+    Only the sidebar is parsed, in a single pass over its list items. The sidebar runs up to its
+    own closing tag, lists nested in it included. Pages without a known sidebar are parsed in full.
+
+    :param content: HTML of the post page.
+    """
+    # lxml is only needed when the API of a booru failed and its post page is scraped
+    import lxml.html
+
+    tags = Tags(artist=[], character=[], copyright=[])
+    # parsers must not be shared between threads, and pages are parsed in worker threads
+    root = lxml.html.fromstring(_slice_sidebar(content), parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    for li in root.iter('li'):
+        kind = _tag_kind(li.get('class'))
+        if kind is None:
+            continue
+
+        # the first link goes to the wiki, the second one is the tag itself
+        links = list(li.iter('a'))
+        if len(links) >= 2:
+            getattr(tags, kind).append(links[1].text_content())
+
+    return tags
+
+def _slice_sidebar(content: bytes) -> bytes:
+    for sidebar_id in SIDEBAR_IDS:
+        start = content.find(sidebar_id)
+        if start == -1:
+            continue
+
+        start = content.rfind(b'<', 0, start)
+        end = _find_element_end(content, start)
+        return content[start:end] if end != -1 else content[start:]
+
+    return content
+
+def _find_element_end(content: bytes, start: int) -> int:
+    """
+    Find where the element starting at start ends, counting the lists or divisions nested in it.
+
+    :param content: HTML of the page.
+    :param start: Offset of the opening tag.
+    :return: Offset after the closing tag, or -1 if the element is not closed.
+    """
+    name = re.match(rb'<([a-zA-Z0-9]+)', content[start:start + 32])
+    if name is None:
+        return -1
+
+    depth = 0
+    pattern = re.compile(_TAG_PATTERN % re.escape(name.group(1)), re.IGNORECASE)
+    for tag in pattern.finditer(content, start):
+        depth += -1 if tag.group(1) else 1
+
+        if depth == 0:
+            end = content.find(b'>', tag.start())
+            return end + 1 if end != -1 else -1
+
+    return -1
+
+def _tag_kind(classes: str):
+    if not classes:
+        return None
+
+    for name in classes.split():
+        kind = TAG_TYPE_CLASSES.get(name)
+        if kind is not None:
+            return kind
+
+    return None
@@ -0,0 +1,65 @@
+import asyncio
+from dataclasses import asdict
+from typing import Awaitable, Callable, Optional
+from metrics import METRICS
+from utils import SqliteCache
+from .Tags import Tags
+
+class TagCache:
+    """
+    Cache in front of the booru adapters, keyed by post URL.
+
+    Concurrent requests for the same post share a single fetch, and fetched tags are kept in a
+    persistent store so later runs do not have to fetch them again.
+    """
+
+    def __init__(self, path: Optional[str], ttl: float):
+        """
+        Construct a new TagCache object.
+
+        :param path: Path of the SQLite database to keep tags in, or None to only share fetches within this run.
+        :param ttl: Seconds until stored tags expire.
+        """
+        self.store = SqliteCache(path, 'booru_tags') if path is not None else None
+        self.ttl = ttl
+        self.hits = 0
+        self._pending = {}
+
+    async def get_tags(self, url: str, fetch: Callable[[str], Awaitable[Tags]]) -> Tags:
+        """
+        Get the tags of a post, fetching them only if they are not cached or already being fetched.
+
+        :param url: URL of the booru post.
+        :param fetch: Fetches the tags of a post URL.
+        """
+        if self.store is not None:
+            # cache.db may be busy with a write from another thread, wait for it off the event loop
+            tags = await asyncio.to_thread(self.store.get, url)
+            if tags is not None:
+                self.hits += 1
+                METRICS.cache.inc('tags', 'hit')
+                return Tags(**tags)
+
+        task = self._pending.get(url)
+        if task is not None:
+            self.hits += 1
+            METRICS.cache.inc('tags', 'hit')
+            return await asyncio.shield(task)
+
+        METRICS.cache.inc('tags', 'miss')
+
+        task = asyncio.create_task(fetch(url))
+        self._pending[url] = task
+        try:
+            tags = await asyncio.shield(task)
+        finally:
+            self._pending.pop(url, None)
+
+        if self.store is not None:
+            await asyncio.to_thread(self.store.put, url, asdict(tags), self.ttl)
+
+        return tags
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
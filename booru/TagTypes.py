@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+class TagTypes:
+    """
+    Local dictionary of booru tag names to tag types, kept per booru host in SQLite.
+
+    The post APIs of most boorus only list the tag names of a post, the dictionary is what sorts
+    them into artists, characters and copyrights. Every call can wait for the lock while another
+    booru writes its dictionary, so the adapters make them from worker threads and the connection
+    is shared behind a lock.
+    """
+
+    # tag types as numbered by both Moebooru and Gelbooru
+    GENERAL = 0
+    ARTIST = 1
+    COPYRIGHT = 3
+    CHARACTER = 4
+
+    def __init__(self, path: Optional[str], ttl: float):
+        """
+        Open the dictionary, creating its tables if needed.
+
+        :param path: Path of the SQLite database, or None to only keep the dictionary for this run.
+        :param ttl: Seconds until a tag type has to be looked up again.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path if path is not None else ':memory:', check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('PRAGMA busy_timeout=5000')
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS booru_tag_types (
+                host TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (host, name)
+            );
+        ''')
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS booru_tag_syncs (
+                host TEXT PRIMARY KEY,
+                cursor TEXT NOT NULL,
+                synced_at REAL NOT NULL
+            );
+        ''')
+        self.con.commit()
+
+    def get_types(self, host: str, names: Iterable[str]) -> dict[str, int]:
+        """
+        Get the known types of tags, tags that are unknown or expired are left out.
+
+        :param host: Host of the booru.
+        :param names: Names of the tags.
+        """
+        names = list(set(names))
+        expired = time.time() - self.ttl
+        types = {}
+
+        with self._lock:
+            # stay below the number of variables sqlite allows in one statement
+            for i in range(0, len(names), 500):
+                batch = names[i:i + 500]
+                rows = self.con.execute(
+                    f'SELECT name, type FROM booru_tag_types WHERE host = ? AND updated_at >= ? AND name IN ({",".join("?" * len(batch))})',
+                    (host, expired, *batch)
+                )
+                types.update(rows)
+
+        return types
+
+    def put_types(self, host: str, types: dict[str, int]):
+        """
+        Store the types of tags.
+
+        :param host: Host of the booru.
+        :param types: Tag types by tag name.
+        """
+        now = time.time()
+
+        with self._lock:
+            self.con.executemany(
+                'INSERT OR REPLACE INTO booru_tag_types (host, name, type, updated_at) VALUES (?, ?, ?, ?)',
+                ((host, name, type, now) for name, type in types.items())
+            )
+            self.con.commit()
+
+    def touch(self, host: str):
+        """
+        Mark every tag type of a host as up to date, e.g. after the booru reported nothing changed.
+
+        :param host: Host of the booru.
+        """
+        with self._lock:
+            self.con.execute('UPDATE booru_tag_types SET updated_at = ? WHERE host = ?', (time.time(), host))
+            self.con.commit()
+
+    def get_cursor(self, host: str) -> Optional[str]:
+        """
+        Get where the last refresh of a host's dictionary left off, e.g. the version of its tag list.
+
+        :param host: Host of the booru.
+        """
+        with self._lock:
+            row = self.con.execute('SELECT cursor FROM booru_tag_syncs WHERE host = ?', (host,)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_cursor(self, host: str, cursor: str):
+        """
+        Store where the refresh of a host's dictionary left off.
+
+        :param host: Host of the booru.
+        :param cursor: Position to continue the next refresh from.
+        """
+        with self._lock:
+            self.con.execute('INSERT OR REPLACE INTO booru_tag_syncs (host, cursor, synced_at) VALUES (?, ?, ?)', (host, str(cursor), time.time()))
+            self.con.commit()
+
+    def close(self):
+        self.con.close()
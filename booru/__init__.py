@@ -1,6 +1,21 @@
+import importlib
 from .BooruEnum import BooruEnum
-from .Danbooru import Danbooru
-from .Yandere import Yandere
-from .Gelbooru import Gelbooru
-from .Sankaku import Sankaku
-from .Konachan import Konachan
\ No newline at end of file
+from .TagCache import TagCache
+from .TagTypes import TagTypes
+
+# the adapters are only imported when they are first used, most runs only need some of them
+_ADAPTERS = ('Danbooru', 'Yandere', 'Gelbooru', 'Sankaku', 'Konachan')
+
+def __getattr__(name: str):
+    if name not in _ADAPTERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # the submodule has the name of its class, bind the class over the module the import sets. Once
+    # anything imports the submodule directly its module is bound again, so the tagger imports the
+    # classes from their submodules and this is only a convenience.
+    adapter = getattr(importlib.import_module(f".{name}", __name__), name)
+    globals()[name] = adapter
+    return adapter
+
+def __dir__():
+    return sorted(set(globals()) | set(_ADAPTERS))
@@ -1,200 +1,459 @@
 import argparse
+import json
 import logging
 from gql.transport.requests import log as requests_logger
 from stash import StashAPI
-from stash import ImageFetchType
+from stash import ImageFetchType, EntityResolver, ImageUpdateBuffer
 from gql.transport.exceptions import TransportQueryError
-from match import IqdbMatcher
-from booru import BooruEnum, Danbooru, Gelbooru, Konachan, Sankaku, Yandere
+from match import MatchCache, MatchClusters
+from match.Matcher import Matcher
+from metrics import METRICS, TRACER, MetricsServer, Profiler
+from net import HookServer, HttpClients, RateLimits
+from match.PerceptualHash import perceptual_hash, stash_perceptual_hash
+from match.Thumbnail import make_thumbnail
+from match.MatchResults import MatchResult
+from booru import BooruEnum, TagCache, TagTypes
+from booru.Booru import Booru
+from pipeline import Pipeline, Stage, ImageJob
+from state import RunState, Watermark, WorkBatch, WorkStore
 from urllib.parse import urlparse
-from utils import format_tag, ProgressCounter
-import sqlite3
-from sqlite3 import IntegrityError
+from utils import ProgressCounter
 import asyncio
 import coloredlogs
+import importlib
+import os
+import signal
+import socket
+import time
+from functools import cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
 
-async def main(stash_api: StashAPI, args):
+MATCHERS = ('iqdb', 'saucenao')
+
+# stages in pipeline order whose results are journaled, so an interrupted run can resume after them
+RESUMABLE_STAGES = ['download', 'match', 'tags', 'resolve']
+
+async def main(stash_api: StashAPI, run_state: RunState, rate_limits: RateLimits, args):
+    counter = ProgressCounter(0)
+    METRICS.track_progress(counter)
+
+    # stash requests are sent from worker threads and wait on the limiters through the event loop
+    rate_limits.start()
+
+    # the index loads while the first images are downloaded and matched. A single image looks its
+    # entities up by name instead, loading the whole index would take longer than its run.
+    resolver = EntityResolver(stash_api)
+    if not args.skip_entity_preload and not args.stash_image_id:
+        resolver.start_loading()
+
+    # one pooled, rate limited client per host for iqdb and the boorus, kept alive for the whole run
+    http_clients = HttpClients(timeout=args.http_timeout, connect_timeout=args.http_connect_timeout, max_connections=args.http_max_connections, http2=args.http2, rate_limits=rate_limits, host_overrides=dict(args.host_override or []))
+    matcher = build_matcher(http_clients, args)
+
+    # iqdb results are kept per image content, so re-runs rank them again instead of searching again
+    match_cache = None
+    if not args.no_match_cache:
+        match_cache = MatchCache(args.cache_path, ttl=args.match_cache_ttl * 86400, negative_ttl=args.match_cache_negative_ttl * 86400)
+
+    clusters = MatchClusters(args.phash_distance, args.phash_max_clusters) if args.phash_cluster else None
+
+    # decoding and resizing is cpu bound, so it runs in separate processes
+    resize_pool = ProcessPoolExecutor(max_workers=args.resize_processes) if args.match_source == 'resize' else None
+
+    # posts matched by several images are fetched once, and not at all if a previous run fetched them
+    tag_cache = TagCache(None if args.no_tag_cache else args.cache_path, ttl=args.tag_cache_ttl * 86400)
+
+    # the booru apis only list tag names, the local dictionary sorts them by type
+    tag_types = TagTypes(args.cache_path, ttl=args.tag_type_ttl * 86400)
+    boorus = build_boorus(http_clients, tag_types, args)
+
+    # images only count as processed once their update has been written by the buffer
+    update_buffer = ImageUpdateBuffer(
+        stash_api,
+        on_flushed=partial(on_images_written, run_state, counter),
+        on_failed=partial(on_images_not_written, run_state, counter),
+        max_size=args.update_batch_size,
+        max_delay=args.update_batch_delay
+    )
+
+    pipeline = Pipeline(
+        stages=build_stages(stash_api, resolver, boorus, matcher, match_cache, clusters, resize_pool, tag_cache, update_buffer, args, counter),
+        on_error=partial(on_image_failed, run_state, counter),
+        on_stage_complete=partial(journal_image_stage, run_state),
+        skip=stage_is_completed
+    )
+
+    # batches of images are claimed from the store shared with the other workers
+    work_store = None
+    if args.work_store:
+        work_store = WorkStore(args.work_store, args.worker_id or f"{socket.gethostname()}-{os.getpid()}", batch_size=args.work_batch_size, lease_seconds=args.lease_seconds, shard=args.shard)
+        work_store.start()
+
+    # watch mode polls stash for new images until it is stopped, a hook can wake it up early
+    hook_server = None
+    if args.watch:
+        watermark = Watermark(run_state.get_watermark('created_at') or args.created_after, on_advance=partial(run_state.set_watermark, 'created_at'))
+        wake = asyncio.Event()
+        jobs = watch_images(stash_api, run_state, args, counter, watermark, wake)
+
+        # a service manager stops the daemon with SIGTERM, it shuts down like on Ctrl+C
+        main_task = asyncio.current_task()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+        except NotImplementedError:
+            pass
+
+        if args.hook_port:
+            hook_server = HookServer(args.hook_host, args.hook_port, on_hook=wake.set)
+            await hook_server.start()
+    else:
+        jobs = queue_images(stash_api, run_state, args, counter, work_store)
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(args.metrics_host, args.metrics_port, METRICS)
+        await metrics_server.start()
+
+    update_buffer.start()
     try:
-        images = get_images_from_stash(stash_api, args)
-        total_images = len(images)
-        logger.info(f"Will now process {total_images} images.")
+        await pipeline.run(jobs)
     except TransportQueryError as e:
         logger.error(f"Failed to query stash: {str(e)}")
+    except Exception as e:
+        logger.error(f"Failed to process images: {str(e)}")
+    except asyncio.CancelledError:
+        logger.info(f"Stopping, writing the images that are done...")
+    finally:
+        if hook_server is not None:
+            await hook_server.close()
+
+        if metrics_server is not None:
+            await metrics_server.close()
+
+        await update_buffer.close()
+
+        if work_store is not None:
+            await work_store.close()
+
+        if match_cache is not None:
+            match_cache.close()
+
+        tag_cache.close()
+        tag_types.close()
+
+        if resize_pool is not None:
+            resize_pool.shutdown()
+
+        await http_clients.close()
+
+        for host, limiter in rate_limits.limiters.items():
+            logger.info(f"Finished {host} at {limiter.rate:.2f} requests/s with {int(limiter.concurrency)} in flight.")
+
+        for line in METRICS.summary():
+            logger.info(line)
+
+    logger.info(f"Finished processing images.")
+
+async def queue_images(stash_api: StashAPI, run_state: RunState, args, counter: ProgressCounter, work_store: Optional[WorkStore] = None):
+    """
+    Yield a job for every image in stash that needs processing, as pages of images arrive.
+    """
+    async for batch in get_work_batches(stash_api, args, work_store):
+        try:
+            async for job in queue_batch_images(stash_api, run_state, args, counter, batch):
+                yield job
+        except Exception as e:
+            if work_store is None:
+                raise
+
+            # the images queued so far are still worked on, the batch is handed back once they are done
+            logger.error(f"Failed to queue {batch}, handing it back to the other workers: {str(e)}")
+            batch.on_done = lambda batch: work_store.release(batch.id_range[0])
+            batch.finish_queueing()
+
+async def get_work_batches(stash_api: StashAPI, args, work_store: Optional[WorkStore]):
+    """
+    Yield the batches of images this worker should tag: every image, the batches of its shard, or
+    the batches it claims from the shared work store.
+    """
+    if args.stash_image_id or (args.shard is None and work_store is None):
+        yield WorkBatch()
         return
 
-    logger.info(f"Queuing {total_images} images for processing...")
+    max_id = await asyncio.to_thread(stash_api.get_max_image_id)
 
-    task_queue = []
-    semaphore = asyncio.Semaphore(args.max_threads)
-    counter = ProgressCounter(0)
+    if work_store is None:
+        index, count = args.shard
+        for start in range(index * args.work_batch_size, max_id + 1, count * args.work_batch_size):
+            yield WorkBatch((start, start + args.work_batch_size))
+        return
 
-    for image in images:
+    await work_store.add_batches(max_id)
 
-        # If the image has been processed and we're not forcing re-tagging, skip it.
-        if image_is_processed(image['id']) and not args.force_tag_all:
-            logger.info(f"Image {image['id']} has already been processed.")
-            # delete from failed images if it exists
-            if image_is_failed(image['id']):
-                delete_failed_image(image['id'])
-            continue
+    while True:
+        id_range = await work_store.claim()
+
+        if id_range is not None:
+            yield WorkBatch(id_range, on_done=lambda batch: work_store.complete(batch.id_range[0]))
+        elif await work_store.is_finished():
+            return
+        else:
+            # the other workers hold the rest, wait in case one of them stops and its leases run out
+            await asyncio.sleep(min(30, args.lease_seconds / 4))
+
+async def queue_batch_images(stash_api: StashAPI, run_state: RunState, args, counter: ProgressCounter, batch: WorkBatch):
+    logger.info(f"Queuing {batch}...")
 
-        # If the image has previously failed to process and we're skipping failed images, skip it unless we're forcing re-tagging.
-        if (image_is_failed(image['id']) and args.skip_failed_images) or not args.force_tag_all:
-            logger.info(f"Image {image['id']} has previously failed to process.")
+    async for image in get_images_from_stash(stash_api, args, counter, batch.id_range):
+        job = await make_job(run_state, args, counter, image)
+        if job is None:
             continue
 
-        # Queue the image for processing
-        task_queue.append(process_image_wrapper(
-            semaphore=semaphore,
-            image=image,
-            counter=counter,
-            stash_api=stash_api,
-            image_similarity=args.image_similarity,
-            preferred_booru=args.preferred_booru
-        ))
+        job.work_batch = batch
+        batch.start_image()
+        yield job
 
-    total_queue_count = len(task_queue)
-    counter.set_total(total_queue_count)
+    batch.finish_queueing()
 
-    logger.info(f"Queued {total_queue_count} images for processing.")
+async def watch_images(stash_api: StashAPI, run_state: RunState, args, counter: ProgressCounter, watermark: Watermark, wake: asyncio.Event):
+    """
+    Yield a job for every image created in stash after the watermark, polling stash for new images
+    every poll interval or when woken up, until the run is stopped.
+    """
+    while True:
+        logger.debug(f"Polling stash for images created after {watermark.value or 'the first image'}...")
+        watermark.start_polling()
 
-    try:
-        await asyncio.gather(*task_queue)
-    except Exception as e:
-        logger.error(f"Failed to process images: {str(e)}")
+        try:
+            async for image in get_images_from_stash(stash_api, args, counter, created_after=watermark.value):
+                # images still in progress are behind the watermark, so later polls see them again
+                if watermark.is_tracked(image['id']):
+                    continue
 
-    logger.info(f"Finished processing images.")
+                job = await make_job(run_state, args, counter, image)
+                watermark.add_image(image['id'], image['created_at'], done=job is None)
+                if job is None:
+                    continue
+
+                job.watermark = watermark
+                yield job
+
+            watermark.finish_polling()
+        except Exception as e:
+            # stash being away for a while must not stop the daemon, the next poll tries again. The
+            # watermark stays put until then, the pages that failed may hold older images.
+            logger.error(f"Failed to poll stash for new images: {str(e)}")
+
+        try:
+            await asyncio.wait_for(wake.wait(), args.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+async def make_job(run_state: RunState, args, counter: ProgressCounter, image: dict) -> Optional[ImageJob]:
+    """
+    Make the job of an image, or return None if the image should be skipped.
+    """
+    # If the image has been processed and we're not forcing re-tagging, skip it.
+    if run_state.image_is_processed(image['id']) and not args.force_tag_all:
+        logger.info(f"Image {image['id']} has already been processed.")
+        # delete from failed images if it exists
+        if run_state.image_is_failed(image['id']):
+            run_state.delete_failed_image(image['id'])
+        METRICS.finish_image('skipped')
+        await counter.increment()
+        return None
+
+    # If the image has previously failed to process and we're skipping failed images, skip it unless we're forcing re-tagging.
+    if run_state.image_is_failed(image['id']) and args.skip_failed_images and not args.force_tag_all:
+        logger.info(f"Image {image['id']} has previously failed to process.")
+        METRICS.finish_image('skipped')
+        await counter.increment()
+        return None
+
+    # Queue the image for processing, skipping the stages an interrupted run already finished
+    job = ImageJob(image=image)
+    journal = run_state.get_journal(image['id'])
+
+    if journal is not None and args.no_resume:
+        run_state.delete_journal(image['id'])
+    elif journal is not None:
+        stage, checkpoint = journal
+        job.restore(checkpoint, set(RESUMABLE_STAGES[:RESUMABLE_STAGES.index(stage) + 1]))
+        logger.info(f"Resuming image {image['id']} after the {stage} stage.")
+
+    return job
+
+def get_images_from_stash(stash_api: StashAPI, args, counter: ProgressCounter, id_range: Optional[tuple[int, int]] = None, created_after: Optional[str] = None):
+    def on_count(total_images: int):
+        counter.add_total(total_images)
+
+        # watch mode polls all the time, most polls find nothing
+        if total_images > 0 or not args.watch:
+            logger.info(f"Will now process {total_images} images.")
+
+    # images that were tagged before carry the stash-booru-tagger tag, so stash can leave them out
+    filters = {
+        'page_size': args.page_size,
+        'on_count': on_count,
+        'exclude_tagged': not args.force_tag_all,
+        'created_after': created_after or args.created_after,
+        'updated_after': args.updated_after,
+        'image_filter': args.image_filter,
+        'include_fingerprints': args.phash_cluster and args.use_stash_phash,
+        'id_range': id_range,
+    }
 
-def get_images_from_stash(stash_api: StashAPI, args):
     if args.stash_all_images:
-        images = stash_api.get_images(ImageFetchType.ALL_IMAGES)
+        images = stash_api.get_images(ImageFetchType.ALL_IMAGES, **filters)
     elif args.stash_image_id:
-        images = stash_api.get_images(ImageFetchType.SINGLE_IMAGE,args.stash_image_id)
+        images = stash_api.get_images(ImageFetchType.SINGLE_IMAGE, args.stash_image_id, **filters)
     elif args.stash_image_gallery_id:
-        images = stash_api.get_images(ImageFetchType.IMAGE_GALLERY,args.stash_image_gallery_id)
+        images = stash_api.get_images(ImageFetchType.IMAGE_GALLERY, args.stash_image_gallery_id, **filters)
 
     return images
 
-async def process_image_wrapper(semaphore, image, counter, stash_api: StashAPI, image_similarity: float, preferred_booru: BooruEnum):
-    async with semaphore:
-        logger.info(f"Processing image {image['id']}... [{counter}]")
-        try:
-            await process_image(stash_api, image, image_similarity, preferred_booru)
-            add_processed_image(image['id'])
-
-            # delete from failed images if it exists
-            if image_is_failed(image['id']):
-                delete_failed_image(image['id'])
-        except IntegrityError as e:
-            if "UNIQUE constraint failed" in str(e):
-                logger.warning(f"Image {image['id']} has already been processed previously.")
-            else:
-                logger.warning(f"Unable to keep track of processed image: {str(e)}")
-        except Exception as e:
-            logger.error(f"Failed to process image: {str(e)}")
-            try:
-                add_processed_image(image['id'], failed=True, reason=str(e))
-            except Exception as e:
-                logger.warn(f"Unable to keep track of failed image: {str(e)}")
-        finally:
-            await counter.increment()
-
-
-async def process_image(stash_api: StashAPI, image, image_similarity: float, preferred_booru: BooruEnum):
-    logger.debug(f"Downloading image {image['paths']['image']}...")
-    image_bytes = stash_api.load_image(image['paths']['image'])
-
-    logger.info(f"Matching image {image['id']}...")
-    matched_image = await match_image(image_bytes, image_similarity, preferred_booru)
-    if matched_image is None:
-        raise Exception(f"No matches found for image {image.id}.")
-    logger.info(f"Matched image {image['id']} with {matched_image.source_url}.")
-    
-    logger.info(f"Fetching tags for image {image['id']}...")
-    tags = get_matched_image_tags(matched_image.source_url)
-        
-    copyright_tags_to_assign = []
-    character_tags_to_assign = []
-    artist_tags_to_assign = []
-    
-    logger.info(f"Tags found: {tags}")
-    logger.info(f"Creating tags on stash...")
-    # create the copyright tags as normal tags
+def build_stages(stash_api: StashAPI, resolver: EntityResolver, boorus: dict[str, Callable[[], Booru]], matcher: Matcher, match_cache: Optional[MatchCache], clusters: Optional[MatchClusters], resize_pool: Optional[ProcessPoolExecutor], tag_cache: TagCache, update_buffer: ImageUpdateBuffer, args, counter: ProgressCounter):
+    """
+    Build the processing stages for an image.
+
+    Stash calls (gql over requests) block and are run in a worker thread, while IQDB and
+    the boorus go through the shared async http clients so the event loop is free to
+    drive the other stages in the meantime.
+    """
+    return [
+        Stage('download', partial(download_image, stash_api, counter, args.match_source, resize_pool, args.resize_max_size), workers=args.download_workers or args.max_threads),
+        Stage('match', partial(match_job_image, stash_api, matcher, args.image_similarity, args.preferred_booru, match_cache, clusters), workers=args.match_workers or args.max_threads),
+        # enough tag workers to fill a danbooru batch, the rate limits keep the other boorus in check
+        Stage('tags', partial(fetch_job_tags, boorus, tag_cache), workers=args.tag_workers or max(args.max_threads, args.danbooru_batch_size)),
+        Stage('resolve', partial(resolve_job_entities, resolver), workers=args.resolve_workers or args.max_threads),
+        Stage('update', partial(update_job_image, update_buffer)),
+    ]
+
+async def journal_image_stage(run_state: RunState, job: ImageJob, stage: Stage):
+    # downloads are not journaled, the image bytes are too big and only needed for the match
+    if stage.name in RESUMABLE_STAGES[1:]:
+        run_state.add_journal(job.id, stage.name, job.checkpoint())
+
+def stage_is_completed(job: ImageJob, stage: Stage):
+    return stage.name in job.completed_stages
+
+async def on_images_written(run_state: RunState, counter: ProgressCounter, jobs: list[ImageJob]):
+    for job in jobs:
+        logger.info(f"Image {job.id} processed successfully.")
+        run_state.add_processed_image(job.id)
+
+        # delete from failed images if it exists
+        if run_state.image_is_failed(job.id):
+            run_state.delete_failed_image(job.id)
+
+        await finish_image(counter, job, 'processed')
+
+async def on_images_not_written(run_state: RunState, counter: ProgressCounter, jobs: list[ImageJob], error: Exception):
+    for job in jobs:
+        await record_failed_image(run_state, counter, job, 'update', error)
+
+async def on_image_failed(run_state: RunState, counter: ProgressCounter, job: ImageJob, stage: Stage, error: Exception):
+    await record_failed_image(run_state, counter, job, stage.name, error)
+
+async def record_failed_image(run_state: RunState, counter: ProgressCounter, job: ImageJob, stage_name: str, error: Exception):
+    logger.error(f"Failed to process image {job.id} during {stage_name}: {str(error)}")
+    run_state.add_failed_image(job.id, reason=str(error))
+    METRICS.stage_errors.inc(stage_name)
+    await finish_image(counter, job, 'failed', failed_stage=stage_name)
+
+async def finish_image(counter: ProgressCounter, job: ImageJob, outcome: str, **trace_args):
+    METRICS.finish_image(outcome)
+    TRACER.add_span('image', 'image', job.queued_at, time.perf_counter() - job.queued_at, image=job.id, outcome=outcome, **trace_args)
+    await counter.increment()
+
+    if job.work_batch is not None:
+        job.work_batch.finish_image()
+
+    if job.watermark is not None:
+        job.watermark.finish_image(job.id)
+
+async def download_image(stash_api: StashAPI, counter: ProgressCounter, match_source: str, resize_pool: Optional[ProcessPoolExecutor], resize_max_size: int, job: ImageJob):
+    logger.info(f"Processing image {job.id}... [{counter}]")
+
+    # iqdb only compares small thumbnails, so there is no need to send it the original
+    if match_source == 'thumbnail' and job.image['paths'].get('thumbnail'):
+        logger.debug(f"Downloading thumbnail {job.image['paths']['thumbnail']}...")
+        job.image_bytes = await asyncio.to_thread(stash_api.load_image, job.image['paths']['thumbnail'])
+        job.reduced_image = True
+        return
 
-    logger.info("Creating copyright/series tags on stash...")
-    for copyright_tag in tags.copyright:
-        if not copyright_tag:
-            continue
-        
-        logger.debug(f"Creating tag for {copyright_tag}...")
-
-        formatted_tag = format_tag(copyright_tag)
-        existing_tag = stash_api.get_tag_by_name(formatted_tag)
-
-        if existing_tag['findTags']['count'] == 0:
-            logger.debug(f"Tag {formatted_tag} not found, creating...")
-            add_tag = stash_api.add_tag(formatted_tag, [copyright_tag])
-            copyright_tags_to_assign.append((add_tag['tagCreate']['id'], add_tag['tagCreate']['name']))
-        elif existing_tag['findTags']['count'] > 1:
-            raise Exception(f"Multiple tags found for {formatted_tag}.")
-        else:
-            logger.debug(f"Tag {formatted_tag} exists already. Using existing tag.")
-            copyright_tags_to_assign.append((existing_tag['findTags']['tags'][0]['id'], existing_tag['findTags']['tags'][0]['name']))
+    logger.debug(f"Downloading image {job.image['paths']['image']}...")
+    job.image_bytes = await asyncio.to_thread(stash_api.load_image, job.image['paths']['image'])
 
-    # create the character tags as performers
-    logger.info("Creating character tags on stash...")
-    for character_tag in tags.character:
-        if not character_tag:
-            continue
-        logger.debug(f"Creating performer for {character_tag}...")
-
-        formatted_tag = format_tag(character_tag)
-        existing_performer = stash_api.get_performer_by_name(formatted_tag)
-
-        if existing_performer['findPerformers']['count'] == 0:
-            logger.debug(f"Performer {formatted_tag} not found, creating...")
-            character_tags_to_assign.append(stash_api.add_performer(
-                name=formatted_tag,
-                disambiguation=copyright_tags_to_assign[0][1] if len(copyright_tags_to_assign) > 0 else "",
-                tag_ids=[ids[0] for ids in copyright_tags_to_assign],
-                alias_list=[character_tag] if character_tag.lower() != formatted_tag.lower() else []
-            )['performerCreate']['id'])
-        elif existing_performer['findPerformers']['count'] > 1:
-            raise Exception(f"Multiple performers found for {formatted_tag}.")
-        else:
-            logger.debug(f"Performer {formatted_tag} exists already. Using existing performer.")
-            character_tags_to_assign.append(existing_performer['findPerformers']['performers'][0]['id'])
+    if match_source == 'resize':
+        job.image_bytes = await asyncio.get_running_loop().run_in_executor(resize_pool, make_thumbnail, job.image_bytes, resize_max_size)
+        job.reduced_image = True
 
-    # create artist tags as studios
-    logger.info("Creating artist tags on stash...")
-    for artist_tag in tags.artist:
-        if artist_tag in ['banned_artist']:
-            continue
+async def match_job_image(stash_api: StashAPI, matcher: Matcher, image_similarity: float, preferred_booru: BooruEnum, match_cache: Optional[MatchCache], clusters: Optional[MatchClusters], job: ImageJob):
+    logger.info(f"Matching image {job.id}...")
+    if clusters is not None:
+        # near-duplicates share the search of the first image of their cluster
+        image_hash = stash_perceptual_hash(job.image)
+        if image_hash is None:
+            image_hash = await asyncio.to_thread(perceptual_hash, job.image_bytes)
 
-        logger.debug(f"Creating studio for {artist_tag}...")
-        formatted_tag = format_tag(artist_tag)
-        existing_studio = stash_api.get_studio_by_name(formatted_tag)
+        matches = await clusters.find_matches(image_hash, partial(find_matches, matcher, job.image_bytes, match_cache))
+    else:
+        matches = await find_matches(matcher, job.image_bytes, match_cache)
 
-        if existing_studio['findStudios']['count'] == 0:
-            logger.debug(f"Studio {formatted_tag} not found, creating...")
-            artist_tags_to_assign.append(stash_api.add_studio(formatted_tag)['studioCreate']['id'])
-        elif existing_studio['findStudios']['count'] > 1:
-            raise Exception(f"Multiple studios found for {formatted_tag}.")
-        else:
-            logger.debug(f"Studio {formatted_tag} exists already. Using existing studio.")
-            artist_tags_to_assign.append(existing_studio['findStudios']['studios'][0]['id'])
+    matched_image = select_best_match(matches, image_similarity, preferred_booru)
+    # the image bytes are not needed past this point, free them up while the job waits in the queues
+    job.image_bytes = None
+
+    if not matched_image and job.reduced_image:
+        logger.info(f"No matches found for the thumbnail of image {job.id}, trying the original image...")
+        image_bytes = await asyncio.to_thread(stash_api.load_image, job.image['paths']['image'])
+        matched_image = select_best_match(await find_matches(matcher, image_bytes, match_cache), image_similarity, preferred_booru)
+
+    METRICS.matches.inc('matched' if matched_image else 'none')
+    if not matched_image:
+        raise Exception(f"No matches found for image {job.id}.")
+
+    job.matched_image = matched_image
+    logger.info(f"Matched image {job.id} with {matched_image.source_url}.")
+
+async def fetch_job_tags(boorus: dict[str, Callable[[], Booru]], tag_cache: TagCache, job: ImageJob):
+    logger.info(f"Fetching tags for image {job.id}...")
+    job.tags = await tag_cache.get_tags(job.matched_image.source_url, partial(get_matched_image_tags, boorus))
+    logger.info(f"Tags found: {job.tags}")
+
+async def resolve_job_entities(resolver: EntityResolver, job: ImageJob):
+    logger.info(f"Creating tags on stash for image {job.id}...")
+    job.tag_ids, job.performer_ids, job.studio_id = await resolver.resolve(job.tags)
+
+async def update_job_image(update_buffer: ImageUpdateBuffer, job: ImageJob):
+    logger.info(f"Queuing tag assignment for image {job.id}...")
+    await update_buffer.add(job.id, job.tag_ids, job.performer_ids, job.studio_id, [job.matched_image.source_url], context=job)
+
+async def find_matches(matcher: Matcher, image_bytes, match_cache: Optional[MatchCache] = None):
+    matches = None
 
-    logger.info(f"Assigning tags to image...")
-    # now we can assign the tags to the image
-    stash_api.update_image(image['id'], [ids[0] for ids in copyright_tags_to_assign], character_tags_to_assign, artist_tags_to_assign[0] if len(artist_tags_to_assign) > 0 else None, [matched_image.source_url])
+    if match_cache is not None:
+        image_hash = await asyncio.to_thread(MatchCache.hash_image, image_bytes)
+        matches = await asyncio.to_thread(match_cache.get_matches, image_hash)
+        METRICS.cache.inc('match', 'miss' if matches is None else 'hit')
 
-    logger.info(f"Image {image['id']} processed successfully.")
-        
-async def match_image(image_bytes, image_similarity: float, preferred_booru: BooruEnum):
-    matches = await IqdbMatcher().match_image(image_bytes, image_similarity)
+    if matches is None:
+        # every candidate is kept, they are ranked against the current options afterwards
+        matches = await matcher.match_image(image_bytes, 0)
 
+        if match_cache is not None:
+            await asyncio.to_thread(match_cache.put_matches, image_hash, matches)
+    else:
+        logger.debug(f"Using {len(matches)} cached matches.")
+
+    return matches
+
+def select_best_match(matches: list[MatchResult], image_similarity: float, preferred_booru: BooruEnum):
     if len(matches) == 0:
-        return matches
+        return None
     
     best_match = None
 
@@ -211,21 +470,87 @@ async def match_image(image_bytes, image_similarity: float, preferred_booru: Boo
     # Return the best match found (which may be None if no matches found)
     return best_match
 
-def get_matched_image_tags(url):
-    matched_image_host = urlparse(url).netloc
-    booru_classes = {
-        BooruEnum.DANBOORU.value: Danbooru,
-        BooruEnum.GELBOORU.value: Gelbooru,
-        BooruEnum.KONACHAN.value: Konachan,
-        BooruEnum.YANDERE.value: Yandere,
-        BooruEnum.SANKAKU.value: Sankaku
+def build_matcher(http_clients: HttpClients, args) -> Matcher:
+    # only the backends that are used get imported. From their submodules, the package attribute of
+    # the same name is the submodule once anything imported it directly.
+    from match.CompositeMatcher import CompositeMatcher
+    from match.IqdbMatcher import IqdbMatcher
+    from match.SauceNaoMatcher import SauceNaoMatcher
+
+    backends = {
+        'iqdb': lambda: IqdbMatcher(http_clients, base_url=args.iqdb_url),
+        'saucenao': lambda: SauceNaoMatcher(http_clients, api_key=args.saucenao_api_key, base_url=args.saucenao_url),
     }
 
-    if matched_image_host not in booru_classes:
+    matchers = [backends[name]() for name in args.matchers]
+    if len(matchers) == 1:
+        return matchers[0]
+
+    return CompositeMatcher(matchers, args.image_similarity, args.preferred_booru, hedge_delay=args.hedge_delay or None)
+
+def matcher_names(value: str) -> list[str]:
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in MATCHERS]
+
+    if len(names) == 0 or len(unknown) > 0:
+        raise argparse.ArgumentTypeError(f"unsupported matchers: {', '.join(unknown) or value}, choose from {', '.join(MATCHERS)}")
+
+    return names
+
+def host_override(value: str) -> tuple[str, str]:
+    host, _, url = value.partition('=')
+
+    if not host or not url.startswith(('http://', 'https://')):
+        raise argparse.ArgumentTypeError(f"invalid host override {value}, expected HOST=URL, e.g. danbooru.donmai.us=http://127.0.0.1:8001")
+
+    return host, url
+
+def shard_spec(value: str) -> tuple[int, int]:
+    index, _, count = value.partition('/')
+
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}, expected INDEX/COUNT, e.g. 0/2")
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}, the index has to be between 0 and COUNT - 1")
+
+    return index, count
+
+def build_boorus(http_clients: HttpClients, tag_types: TagTypes, args) -> dict[str, Callable[[], Booru]]:
+    # the adapters are shared by all images, so lookups of tag types can be shared as well. Each one
+    # is imported and created when it is first needed, a run over a few images only needs some.
+    def create(module: str, *args, **kwargs) -> Booru:
+        # from the submodule, the package attribute of the same name is the submodule once anything imported it directly
+        return getattr(importlib.import_module(f"booru.{module}"), module)(*args, **kwargs)
+
+    adapters = {
+        BooruEnum.DANBOORU.value: partial(create, 'Danbooru', http_clients, batch_size=args.danbooru_batch_size, batch_delay=args.danbooru_batch_delay),
+        BooruEnum.GELBOORU.value: partial(create, 'Gelbooru', http_clients, tag_types, api_key=args.gelbooru_api_key, user_id=args.gelbooru_user_id),
+        BooruEnum.KONACHAN.value: partial(create, 'Konachan', http_clients, tag_types),
+        BooruEnum.YANDERE.value: partial(create, 'Yandere', http_clients, tag_types),
+        BooruEnum.SANKAKU.value: partial(create, 'Sankaku', http_clients)
+    }
+    return {host: cache(create) for host, create in adapters.items()}
+
+async def get_matched_image_tags(boorus: dict[str, Callable[[], Booru]], url):
+    matched_image_host = urlparse(url).netloc
+
+    if matched_image_host not in boorus:
         raise Exception(f"Unsupported booru site: {matched_image_host}")
     
-    booru = booru_classes[matched_image_host]()
-    return booru.get_tags(url)
+    return await boorus[matched_image_host]().get_tags(url)
+
+def load_rate_limits(args):
+    limits = RateLimits.load_config(args.rate_limit_config) if args.rate_limit_config else {}
+
+    # limits given on the command line win over the config file
+    for value in args.rate_limit or []:
+        host, options = RateLimits.parse_limit(value)
+        limits.setdefault(host, {}).update(options)
+
+    return RateLimits(limits, adaptive=not args.fixed_rate_limits)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Tags images in stash from booru site tags.')
@@ -237,14 +562,82 @@ def parse_args():
     parser.add_argument('-b', '--preferred-booru', type=BooruEnum, help='Preferred booru site to source tags from.', choices=list(BooruEnum), default=BooruEnum.DANBOORU)
     parser.add_argument('-f', '--force-tag-all', action='store_true', help='Force re-tagging of all images.', default=False)
     parser.add_argument('-sf', '--skip-failed-images', action='store_true', help='Skip images that have failed to process.')
-    parser.add_argument('-t', '--max-threads', type=int, help='Maximum number of threads to use.', default=4)
+    parser.add_argument('-t', '--max-threads', type=int, help='Default number of workers for each processing stage.', default=4)
+    parser.add_argument('--download-workers', type=int, help='Number of images to download from stash at the same time. (Default --max-threads)')
+    parser.add_argument('--match-workers', type=int, help='Number of images to match on IQDB at the same time. (Default --max-threads)')
+    parser.add_argument('--tag-workers', type=int, help='Number of booru tag fetches to run at the same time. (Default --danbooru-batch-size or --max-threads, whichever is larger)')
+    parser.add_argument('--resolve-workers', type=int, help='Number of images to create stash tags, performers and studios for at the same time. (Default --max-threads)')
+    parser.add_argument('--update-batch-size', type=int, help='Number of images with the same tags, performers and studio to write to stash in one update. (Default 50)', default=50)
+    parser.add_argument('--update-batch-delay', type=float, help='Seconds to wait for more images with the same tags before writing an update to stash. (Default 5)', default=5.0)
+    parser.add_argument('--page-size', type=int, help='Number of images to fetch from stash per request. (Default 100)', default=100)
+    parser.add_argument('--created-after', type=str, help='Only tag images created in stash after this timestamp, e.g. 2024-01-31 or 2024-01-31T12:00:00Z.')
+    parser.add_argument('--updated-after', type=str, help='Only tag images updated in stash after this timestamp, e.g. 2024-01-31 or 2024-01-31T12:00:00Z.')
+    parser.add_argument('--image-filter', type=json.loads, help='Extra stash ImageFilterType criteria as JSON, e.g. \'{"organized": false}\'.')
+    parser.add_argument('--matchers', type=matcher_names, help='Comma separated reverse image search backends, in the order they are tried: iqdb, saucenao. (Default iqdb)', default='iqdb')
+    parser.add_argument('--hedge-delay', type=float, help='Seconds to wait for a good match from one backend before also searching the next one, 0 searches all of them at once. (Default 10)', default=10)
+    parser.add_argument('--saucenao-api-key', type=str, help='SauceNAO API key. (optional, anonymous searches are limited to a few a day)')
+    parser.add_argument('--iqdb-url', type=str, help='URL of the IQDB instance to search. (Default https://iqdb.org/)')
+    parser.add_argument('--saucenao-url', type=str, help='URL of the SauceNAO search endpoint. (Default https://saucenao.com/search.php)')
+    parser.add_argument('--host-override', type=host_override, action='append', metavar='HOST=URL', help='Send the requests for a booru host to another server instead, e.g. a local stand-in for testing. Can be given multiple times.')
+    parser.add_argument('--http-timeout', type=float, help='Seconds to wait for a response from IQDB or a booru. (Default 60)', default=60)
+    parser.add_argument('--http-connect-timeout', type=float, help='Seconds to wait for a connection to IQDB or a booru. (Default 10)', default=10)
+    parser.add_argument('--http-max-connections', type=int, help='Maximum number of open connections per host. (Default 10)', default=10)
+    parser.add_argument('--http2', action='store_true', help='Use HTTP/2 where IQDB or the booru supports it. (requires httpx[http2])')
+    parser.add_argument('--rate-limit', type=str, action='append', metavar='HOST=RATE[:CONCURRENCY]', help='Initial requests per second and requests in flight for a host, e.g. iqdb.org=0.5:1. Use "stash" for the stash instance and "*" for any other host. Can be given multiple times.')
+    parser.add_argument('--rate-limit-config', type=str, help='JSON file with rate limits by host, e.g. \'{"iqdb.org": {"rate": 0.5, "concurrency": 1, "max_rate": 1}}\'.')
+    parser.add_argument('--fixed-rate-limits', action='store_true', help='Keep the rate limits at their initial values instead of adjusting them to how each host responds.')
+    parser.add_argument('--cache-path', type=str, help='Path of the local cache database. (Default cache.db)', default='cache.db')
+    parser.add_argument('--no-match-cache', action='store_true', help='Always search IQDB instead of reusing cached results for the same image.')
+    parser.add_argument('--match-cache-ttl', type=float, help='Days to keep cached IQDB results. (Default 90)', default=90)
+    parser.add_argument('--match-cache-negative-ttl', type=float, help='Days to keep cached searches that found nothing, or that ended before every backend of --matchers answered. (Default 1)', default=1)
+    parser.add_argument('--no-tag-cache', action='store_true', help='Always fetch tags from the booru instead of reusing tags cached by previous runs.')
+    parser.add_argument('--tag-cache-ttl', type=float, help='Days to keep cached booru tags. (Default 30)', default=30)
+    parser.add_argument('--tag-type-ttl', type=float, help='Days to keep the types of booru tags before looking them up again. (Default 30)', default=30)
+    parser.add_argument('--danbooru-batch-size', type=int, help='Number of Danbooru posts to fetch with one request. (Default 100)', default=100)
+    parser.add_argument('--danbooru-batch-delay', type=float, help='Seconds to wait for more matched Danbooru posts before fetching a batch. (Default 0.1)', default=0.1)
+    parser.add_argument('--gelbooru-api-key', type=str, help='Gelbooru API key, used together with --gelbooru-user-id. (optional)')
+    parser.add_argument('--gelbooru-user-id', type=str, help='Gelbooru user id the API key belongs to. (optional)')
+    parser.add_argument('--match-source', type=str, help='Image sent to IQDB: the original, the thumbnail stash generated, or the original resized locally. Reduced images fall back to the original when they do not match. (Default original)', choices=['original', 'thumbnail', 'resize'], default='original')
+    parser.add_argument('--resize-max-size', type=int, help='Maximum width and height of locally resized images. (Default 500)', default=500)
+    parser.add_argument('--resize-processes', type=int, help='Number of processes used to resize images. (Default number of CPUs)')
+    parser.add_argument('--phash-cluster', action='store_true', help='Search IQDB only once for near-duplicate images, found by perceptual hash. (requires Pillow)')
+    parser.add_argument('--phash-distance', type=int, help='Maximum Hamming distance between the perceptual hashes of near-duplicate images. (Default 4)', default=4)
+    parser.add_argument('--phash-max-clusters', type=int, help='Number of recent clusters of near-duplicates that are kept, older ones are searched again when another duplicate turns up. (Default 10000)', default=10000)
+    parser.add_argument('--use-stash-phash', action='store_true', help='Use the phash fingerprints stash generated for images when available instead of computing them.')
+    parser.add_argument('--shard', type=shard_spec, metavar='INDEX/COUNT', help='Only tag the images of one of COUNT shards, e.g. 0/2 and 1/2 for two workers. Images are split into batches of --work-batch-size ids, dealt out in turn.')
+    parser.add_argument('--work-store', type=str, help='Path of a SQLite database shared by several workers. Workers claim batches of images from it under a lease.')
+    parser.add_argument('--worker-id', type=str, help='Name of this worker in the work store, unique between the workers. (Default host name and process id)')
+    parser.add_argument('--work-batch-size', type=int, help='Number of image ids in a batch of the work store or a shard. (Default 1000)', default=1000)
+    parser.add_argument('--lease-seconds', type=float, help='Seconds a claimed batch stays with a worker that stopped renewing it. (Default 300)', default=300)
+    parser.add_argument('--watch', action='store_true', help='Keep running and tag new images as they are added to stash, polling stash for images created after the last ones tagged.')
+    parser.add_argument('--poll-interval', type=float, help='Seconds between two polls for new images in watch mode. (Default 60)', default=60)
+    parser.add_argument('--hook-port', type=int, help='Port of a local HTTP endpoint that makes watch mode poll right away when it gets a POST request, e.g. from a stash plugin. (optional)')
+    parser.add_argument('--hook-host', type=str, help='Address the hook endpoint listens on. (Default 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--metrics-port', type=int, help='Port of a local HTTP endpoint that serves the metrics of the run in the Prometheus text format. (optional)')
+    parser.add_argument('--metrics-host', type=str, help='Address the metrics endpoint listens on. (Default 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--profile', type=str, metavar='FILE', help='Profile the run with cProfile and save the stats to FILE, e.g. for snakeviz. The functions with the most cumulative time are logged at the end.')
+    parser.add_argument('--profile-memory', type=str, metavar='FILE', help='Trace memory allocations with tracemalloc and save a snapshot to FILE. The largest allocation sites are logged at the end. Slows the run down noticeably.')
+    parser.add_argument('--trace', type=str, metavar='FILE', help='Write a span for every stage, search, tag fetch, stash call and request of every image to FILE, one JSON object per line. bench/trace_to_chrome.py converts it for chrome://tracing, Perfetto or speedscope.')
+    parser.add_argument('--no-resume', action='store_true', help='Start every image from the beginning instead of resuming the stages an interrupted run already finished for it.')
+    parser.add_argument('--skip-entity-preload', action='store_true', help='Do not load all existing tags, performers and studios from stash at startup. Each one is looked up when it is first needed instead. Always the case with -i.')
     stash_image_group = parser.add_mutually_exclusive_group(required=True)
 
     stash_image_group.add_argument('-a', '--stash-all-images', action='store_true', help='Tag all images in stash.')
     stash_image_group.add_argument('-i', '--stash-image-id', type=int, help='Tag a specific image in stash by id.')
     stash_image_group.add_argument('-g', '--stash-image-gallery-id', type=int, help='Tag all images in a specific gallery in stash by id.')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.watch and (args.stash_image_id or args.shard is not None or args.work_store):
+        parser.error("--watch can not be combined with -i, --shard or --work-store")
+
+    if args.hook_port and not args.watch:
+        parser.error("--hook-port requires --watch")
+
+    if args.update_batch_delay <= 0:
+        parser.error("--update-batch-delay must be more than 0")
+
+    return args
 
 def setup_logging():
     logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] [%(levelname)s] %(message)s')
@@ -253,67 +646,36 @@ def setup_logging():
     requests_logger.setLevel(logging.WARNING)
     return logger
 
-def add_processed_image(image_id, failed=False, reason=None):
-    cursor = tagger_db.cursor()
-    if failed:
-        cursor.execute('INSERT INTO failed_images (id, reason) VALUES (?, ?)', (image_id, reason))
-    else:
-        cursor.execute('INSERT INTO processed_images (id) VALUES (?)', (image_id,))
-    tagger_db.commit()
-
-def image_is_processed(image_id) -> bool:
-    cursor = tagger_db.cursor()
-    cursor.execute('SELECT * FROM processed_images WHERE id = ?', (image_id,))
-    return cursor.fetchone() is not None
-
-def image_is_failed(image_id) -> bool:
-    cursor = tagger_db.cursor()
-    cursor.execute('SELECT * FROM failed_images WHERE id = ?', (image_id,))
-    return cursor.fetchone() is not None
-
-def delete_processed_image(image_id):
-    cursor = tagger_db.cursor()
-    cursor.execute('DELETE FROM processed_images WHERE id = ?', (image_id,))
-    tagger_db.commit()
-
-def delete_failed_image(image_id):
-    cursor = tagger_db.cursor()
-    cursor.execute('DELETE FROM failed_images WHERE id = ?', (image_id,))
-    tagger_db.commit()
-
-def setup_sqlite():
-    con = sqlite3.connect('tagger.db')
-
-    # create the tables if they don't exist
-    con.execute('''
-        CREATE TABLE IF NOT EXISTS processed_images (
-            id INTEGER PRIMARY KEY
-        );
-    ''')
-
-    con.execute('''
-        CREATE TABLE IF NOT EXISTS failed_images (
-            id INTEGER PRIMARY KEY,
-            reason TEXT
-        );
-    ''')
-
-    con.commit()
-
-    return con
-
 if __name__ == '__main__':
     args = parse_args()
     global logger
     logger = setup_logging()
-    global tagger_db
-    tagger_db = setup_sqlite()
-    
-    stash_api = StashAPI(args.stash_url, args.api_key, args.stash_username, args.stash_password)
+    run_state = RunState('tagger.db')
+
     try:
-        stash_api.check_api()
+        rate_limits = load_rate_limits(args)
     except Exception as e:
-        logging.critical(f"Failed to check API: {str(e)}")
+        logging.critical(f"Failed to load rate limits: {str(e)}")
+        run_state.close()
         exit(1)
 
-    asyncio.run(main(stash_api, args))
\ No newline at end of file
+    # startup is part of the profile, it dominates short runs
+    profiler = Profiler(args.profile, args.profile_memory)
+    profiler.start()
+
+    if args.trace:
+        TRACER.open(args.trace)
+
+    try:
+        stash_api = StashAPI(args.stash_url, args.api_key, args.stash_username, args.stash_password, rate_limiter=rate_limits.limiter(RateLimits.STASH), schema_cache=args.cache_path)
+        try:
+            stash_api.check_api()
+        except Exception as e:
+            logging.critical(f"Failed to check API: {str(e)}")
+            exit(1)
+
+        asyncio.run(main(stash_api, run_state, rate_limits, args))
+    finally:
+        run_state.close()
+        profiler.stop()
+        TRACER.close()
\ No newline at end of file
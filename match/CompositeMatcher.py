@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import List, Optional
+from booru import BooruEnum
+from .Matcher import Matcher
+from .MatchResults import MatchResult, PartialMatches
+
+class CompositeMatcher(Matcher):
+    """
+    Searches several reverse image search backends for the same image.
+
+    Backends are tried in order. Without a hedge delay they all start at once, otherwise the next
+    backend starts when the running ones have not found a good match within the hedge delay, or
+    as soon as one of them fails or finds nothing good. The search ends as soon as a backend finds
+    a match above the similarity on the preferred booru, the other backends are cancelled.
+    """
+
+    def __init__(self, matchers: List[Matcher], image_similarity: float, preferred_booru: BooruEnum, hedge_delay: Optional[float] = None):
+        """
+        Construct a new CompositeMatcher object.
+
+        :param matchers: Backends to search, in the order they are tried.
+        :param image_similarity: Minimum similarity of a match that ends the search.
+        :param preferred_booru: Booru a match has to be on to end the search.
+        :param hedge_delay: Seconds to wait for a backend before starting the next one, or None to start them all at once.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.matchers = matchers
+        self.image_similarity = image_similarity
+        self.preferred_booru = preferred_booru
+        self.hedge_delay = hedge_delay
+
+    async def match_image(self, image_bytes, image_similarity: float) -> List[MatchResult]:
+        """
+        Search the backends and return the matches of every backend that finished.
+
+        The matches are PartialMatches when backends were cancelled or failed. Raises the error of
+        the last failed backend if every backend failed.
+        """
+        backends = iter(self.matchers)
+        running = {}
+        matches = []
+        error = None
+
+        def start_next() -> bool:
+            matcher = next(backends, None)
+            if matcher is None:
+                return False
+
+            task = asyncio.create_task(matcher.match_image(image_bytes, image_similarity))
+            running[task] = type(matcher).__name__
+            return True
+
+        if self.hedge_delay is None:
+            while start_next():
+                pass
+        else:
+            start_next()
+
+        try:
+            while len(running) > 0:
+                done, _ = await asyncio.wait(running, timeout=self.hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+
+                if len(done) == 0:
+                    if start_next():
+                        self.logger.debug(f"No good match within {self.hedge_delay} seconds, also searching {list(running.values())[-1]}...")
+                    continue
+
+                for task in done:
+                    name = running.pop(task)
+
+                    if task.exception() is not None:
+                        error = task.exception()
+                        self.logger.warning(f"{name} failed: {str(error)}")
+                        continue
+
+                    matches.extend(task.result())
+                    if self._is_good_match(task.result()):
+                        return PartialMatches(matches) if len(running) > 0 or error is not None else matches
+
+                # nothing good came back, so there is no point in waiting for the hedge delay
+                start_next()
+        finally:
+            for task in running:
+                task.cancel()
+
+        if error is not None:
+            if len(matches) == 0:
+                raise error
+
+            return PartialMatches(matches)
+
+        return matches
+
+    def _is_good_match(self, matches: List[MatchResult]) -> bool:
+        return any(match.image_similarity >= self.image_similarity and self.preferred_booru.value in match.source_url for match in matches)
@@ -1,21 +1,45 @@
 from .Matcher import Matcher
-from PicImageSearch import Iqdb, Network
-from PicImageSearch.model import IqdbResponse
+import asyncio
 import backoff
-from typing import List
+from metrics import METRICS, TRACER
+from typing import List, Optional
+from net import HttpClients
 from .MatchResults import MatchResult
 import logging
+import urllib.parse
+
 class IqdbMatcher(Matcher):
-    def __init__(self):
+    HOST = "iqdb.org"
+    BASE_URL = "https://iqdb.org/"
+
+    def __init__(self, http: HttpClients, base_url: Optional[str] = None):
+        """
+        Construct a new IqdbMatcher object.
+
+        :param http: Shared http clients.
+        :param base_url: URL of the IQDB instance, e.g. a local stand-in. (Default https://iqdb.org/)
+        """
         self.logger = logging.getLogger(__name__)
-        super().__init__()
+        self.base_url = base_url or self.BASE_URL
+        super().__init__(http)
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3)
+    @TRACER.traced('match')
+    @backoff.on_exception(backoff.expo, Exception, max_tries=3, on_backoff=METRICS.count_retry)
     async def match_image(self, image_bytes, image_similarity: float):
-        async with Network(timeout=60) as client:
-            iqdb = Iqdb(client=client)
-            resp = await iqdb.search(file=image_bytes)
-            return self._parse_response(resp)
+        # PicImageSearch is only imported once IQDB is searched, runs answered by the match cache do not need it
+        from PicImageSearch.network import DEFAULT_HEADERS
+
+        client = self.http.client(urllib.parse.urlparse(self.base_url).netloc, headers=DEFAULT_HEADERS)
+        resp = await client.post(self.base_url, files={"file": image_bytes})
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to search IQDB. Status code: {resp.status_code}")
+
+        # the result page is parsed with PicImageSearch, which is cpu bound
+        return await asyncio.to_thread(self._parse_response, resp.text)
+
+    def _parse_response(self, text: str) -> List[MatchResult]:
+        from PicImageSearch.model import IqdbResponse
 
-    def _parse_response(self, resp: IqdbResponse) -> List[MatchResult]:
-        return [MatchResult(image_similarity=result.similarity*100, source_url=result.url) for result in resp.raw]
\ No newline at end of file
+        # iqdb reports similarity in percent
+        return [MatchResult(image_similarity=result.similarity / 100, source_url=result.url) for result in IqdbResponse(text).raw]
@@ -0,0 +1,42 @@
+import hashlib
+from dataclasses import asdict
+from typing import List, Optional
+from utils import SqliteCache
+from .MatchResults import MatchResult, PartialMatches
+
+class MatchCache(SqliteCache):
+    """
+    Persistent cache of reverse image search results, keyed by the hash of the image content.
+
+    The full list of results is cached, so they can be ranked again with a different similarity
+    or preferred booru without searching again. Searches without results, and searches that did not
+    hear back from every backend, expire sooner.
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float):
+        """
+        Open the match cache.
+
+        :param path: Path of the SQLite database.
+        :param ttl: Seconds until cached results expire.
+        :param negative_ttl: Seconds until a cached search without results expires.
+        """
+        super().__init__(path, 'iqdb_matches')
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    @staticmethod
+    def hash_image(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def get_matches(self, image_hash: str) -> Optional[List[MatchResult]]:
+        matches = self.get(image_hash)
+
+        if matches is None:
+            return None
+
+        return [MatchResult(**match) for match in matches]
+
+    def put_matches(self, image_hash: str, matches: List[MatchResult]):
+        complete = len(matches) > 0 and not isinstance(matches, PartialMatches)
+        self.put(image_hash, [asdict(match) for match in matches], self.ttl if complete else self.negative_ttl)
@@ -0,0 +1,92 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from metrics import METRICS
+from utils import BKTree
+from .MatchResults import MatchResult
+
+class MatchClusters:
+    """
+    Shares reverse image search results between near-duplicate images.
+
+    Images are clustered on the fly by perceptual hash. The first image of a cluster is searched
+    and every later image within max_distance of it reuses that search instead of running its own.
+
+    Only the clusters seen most recently are kept, in two generations of at most max_clusters
+    each. When the current generation is full the one before it is dropped, clusters that are
+    still seen are carried over into the new one. Memory stays flat on large libraries and in
+    watch mode, near-duplicates far apart in the run are searched twice.
+    """
+
+    def __init__(self, max_distance: int, max_clusters: int = 10000):
+        """
+        Construct a new MatchClusters object.
+
+        :param max_distance: Maximum Hamming distance between the hashes of images in the same cluster.
+        :param max_clusters: Number of clusters in a generation. (Default 10000)
+        """
+        self.max_distance = max_distance
+        self.max_clusters = max_clusters
+        self.tree = BKTree()
+        self.previous = BKTree()
+        self.shared = 0
+
+    async def find_matches(self, image_hash: int, search: Callable[[], Awaitable[List[MatchResult]]]) -> List[MatchResult]:
+        """
+        Get the search results of the cluster an image belongs to, searching if it starts a new cluster.
+
+        :param image_hash: Perceptual hash of the image.
+        :param search: Runs the search for the image.
+        """
+        # a list so a failed search can be replaced by the next image of the cluster
+        representative = self._find(image_hash)
+
+        if representative is not None and not self._failed(representative[0]):
+            self.shared += 1
+            METRICS.cache.inc('clusters', 'hit')
+
+            # waits like a shield, the search goes on for the cluster if this image is cancelled
+            task = representative[0]
+            await asyncio.wait([task])
+            if not task.cancelled():
+                return task.result()
+
+        METRICS.cache.inc('clusters', 'miss')
+
+        if representative is None:
+            representative = [None]
+            self._add(image_hash, representative)
+
+        # another image of the cluster may have started a new search in the meantime
+        if representative[0] is None or self._failed(representative[0]):
+            representative[0] = asyncio.create_task(search())
+
+        task = representative[0]
+        await asyncio.wait([task])
+        if task.cancelled():
+            # the search was cancelled rather than this image, so the image is searched on its own
+            return await search()
+
+        return task.result()
+
+    def _find(self, image_hash: int) -> Optional[list]:
+        for tree in (self.tree, self.previous):
+            found = tree.find(image_hash, self.max_distance)
+
+            if len(found) > 0:
+                _, cluster_hash, representative = found[0]
+                if tree is self.previous:
+                    self._add(cluster_hash, representative)
+
+                return representative
+
+        return None
+
+    def _add(self, image_hash: int, representative: list):
+        if len(self.tree) >= self.max_clusters:
+            self.previous, self.tree = self.tree, BKTree()
+
+        self.tree.add(image_hash, representative)
+
+    @staticmethod
+    def _failed(task: asyncio.Task) -> bool:
+        return task.done() and (task.cancelled() or task.exception() is not None)
@@ -3,4 +3,10 @@ from dataclasses import dataclass
 @dataclass
 class MatchResult:
     image_similarity: float
-    source_url: str
\ No newline at end of file
+    source_url: str
+
+class PartialMatches(list):
+    """
+    Matches of a search that ended before every backend answered, because one found a good match
+    first or failed. Other backends may have had more.
+    """
@@ -1,8 +1,12 @@
 from abc import ABC, abstractmethod
 from typing import List
+from net import HttpClients
 from .MatchResults import MatchResult
 
 class Matcher(ABC):
+    def __init__(self, http: HttpClients):
+        self.http = http
+
     @abstractmethod
-    def match_image(self, image_bytes, image_similarity: float) -> List[MatchResult]:
-        pass
\ No newline at end of file
+    async def match_image(self, image_bytes, image_similarity: float) -> List[MatchResult]:
+        pass
@@ -0,0 +1,50 @@
+import io
+import math
+from typing import Optional
+
+# DCT-II basis for the 8 lowest frequencies of a 64 sample signal, computed once.
+_SIZE = 64
+_LOW = 8
+_BASIS = [[math.cos(math.pi * (j + 0.5) * i / _SIZE) * math.sqrt(2.0 / _SIZE) * (math.sqrt(0.5) if i == 0 else 1.0) for j in range(_SIZE)] for i in range(_LOW)]
+
+def perceptual_hash(image_bytes: bytes) -> int:
+    """
+    Compute the 64 bit perceptual hash of an image.
+
+    Uses the same DCT based algorithm as stash's phash fingerprints (goimagehash), so hashes
+    computed here can be compared with the ones stash provides.
+
+    :param image_bytes: Encoded image.
+    """
+    # Pillow is only needed when clustering is turned on
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = list(image.convert('RGB').resize((_SIZE, _SIZE), Image.BILINEAR).convert('L').getdata())
+
+    # only the top left 8x8 block of the 2D DCT is needed, so only those coefficients are computed
+    rows = [pixels[y * _SIZE:(y + 1) * _SIZE] for y in range(_SIZE)]
+    row_dct = [[sum(b * p for b, p in zip(basis, row)) for basis in _BASIS] for row in rows]
+    coefficients = [sum(basis[y] * row_dct[y][x] for y in range(_SIZE)) for basis in _BASIS for x in range(_LOW)]
+
+    median = sorted(coefficients)[len(coefficients) // 2]
+
+    image_hash = 0
+    for index, coefficient in enumerate(coefficients):
+        if coefficient > median:
+            image_hash |= 1 << (len(coefficients) - index - 1)
+
+    return image_hash
+
+def stash_perceptual_hash(image: dict) -> Optional[int]:
+    """
+    Get the phash fingerprint stash computed for an image, if it has one.
+
+    :param image: Image as returned by StashAPI.get_images(include_fingerprints=True).
+    """
+    for file in image.get('visual_files') or []:
+        for fingerprint in file.get('fingerprints') or []:
+            if fingerprint['type'] == 'phash':
+                return int(fingerprint['value'], 16)
+
+    return None
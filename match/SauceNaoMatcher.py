@@ -0,0 +1,66 @@
+from .Matcher import Matcher
+import backoff
+from metrics import METRICS, TRACER
+from booru import BooruEnum
+from typing import List, Optional
+from net import HttpClients
+from .MatchResults import MatchResult
+import logging
+import urllib.parse
+
+class SauceNaoMatcher(Matcher):
+    """
+    Reverse image search on SauceNAO.
+
+    Only results that link to a supported booru are kept, the other indexes (pixiv, twitter, ...)
+    have no booru tags to fetch.
+    """
+
+    HOST = "saucenao.com"
+    BASE_URL = "https://saucenao.com/search.php"
+
+    def __init__(self, http: HttpClients, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        """
+        Construct a new SauceNaoMatcher object.
+
+        :param http: Shared http clients.
+        :param api_key: SauceNAO API key. (optional, anonymous searches are limited to a few a day)
+        :param base_url: URL of the search endpoint, e.g. a local stand-in. (Default https://saucenao.com/search.php)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.api_key = api_key
+        self.base_url = base_url or self.BASE_URL
+        self.booru_hosts = {booru.value for booru in BooruEnum}
+        super().__init__(http)
+
+    @TRACER.traced('match')
+    @backoff.on_exception(backoff.expo, Exception, max_tries=3, on_backoff=METRICS.count_retry)
+    async def match_image(self, image_bytes, image_similarity: float):
+        params = {"output_type": 2, "numres": 16, "db": 999}
+        if self.api_key is not None:
+            params["api_key"] = self.api_key
+
+        client = self.http.client(urllib.parse.urlparse(self.base_url).netloc)
+        resp = await client.post(self.base_url, params=params, files={"file": image_bytes})
+
+        if resp.status_code != 200:
+            raise Exception(f"Failed to search SauceNAO. Status code: {resp.status_code}")
+
+        resp_json = resp.json()
+        if resp_json['header'].get('status', 0) != 0:
+            raise Exception(f"Failed to search SauceNAO: {resp_json['header'].get('message', resp_json['header']['status'])}")
+
+        return self._parse_response(resp_json)
+
+    def _parse_response(self, resp_json: dict) -> List[MatchResult]:
+        matches = []
+
+        for result in resp_json.get('results') or []:
+            # saucenao reports similarity in percent
+            similarity = float(result['header']['similarity']) / 100
+
+            for url in result['data'].get('ext_urls', []):
+                if urllib.parse.urlparse(url).netloc in self.booru_hosts:
+                    matches.append(MatchResult(image_similarity=similarity, source_url=url))
+
+        return matches
@@ -0,0 +1,22 @@
+import io
+
+def make_thumbnail(image_bytes: bytes, max_size: int) -> bytes:
+    """
+    Shrink an image to fit in max_size x max_size and re-encode it as JPEG.
+
+    Runs in a worker process, so it has to stay a module level function.
+
+    :param image_bytes: Encoded image.
+    :param max_size: Maximum width and height of the thumbnail.
+    """
+    # Pillow is only needed when images are resized locally
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('RGB', (max_size, max_size))
+        thumbnail = image.convert('RGB')
+        thumbnail.thumbnail((max_size, max_size))
+
+    output = io.BytesIO()
+    thumbnail.save(output, 'JPEG', quality=90)
+    return output.getvalue()
@@ -1 +1,20 @@
-from .IqdbMatcher import IqdbMatcher
\ No newline at end of file
+import importlib
+from .MatchCache import MatchCache
+from .MatchClusters import MatchClusters
+
+# the search backends are only imported when they are first used, IQDB pulls in PicImageSearch
+_MATCHERS = ('IqdbMatcher', 'SauceNaoMatcher', 'CompositeMatcher')
+
+def __getattr__(name: str):
+    if name not in _MATCHERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    # the submodule has the name of its class, bind the class over the module the import sets. Once
+    # anything imports the submodule directly its module is bound again, so the tagger imports the
+    # classes from their submodules and this is only a convenience.
+    matcher = getattr(importlib.import_module(f".{name}", __name__), name)
+    globals()[name] = matcher
+    return matcher
+
+def __dir__():
+    return sorted(set(globals()) | set(_MATCHERS))
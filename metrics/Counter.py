@@ -0,0 +1,28 @@
+from .Metric import Metric
+
+class Counter(Metric):
+    """
+    Count that only goes up, e.g. of requests or finished images.
+    """
+
+    TYPE = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        """
+        Add to the count of the label values.
+
+        :param label_values: Values of the labels, in the order of the labels.
+        :param amount: Amount to add. (Default 1)
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def total(self) -> float:
+        """
+        Sum of the counts of every label value.
+        """
+        with self.lock:
+            return sum(self.values.values())
@@ -0,0 +1,40 @@
+from typing import Callable
+from .Metric import Metric
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. the number of requests in flight.
+
+    Instead of being set, a gauge can also track a function that is called whenever it is read,
+    e.g. the size of a queue.
+    """
+
+    TYPE = "gauge"
+
+    def set(self, *label_values: str, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def track(self, *label_values: str, function: Callable[[], float]):
+        """
+        Read the value of the label values from a function from now on.
+
+        :param label_values: Values of the labels, in the order of the labels.
+        :param function: Returns the current value.
+        """
+        with self.lock:
+            self.values[label_values] = function
+
+    def get(self, *label_values: str) -> float:
+        value = self.values.get(label_values, 0)
+        return value() if callable(value) else value
+
+    def _render_value(self, label_values: tuple, value) -> list[str]:
+        return super()._render_value(label_values, value() if callable(value) else value)
@@ -0,0 +1,95 @@
+import bisect
+from .Metric import Metric, format_number
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. latencies, counted in buckets.
+
+    Besides the buckets the sum, count and maximum of the observations are kept, percentiles are
+    estimated from the buckets.
+    """
+
+    TYPE = "histogram"
+
+    # seconds, from a local stash request up to a slow IQDB search that was retried
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Construct a new Histogram object.
+
+        :param name: Name of the metric, e.g. tagger_stage_seconds.
+        :param help: Description of the metric.
+        :param labels: Names of the labels, their values are passed to every update in this order.
+        :param buckets: Upper bounds of the buckets, in ascending order. (Default 1ms to 120s)
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, *label_values: str, value: float):
+        """
+        Count an observation.
+
+        :param label_values: Values of the labels, in the order of the labels.
+        :param value: Observed value.
+        """
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                # counts per bucket, sum, count, max
+                state = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0, 0.0]
+
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+            state[3] = max(state[3], value)
+
+    def count(self, *label_values: str) -> int:
+        state = self.values.get(label_values)
+        return state[2] if state is not None else 0
+
+    def mean(self, *label_values: str) -> float:
+        state = self.values.get(label_values)
+        return state[1] / state[2] if state is not None and state[2] > 0 else 0.0
+
+    def max(self, *label_values: str) -> float:
+        state = self.values.get(label_values)
+        return state[3] if state is not None else 0.0
+
+    def quantile(self, q: float, *label_values: str) -> float:
+        """
+        Estimate a percentile, interpolating linearly within the bucket it falls into.
+
+        :param q: Percentile between 0 and 1, e.g. 0.9.
+        :param label_values: Values of the labels, in the order of the labels.
+        """
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None or state[2] == 0:
+                return 0.0
+            counts, _, count, maximum = state[0][:], state[1], state[2], state[3]
+
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                # the estimate can never be above what was actually observed
+                upper = min(self.buckets[index], maximum)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+
+        return maximum
+
+    def _render_value(self, label_values: tuple, value) -> list[str]:
+        counts, total, count, _ = value
+        lines = []
+        cumulative = 0
+
+        for bucket, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._format_labels(label_values, (('le', format_number(bucket)),))} {cumulative}")
+
+        lines.append(f"{self.name}_sum{self._format_labels(label_values)} {format_number(total)}")
+        lines.append(f"{self.name}_count{self._format_labels(label_values)} {count}")
+        return lines
@@ -0,0 +1,57 @@
+import threading
+
+class Metric:
+    """
+    A value kept separately for every combination of label values, rendered in the Prometheus text format.
+
+    Metrics are updated from the event loop and from the worker threads that talk to stash, so
+    every update holds the lock of its metric.
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        """
+        Construct a new Metric object.
+
+        :param name: Name of the metric, e.g. tagger_images_total.
+        :param help: Description of the metric.
+        :param labels: Names of the labels, their values are passed to every update in this order.
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        """
+        Lines of the metric in the Prometheus text format.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for label_values, value in values:
+            lines += self._render_value(label_values, value)
+
+        return lines
+
+    def _render_value(self, label_values: tuple, value) -> list[str]:
+        return [f"{self.name}{self._format_labels(label_values)} {format_number(value)}"]
+
+    def _format_labels(self, label_values: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+
+        return "{" + ",".join(f'{name}="{escape_label(str(value))}"' for name, value in pairs) + "}"
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_number(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
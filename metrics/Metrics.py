@@ -0,0 +1,172 @@
+import time
+from collections import deque
+from typing import Optional
+from .Counter import Counter
+from .Gauge import Gauge
+from .Histogram import Histogram
+from .Metric import format_number
+from .Tracer import TRACER
+
+class Metrics:
+    """
+    Everything the tagger measures during a run: how long images spend in every stage, how the hosts
+    answer, retries, cache hits and the throughput of the run.
+
+    The metrics are served in the Prometheus text format while the run goes on and summed up in a
+    table when it ends.
+    """
+
+    # seconds of finished images the throughput and the ETA are based on
+    RATE_WINDOW = 60
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.progress = None
+        self._finished = deque()
+
+        self.stage_seconds = Histogram('tagger_stage_seconds', 'Seconds a pipeline stage worked on an image.', ('stage',))
+        self.stage_in_flight = Gauge('tagger_stage_in_flight', 'Images a pipeline stage is working on.', ('stage',))
+        self.stage_queued = Gauge('tagger_stage_queued', 'Images waiting for a pipeline stage.', ('stage',))
+        self.stage_errors = Counter('tagger_stage_errors_total', 'Images that failed, by the stage they failed in.', ('stage',))
+        self.images = Counter('tagger_images_total', 'Images finished, by outcome.', ('outcome',))
+        self.matches = Counter('tagger_matches_total', 'Images searched for, by whether a good enough match was found.', ('result',))
+        self.requests = Counter('tagger_http_requests_total', 'HTTP requests by host and status, "error" if no response arrived.', ('host', 'status'))
+        self.request_seconds = Histogram('tagger_http_request_seconds', 'Seconds from sending a request to a host until its response.', ('host',))
+        self.requests_in_flight = Gauge('tagger_http_requests_in_flight', 'Requests sent to a host that have not been answered yet.', ('host',))
+        self.retries = Counter('tagger_retries_total', 'Calls retried after they failed, by function.', ('call',))
+        self.cache = Counter('tagger_cache_lookups_total', 'Cache lookups by cache and result.', ('cache', 'result'))
+
+    def track_progress(self, progress):
+        """
+        Take the number of images done and to do from a ProgressCounter.
+        """
+        self.progress = progress
+
+    def finish_image(self, outcome: str):
+        """
+        Count an image that left the run.
+
+        :param outcome: processed, failed or skipped. Skipped images do not count towards the throughput.
+        """
+        self.images.inc(outcome)
+
+        if outcome != 'skipped':
+            self._finished.append(time.monotonic())
+
+    def record_request(self, host: str, status: Optional[int], seconds: float):
+        """
+        Count a request and its latency.
+
+        :param host: Host the request was sent to.
+        :param status: HTTP status code of the response, None if the request failed without one.
+        :param seconds: Seconds until the response arrived.
+        """
+        if status is None:
+            status_class = 'error'
+        elif status == 429:
+            status_class = '429'
+        else:
+            status_class = f"{status // 100}xx"
+
+        self.requests.inc(host, status_class)
+        self.request_seconds.observe(host, value=seconds)
+
+    def count_retry(self, details: dict):
+        """
+        on_backoff handler of the backoff decorators, also counts the retry in the span being traced.
+        """
+        self.retries.inc(details['target'].__qualname__)
+        TRACER.count_retry()
+
+    def images_per_second(self) -> float:
+        now = time.monotonic()
+        while len(self._finished) > 0 and self._finished[0] < now - self.RATE_WINDOW:
+            self._finished.popleft()
+
+        elapsed = min(self.RATE_WINDOW, now - self.started)
+        return len(self._finished) / elapsed if elapsed > 0 else 0.0
+
+    def eta_seconds(self) -> Optional[float]:
+        """
+        Seconds until every known image is done at the current throughput, None if nothing was done lately.
+        """
+        rate = self.images_per_second()
+        if self.progress is None or rate == 0:
+            return None
+
+        return max(0, self.progress.total - self.progress.current) / rate
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text format.
+        """
+        lines = []
+        for metric in (self.stage_seconds, self.stage_in_flight, self.stage_queued, self.stage_errors, self.images, self.matches, self.requests, self.request_seconds, self.requests_in_flight, self.retries, self.cache):
+            lines += metric.render()
+
+        eta = self.eta_seconds()
+        run_gauges = [
+            ('tagger_uptime_seconds', 'Seconds since the run started.', time.monotonic() - self.started),
+            ('tagger_images_per_second', f"Images processed or failed per second over the last {self.RATE_WINDOW} seconds.", self.images_per_second()),
+            ('tagger_images_done', 'Images done so far, including skipped ones.', self.progress.current if self.progress is not None else 0),
+            ('tagger_images_known', 'Images found in stash so far.', self.progress.total if self.progress is not None else 0),
+            ('tagger_eta_seconds', 'Estimated seconds until every known image is done, NaN while nothing is done.', eta if eta is not None else float('nan')),
+        ]
+        for name, help, value in run_gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {'NaN' if value != value else format_number(value)}"]
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list[str]:
+        """
+        Lines of a table summing up the run, to log when it ends.
+        """
+        elapsed = time.monotonic() - self.started
+        done = self.images.get('processed') + self.images.get('failed')
+        lines = [
+            f"Run summary after {format_duration(elapsed)}: {int(self.images.get('processed'))} processed, {int(self.images.get('failed'))} failed, "
+            f"{int(self.images.get('skipped'))} skipped, {done / elapsed if elapsed > 0 else 0:.2f} images/s on average."
+        ]
+
+        stages = sorted(self.stage_seconds.values, key=lambda label_values: STAGE_ORDER.get(label_values[0], len(STAGE_ORDER)))
+        if len(stages) > 0:
+            lines.append(f"{'stage':<12} {'images':>8} {'errors':>7} {'mean s':>8} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'max s':>8}")
+            for (stage,) in stages:
+                lines.append(
+                    f"{stage:<12} {self.stage_seconds.count(stage):>8} {int(self.stage_errors.get(stage)):>7} {self.stage_seconds.mean(stage):>8.3f} "
+                    f"{self.stage_seconds.quantile(0.5, stage):>8.3f} {self.stage_seconds.quantile(0.9, stage):>8.3f} "
+                    f"{self.stage_seconds.quantile(0.99, stage):>8.3f} {self.stage_seconds.max(stage):>8.3f}"
+                )
+
+        hosts = sorted(self.request_seconds.values)
+        if len(hosts) > 0:
+            lines.append(f"{'host':<28} {'requests':>8} {'2xx':>7} {'4xx':>5} {'429':>5} {'5xx':>5} {'errors':>6} {'p50 s':>8} {'p90 s':>8}")
+            for (host,) in hosts:
+                lines.append(
+                    f"{host:<28} {self.request_seconds.count(host):>8} {int(self.requests.get(host, '2xx') + self.requests.get(host, '3xx')):>7} "
+                    f"{int(self.requests.get(host, '4xx')):>5} {int(self.requests.get(host, '429')):>5} {int(self.requests.get(host, '5xx')):>5} "
+                    f"{int(self.requests.get(host, 'error')):>6} {self.request_seconds.quantile(0.5, host):>8.3f} {self.request_seconds.quantile(0.9, host):>8.3f}"
+                )
+
+        if self.matches.total() > 0:
+            lines.append(f"Matches: {int(self.matches.get('matched'))} matched, {int(self.matches.get('none'))} without a good enough match.")
+
+        caches = sorted({cache for cache, _ in self.cache.values})
+        if len(caches) > 0:
+            lines.append("Caches: " + ", ".join(f"{cache} {int(self.cache.get(cache, 'hit'))}/{int(self.cache.get(cache, 'hit') + self.cache.get(cache, 'miss'))} hits" for cache in caches) + ".")
+
+        if self.retries.total() > 0:
+            lines.append("Retries: " + ", ".join(f"{call} {int(count)}" for (call,), count in sorted(self.retries.values.items())) + ".")
+
+        return lines
+
+# stages in pipeline order for the summary, stages of other pipelines follow them
+STAGE_ORDER = {name: index for index, name in enumerate(('download', 'match', 'tags', 'resolve', 'update'))}
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+# the metrics of the run, shared by everything that is measured
+METRICS = Metrics()
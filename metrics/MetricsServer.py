@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from .Metrics import Metrics
+
+class MetricsServer:
+    """
+    Minimal local HTTP endpoint that serves the metrics of the run in the Prometheus text format.
+
+    Every GET request is answered with all metrics, whatever its path, so both a Prometheus scrape of
+    /metrics and a quick curl of / work.
+    """
+
+    MAX_HEADER_SIZE = 16384
+
+    def __init__(self, host: str, port: int, metrics: Metrics):
+        """
+        Construct a new MetricsServer object.
+
+        :param host: Address to listen on.
+        :param port: Port to listen on.
+        :param metrics: Metrics to serve.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=self.MAX_HEADER_SIZE)
+        self.logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            method = request_line.split(b' ', 1)[0].decode('latin-1')
+
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            if method in ('GET', 'HEAD'):
+                body = self.metrics.render().encode()
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode())
+                if method == 'GET':
+                    writer.write(body)
+            else:
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+            await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            self.logger.debug(f"Dropped a malformed metrics request: {str(e)}")
+        finally:
+            writer.close()
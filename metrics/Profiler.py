@@ -0,0 +1,88 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import tracemalloc
+from typing import Optional
+
+class Profiler:
+    """
+    Profiles a whole run with cProfile, and its memory allocations with tracemalloc.
+
+    cProfile only sees the thread it was started on, which runs the event loop and with it
+    everything but the stash calls, those run in worker threads and show up as the time spent
+    waiting on them. The allocations are snapshot in the background whenever the traced memory
+    reaches a new peak, so the sites that were largest at the peak are kept, not those left
+    over at the end of the run.
+    """
+
+    # seconds between checks of the traced memory, and how much it has to grow over the last snapshot
+    MEMORY_INTERVAL = 1.0
+    MEMORY_GROWTH = 1.1
+
+    def __init__(self, profile_path: Optional[str] = None, memory_path: Optional[str] = None, top: int = 25):
+        """
+        Construct a new Profiler object.
+
+        :param profile_path: Path to save the cProfile stats to, None to not profile the run. (optional)
+        :param memory_path: Path to save the tracemalloc snapshot to, None to not trace allocations. (optional)
+        :param top: Number of functions and allocation sites to log at the end.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.profile_path = profile_path
+        self.memory_path = memory_path
+        self.top = top
+        self.profile = None
+        self.snapshot = None
+        self.snapshot_size = 0
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        if self.memory_path:
+            tracemalloc.start()
+            self._sampler = threading.Thread(target=self._sample_memory, name='memory-sampler', daemon=True)
+            self._sampler.start()
+
+        if self.profile_path:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling, save the results and log the slowest functions and the largest allocation sites.
+        """
+        if self._sampler is not None:
+            self._stopped.set()
+            self._sampler.join()
+            self._take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.snapshot.dump(self.memory_path)
+
+            # the tracemalloc and importlib frames are the cost of tracing and of starting up
+            snapshot = self.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+            lines = [f"{stat.size / 1024:>10.1f} KB {stat.count:>8} blocks  {stat.traceback}" for stat in snapshot.statistics('lineno')[:self.top]]
+            self.logger.info(f"Saved the allocations at {self.snapshot_size / 1048576:.1f} MB to {self.memory_path} (peak {peak / 1048576:.1f} MB), the largest allocation sites:\n" + "\n".join(lines))
+            self._sampler = None
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profile_path)
+
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            self.logger.info(f"Saved the profile to {self.profile_path}, the functions with the most cumulative time:\n{output.getvalue()}")
+            self.profile = None
+
+    def _sample_memory(self):
+        while not self._stopped.wait(self.MEMORY_INTERVAL):
+            self._take_snapshot()
+
+    def _take_snapshot(self):
+        current, _ = tracemalloc.get_traced_memory()
+
+        if self.snapshot is None or current > self.snapshot_size * self.MEMORY_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
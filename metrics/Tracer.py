@@ -0,0 +1,201 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+class Tracer:
+    """
+    Writes a span for every stage, search, tag fetch, stash call and HTTP request done for an image.
+
+    Spans are written as JSON lines, one object per span, so the file can be streamed, filtered
+    with grep or jq and appended to by a killed run without breaking it. A span has its name,
+    category, start and duration in microseconds, process id, image and arguments. to_chrome
+    converts the file to Chrome trace events for chrome://tracing, Perfetto or speedscope.
+
+    Spans know the image they belong to and the span they were started in through context variables,
+    which asyncio tasks and asyncio.to_thread hand down to the code they run.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self._image = contextvars.ContextVar('trace_image', default=None)
+        self._span = contextvars.ContextVar('trace_span', default=None)
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    def open(self, path: str):
+        """
+        Start writing spans to a file.
+
+        :param path: Path of the JSON lines file, overwritten if it exists.
+        """
+        self.file = open(path, 'w')
+
+    def close(self):
+        if self.file is None:
+            return
+
+        with self.lock:
+            self.file.close()
+            self.file = None
+
+    def set_image(self, image_id):
+        """
+        Attribute the spans of the current task, and of the tasks and threads it starts, to an image.
+        """
+        self._image.set(image_id)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        """
+        Time the code in the with block as a span.
+
+        Yields the arguments of the span, so the code can add to them, e.g. the bytes it received.
+
+        :param name: Name of the span, e.g. the function.
+        :param category: Kind of span, e.g. stage, http or stash.
+        :param args: Arguments shown with the span.
+        """
+        if self.file is None:
+            yield args
+            return
+
+        token = self._span.set(args)
+        started = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = str(e)[:200] or type(e).__name__
+            raise
+        finally:
+            self._span.reset(token)
+            self.add_span(name, category, started, time.perf_counter() - started, **args)
+
+    def add_span(self, name: str, category: str, started: float, duration: float, **args):
+        """
+        Write a span that was timed elsewhere.
+
+        :param started: Start of the span, from time.perf_counter.
+        :param duration: Seconds the span took.
+        """
+        if self.file is None:
+            return
+
+        image_id = args.pop('image') if 'image' in args else self._image.get()
+
+        span = {
+            "name": name,
+            "cat": category,
+            "ts": round(started * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": self.pid,
+            "image": image_id,
+            "args": args,
+        }
+        line = json.dumps(span, separators=(',', ':'), default=str) + "\n"
+
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+
+    def count_retry(self):
+        """
+        Count a retry in the span currently running, called by the on_backoff handler.
+        """
+        args = self._span.get()
+        if args is not None:
+            args['retries'] = args.get('retries', 0) + 1
+
+    def traced(self, category: str, name: Optional[str] = None):
+        """
+        Decorator that traces every call of a function or coroutine function as a span.
+
+        Put it above a backoff decorator, so the span covers every try and counts the retries.
+
+        :param category: Kind of span, e.g. stash or booru.
+        :param name: Name of the span. (Default the qualified name of the function)
+        """
+        def decorator(function):
+            span_name = name or function.__qualname__
+
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def run_async(*args, **kwargs):
+                    if self.file is None:
+                        return await function(*args, **kwargs)
+
+                    with self.span(span_name, category):
+                        return await function(*args, **kwargs)
+
+                return run_async
+
+            @functools.wraps(function)
+            def run(*args, **kwargs):
+                if self.file is None:
+                    return function(*args, **kwargs)
+
+                with self.span(span_name, category):
+                    return function(*args, **kwargs)
+
+            return run
+
+        return decorator
+
+    @staticmethod
+    def to_chrome(paths: list[str], output_path: str):
+        """
+        Convert span files to a JSON array of Chrome trace events, e.g. for chrome://tracing or Perfetto.
+
+        Every image gets a row of its own, with its id as thread id. The spans of several files, e.g.
+        of every worker of a run, are merged, their processes are told apart by process id.
+
+        :param paths: Paths of the JSON lines files the tracer wrote.
+        :param output_path: Path of the Chrome trace file, overwritten if it exists.
+        """
+        pids = set()
+
+        with open(output_path, 'w') as output:
+            output.write("[\n")
+
+            for line in Tracer._read_lines(paths):
+                # the last line of a run that was killed can be cut off
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+
+                image_id = span['image']
+                args = span['args'] if image_id is None else {**span['args'], 'image': image_id}
+                event = {
+                    "name": span['name'],
+                    "cat": span['cat'],
+                    "ph": "X",
+                    "ts": span['ts'],
+                    "dur": span['dur'],
+                    "pid": span['pid'],
+                    "tid": int(image_id) if str(image_id).isdigit() else 0,
+                    "args": args,
+                }
+                output.write(json.dumps(event, separators=(',', ':')) + ",\n")
+                pids.add(span['pid'])
+
+            metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"stash-booru-tagger {pid}"}} for pid in sorted(pids)]
+            output.write(",\n".join(json.dumps(event, separators=(',', ':')) for event in metadata) + "\n]\n")
+
+    @staticmethod
+    def _read_lines(paths: list[str]):
+        for path in paths:
+            with open(path) as spans:
+                yield from spans
+
+# the tracer of the run, only writes spans once a trace file was opened
+TRACER = Tracer()
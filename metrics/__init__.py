@@ -0,0 +1,7 @@
+from .Counter import Counter
+from .Gauge import Gauge
+from .Histogram import Histogram
+from .Metrics import Metrics, METRICS
+from .MetricsServer import MetricsServer
+from .Tracer import Tracer, TRACER
+from .Profiler import Profiler
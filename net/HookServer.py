@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import Callable
+
+class HookServer:
+    """
+    Minimal local HTTP endpoint that stash plugins or webhooks call when images are created.
+
+    Every POST request calls on_hook and is answered with 204 right away, the body is ignored.
+    The hook only tells the tagger to poll stash now instead of at the next poll interval, so a
+    lost or repeated call never loses or duplicates an image.
+    """
+
+    MAX_HEADER_SIZE = 16384
+
+    def __init__(self, host: str, port: int, on_hook: Callable[[], None]):
+        """
+        Construct a new HookServer object.
+
+        :param host: Address to listen on.
+        :param port: Port to listen on.
+        :param on_hook: Called for every POST request.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.on_hook = on_hook
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=self.MAX_HEADER_SIZE)
+        self.logger.info(f"Listening for hooks on http://{self.host}:{self.port}/")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            method = request_line.split(b' ', 1)[0].decode('latin-1')
+            content_length = 0
+
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    content_length = int(value.strip())
+
+            # the body is read so clients that wait for it to be consumed do not hang
+            if content_length > 0:
+                await reader.readexactly(min(content_length, self.MAX_HEADER_SIZE))
+
+            if method == 'POST':
+                self.on_hook()
+                writer.write(b'HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nAllow: POST\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+            await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            self.logger.debug(f"Dropped a malformed hook request: {str(e)}")
+        finally:
+            writer.close()
@@ -0,0 +1,30 @@
+import httpx
+
+class HostOverrideTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that sends the requests for some hosts to other servers, e.g. local stand-ins.
+
+    Only the scheme, host and port of the url are replaced, the path, the query and the Host header
+    stay the same, so the other server can still tell which site a request was meant for.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, overrides: dict[str, str]):
+        """
+        Construct a new HostOverrideTransport object.
+
+        :param transport: Transport that sends the requests.
+        :param overrides: Base url to send the requests to by host name, e.g. {"danbooru.donmai.us": "http://127.0.0.1:8001"}.
+        """
+        self.transport = transport
+        self.overrides = {host: httpx.URL(url) for host, url in overrides.items()}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        target = self.overrides.get(request.url.host)
+
+        if target is not None:
+            request.url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
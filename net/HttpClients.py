@@ -0,0 +1,68 @@
+import httpx
+import logging
+from typing import Optional
+from .RateLimits import RateLimits
+from .RateLimitedTransport import RateLimitedTransport
+from .HostOverrideTransport import HostOverrideTransport
+
+class HttpClients:
+    """
+    Long-lived async HTTP clients shared by the matchers and booru adapters.
+
+    Every host gets its own client and connection pool, so connections are kept alive between
+    requests and a slow host can not use up the connections of another one. With rate limits, every
+    request waits for the limiter of its host.
+    """
+
+    def __init__(self, timeout: float = 60, connect_timeout: float = 10, max_connections: int = 10, http2: bool = False, rate_limits: Optional[RateLimits] = None, host_overrides: Optional[dict[str, str]] = None):
+        """
+        Construct a new HttpClients object.
+
+        :param timeout: Seconds to wait for a response.
+        :param connect_timeout: Seconds to wait for a connection to be established.
+        :param max_connections: Maximum number of open connections per host.
+        :param http2: Use HTTP/2 where the host supports it.
+        :param rate_limits: Rate limiters of the hosts. (optional)
+        :param host_overrides: Base url to send the requests for a host to instead, by host name. (optional)
+        """
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                raise Exception("HTTP/2 support requires the h2 package. (pip install httpx[http2])")
+
+        self.logger = logging.getLogger(__name__)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.http2 = http2
+        self.rate_limits = rate_limits
+        self.host_overrides = host_overrides or {}
+        self.clients = {}
+
+    def client(self, host: str, headers: Optional[dict] = None) -> httpx.AsyncClient:
+        """
+        Get the client for a host, creating it on first use.
+
+        :param host: Host name the client is used for.
+        :param headers: Headers sent with every request, only used when the client is created. (optional)
+        """
+        client = self.clients.get(host)
+
+        if client is None:
+            self.logger.debug(f"Opening HTTP client for {host}...")
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, http2=self.http2)
+            if len(self.host_overrides) > 0:
+                transport = HostOverrideTransport(transport, self.host_overrides)
+            if self.rate_limits is not None:
+                transport = RateLimitedTransport(transport, self.rate_limits.limiter(host))
+
+            client = httpx.AsyncClient(headers=headers, timeout=self.timeout, transport=transport, follow_redirects=True)
+            self.clients[host] = client
+
+        return client
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+
+        self.clients = {}
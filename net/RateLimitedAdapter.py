@@ -0,0 +1,43 @@
+import time
+import urllib.parse
+from requests.adapters import HTTPAdapter
+from metrics import METRICS, TRACER
+from .RateLimiter import RateLimiter
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    requests adapter that sends every request through a rate limiter.
+
+    Used for stash, whose gql transport and image downloads are blocking and run in worker threads.
+    """
+
+    def __init__(self, limiter: RateLimiter, **kwargs):
+        """
+        Construct a new RateLimitedAdapter object.
+
+        :param limiter: Rate limiter of the host.
+        """
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        started = self.limiter.acquire_sync()
+        sent = time.perf_counter()
+        METRICS.requests_in_flight.inc(self.limiter.host)
+
+        with TRACER.span(f"{request.method} {urllib.parse.urlparse(request.url).path}", 'http', host=self.limiter.host, bytes_sent=int(request.headers.get('Content-Length', 0))) as span:
+            try:
+                response = super().send(request, **kwargs)
+            except Exception:
+                METRICS.requests_in_flight.dec(self.limiter.host)
+                METRICS.record_request(self.limiter.host, None, time.perf_counter() - sent)
+                self.limiter.release_sync(started)
+                raise
+
+            span['status'] = response.status_code
+            span['bytes_received'] = int(response.headers.get('Content-Length', 0))
+
+        METRICS.requests_in_flight.dec(self.limiter.host)
+        METRICS.record_request(self.limiter.host, response.status_code, time.perf_counter() - sent)
+        self.limiter.release_sync(started, response.status_code, response.headers.get('Retry-After'))
+        return response
@@ -0,0 +1,49 @@
+import time
+import httpx
+from metrics import METRICS, TRACER
+from .RateLimiter import RateLimiter
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport that sends every request through the rate limiter of its host.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: RateLimiter):
+        """
+        Construct a new RateLimitedTransport object.
+
+        :param transport: Transport that sends the requests.
+        :param limiter: Rate limiter of the host.
+        """
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = await self.limiter.acquire()
+        sent = time.perf_counter()
+        METRICS.requests_in_flight.inc(self.limiter.host)
+
+        with TRACER.span(f"{request.method} {request.url.path}", 'http', host=self.limiter.host, bytes_sent=int(request.headers.get('Content-Length', 0))) as span:
+            try:
+                response = await self.transport.handle_async_request(request)
+            except Exception:
+                METRICS.requests_in_flight.dec(self.limiter.host)
+                METRICS.record_request(self.limiter.host, None, time.perf_counter() - sent)
+                await self.limiter.release(started)
+                raise
+            except BaseException:
+                # cancelled, e.g. a hedged search that lost, which says nothing about the host
+                METRICS.requests_in_flight.dec(self.limiter.host)
+                self.limiter.discard()
+                raise
+
+            span['status'] = response.status_code
+            span['bytes_received'] = int(response.headers.get('Content-Length', 0))
+
+        METRICS.requests_in_flight.dec(self.limiter.host)
+        METRICS.record_request(self.limiter.host, response.status_code, time.perf_counter() - sent)
+        await self.limiter.release(started, response.status_code, response.headers.get('Retry-After'))
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
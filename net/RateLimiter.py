@@ -0,0 +1,188 @@
+import asyncio
+import logging
+from collections import deque
+import time
+from typing import Optional
+
+class RateLimiter:
+    """
+    Adaptive rate and concurrency limit for a single host.
+
+    Requests are spaced out by a token bucket and the number of requests in flight is capped. Both
+    limits grow slowly while the host answers quickly, and are cut down as soon as it answers with
+    429/503, fails, or slows down noticeably (additive increase, multiplicative decrease).
+
+    A request that is cancelled, e.g. the losing backend of a hedged search, gives its slot back
+    without counting against the host.
+    """
+
+    THROTTLED_STATUS_CODES = (429, 503)
+
+    def __init__(self, host: str, rate: float, concurrency: int, min_rate: Optional[float] = None, max_rate: Optional[float] = None, max_concurrency: Optional[int] = None, burst: int = 1, adaptive: bool = True, latency_tolerance: float = 3.0, latency_backoff: bool = True):
+        """
+        Construct a new RateLimiter object.
+
+        :param host: Host the limits apply to, only used for logging.
+        :param rate: Initial number of requests per second.
+        :param concurrency: Initial number of requests in flight.
+        :param min_rate: Lowest rate the limiter backs off to. (Default a tenth of rate)
+        :param max_rate: Highest rate the limiter grows to. (Default four times rate)
+        :param max_concurrency: Highest number of requests in flight the limiter grows to. (Default four times concurrency)
+        :param burst: Number of requests that can be sent at once after the host was idle.
+        :param adaptive: Adjust the limits to the responses of the host, otherwise they stay fixed.
+        :param latency_tolerance: How many times slower than the fastest response a response can get before the host counts as overloaded.
+        :param latency_backoff: Back off when responses get slower, otherwise only on 429/503 and failures. Turn it off for hosts whose requests differ a lot in size.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.rate = float(rate)
+        self.concurrency = float(concurrency)
+        self.min_rate = min_rate if min_rate is not None else self.rate / 10
+        self.max_rate = max_rate if max_rate is not None else self.rate * 4
+        self.max_concurrency = max_concurrency if max_concurrency is not None else concurrency * 4
+        self.burst = burst
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.latency_backoff = latency_backoff
+        # the limits grow by a tenth of their initial value for every second of successful requests
+        self.rate_increase = self.rate / 10
+        self.loop = None
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._waiters = deque()
+        self._latency = None
+        self._min_latency = None
+        self._last_decrease = 0.0
+
+    async def acquire(self) -> float:
+        """
+        Wait until a request can be sent to the host.
+
+        Returns the start time of the request, which has to be passed to release once it finished.
+        """
+        while self._in_flight >= int(self.concurrency):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                # a cancelled waiter is still queued
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+        self._in_flight += 1
+
+        delay = self._reserve()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.discard()
+                raise
+
+        return time.monotonic()
+
+    async def release(self, started: float, status: Optional[int] = None, retry_after: Optional[str] = None):
+        """
+        Mark a request as finished and adjust the limits to its outcome.
+
+        :param started: Start time returned by acquire.
+        :param status: HTTP status code of the response, None if the request failed without one.
+        :param retry_after: Retry-After header of the response. (optional)
+        """
+        self._update(time.monotonic() - started, status, retry_after)
+        self.discard()
+
+    def discard(self):
+        """
+        Give the slot of a request back without adjusting the limits, e.g. when it was cancelled.
+        """
+        self._in_flight -= 1
+
+        # every waiter checks the limit again, it may have shrunk in the meantime
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def acquire_sync(self) -> Optional[float]:
+        """
+        Blocking acquire for requests sent from worker threads.
+
+        Returns None without waiting when no event loop is running the limiter, e.g. before the run
+        started or when called from the event loop itself.
+        """
+        if not self._can_block():
+            return None
+
+        return asyncio.run_coroutine_threadsafe(self.acquire(), self.loop).result()
+
+    def release_sync(self, started: Optional[float], status: Optional[int] = None, retry_after: Optional[str] = None):
+        """
+        Release a request acquired with acquire_sync.
+        """
+        if started is None or self.loop is None or self.loop.is_closed():
+            return
+
+        asyncio.run_coroutine_threadsafe(self.release(started, status, retry_after), self.loop).result()
+
+    def _can_block(self) -> bool:
+        if self.loop is None or self.loop.is_closed() or not self.loop.is_running():
+            return False
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return True
+
+        return False
+
+    def _reserve(self) -> float:
+        """
+        Take a token from the bucket and return how long to wait before it can be used.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+
+        delay = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+        return max(delay, self._paused_until - now)
+
+    def _update(self, latency: float, status: Optional[int], retry_after: Optional[str]):
+        if not self.adaptive:
+            return
+
+        now = time.monotonic()
+
+        if status in self.THROTTLED_STATUS_CODES and retry_after:
+            try:
+                self._paused_until = max(self._paused_until, now + float(retry_after))
+            except ValueError:
+                pass
+
+        overloaded = status is None or status in self.THROTTLED_STATUS_CODES
+
+        if not overloaded:
+            # the fastest response creeps up slowly, so a host that got slower for good is not punished forever
+            self._min_latency = latency if self._min_latency is None else min(self._min_latency * 1.01, latency)
+            self._latency = latency if self._latency is None else self._latency * 0.8 + latency * 0.2
+            overloaded = self.latency_backoff and self._latency > self._min_latency * self.latency_tolerance and self._latency > 0.1
+
+        if overloaded:
+            # a burst of failures is one overload, so back off at most once per round trip
+            if now - self._last_decrease < (self._latency or latency):
+                return
+
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.concurrency = max(1.0, self.concurrency / 2)
+            # the slow responses belong to the old limits, measure again from here
+            self._latency = None
+            self.logger.info(f"{self.host} is overloaded (status {status}), backing off to {self.rate:.2f} requests/s with {int(self.concurrency)} in flight.")
+        else:
+            self.rate = min(self.max_rate, self.rate + self.rate_increase / self.rate)
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+from typing import Optional
+from .RateLimiter import RateLimiter
+
+class RateLimits:
+    """
+    Rate limiters of every host the tagger talks to.
+
+    The defaults start well below the published limits of the sites and grow from there, stash is
+    local and starts a lot higher. Hosts without limits of their own get the limits of '*'.
+
+    Stash serves multi-MB image downloads and small GraphQL queries through the same limiter, so
+    how long its responses take says nothing about its load. It only backs off on 429/503 and failures.
+    """
+
+    STASH = "stash"
+
+    DEFAULT_LIMITS = {
+        STASH: {"rate": 50, "concurrency": 8, "latency_backoff": False},
+        "iqdb.org": {"rate": 1, "concurrency": 2},
+        "saucenao.com": {"rate": 0.1, "concurrency": 1},
+        "danbooru.donmai.us": {"rate": 4, "concurrency": 4},
+        "gelbooru.com": {"rate": 2, "concurrency": 2},
+        "konachan.com": {"rate": 2, "concurrency": 2},
+        "yande.re": {"rate": 2, "concurrency": 2},
+        "chan.sankakucomplex.com": {"rate": 1, "concurrency": 2},
+        "*": {"rate": 1, "concurrency": 2},
+    }
+
+    def __init__(self, limits: Optional[dict] = None, adaptive: bool = True):
+        """
+        Construct a new RateLimits object.
+
+        :param limits: RateLimiter options by host, merged over the defaults. (optional)
+        :param adaptive: Adjust the limits to the responses of the hosts, otherwise they stay fixed.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.limits = {host: dict(options) for host, options in self.DEFAULT_LIMITS.items()}
+        self.adaptive = adaptive
+        self.limiters = {}
+        self.loop = None
+
+        for host, options in (limits or {}).items():
+            self.limits.setdefault(host, {}).update(options)
+
+    @staticmethod
+    def load_config(path: str) -> dict:
+        """
+        Load limits from a JSON file, e.g. {"iqdb.org": {"rate": 0.5, "concurrency": 1, "max_rate": 1}}.
+
+        :param path: Path of the config file.
+        """
+        with open(path, 'r') as f:
+            limits = json.load(f)
+
+        if not isinstance(limits, dict) or not all(isinstance(options, dict) for options in limits.values()):
+            raise Exception(f"Invalid rate limit config {path}, expected an object of limits by host.")
+
+        return limits
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[str, dict]:
+        """
+        Parse a limit given as host=rate[:concurrency].
+
+        :param value: Limit to parse.
+        """
+        host, _, limit = value.partition('=')
+        rate, _, concurrency = limit.partition(':')
+
+        try:
+            options = {"rate": float(rate)}
+            if concurrency:
+                options["concurrency"] = int(concurrency)
+        except ValueError:
+            raise Exception(f"Invalid rate limit {value}, expected host=rate[:concurrency].")
+
+        if not host or options["rate"] <= 0:
+            raise Exception(f"Invalid rate limit {value}, expected host=rate[:concurrency].")
+
+        return host, options
+
+    def start(self):
+        """
+        Bind the limiters to the running event loop, so requests from worker threads can wait on them.
+        """
+        self.loop = asyncio.get_running_loop()
+
+        for limiter in self.limiters.values():
+            limiter.loop = self.loop
+
+    def limiter(self, host: str) -> RateLimiter:
+        """
+        Get the limiter of a host, creating it on first use.
+
+        :param host: Host name, or RateLimits.STASH for the stash instance.
+        """
+        limiter = self.limiters.get(host)
+
+        if limiter is None:
+            options = dict(self.limits.get(host, self.limits["*"]))
+            options.setdefault("adaptive", self.adaptive)
+            self.logger.debug(f"Limiting {host} to {options['rate']} requests/s with {options['concurrency']} in flight.")
+
+            limiter = RateLimiter(host, **options)
+            limiter.loop = self.loop
+            self.limiters[host] = limiter
+
+        return limiter
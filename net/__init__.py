@@ -0,0 +1,7 @@
+from .HttpClients import HttpClients
+from .RateLimiter import RateLimiter
+from .RateLimits import RateLimits
+from .RateLimitedTransport import RateLimitedTransport
+from .RateLimitedAdapter import RateLimitedAdapter
+from .HostOverrideTransport import HostOverrideTransport
+from .HookServer import HookServer
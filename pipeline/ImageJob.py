@@ -0,0 +1,61 @@
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Optional
+from booru.Tags import Tags
+from match.MatchResults import MatchResult
+
+@dataclass
+class ImageJob:
+    """
+    Per-image state handed from one pipeline stage to the next.
+    """
+    image: dict
+    image_bytes: Optional[bytes] = None
+    # set when image_bytes holds a thumbnail instead of the original image
+    reduced_image: bool = False
+    matched_image: Optional[MatchResult] = None
+    tags: Optional[Tags] = None
+    tag_ids: list = field(default_factory=list)
+    performer_ids: list = field(default_factory=list)
+    studio_id: Optional[int] = None
+    # stages an earlier, interrupted run already finished for this image
+    completed_stages: set = field(default_factory=set)
+    # batch of images the job was queued for, told when the image is done (optional)
+    work_batch: Optional[Any] = None
+    # watermark of watch mode, told when the image is done (optional)
+    watermark: Optional[Any] = None
+    # time.perf_counter when the job was queued, the trace of the image starts there
+    queued_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def id(self):
+        return self.image['id']
+
+    def checkpoint(self) -> dict:
+        """
+        Intermediate results of the stages finished so far, as something json can serialise.
+        """
+        return {
+            'matched_image': asdict(self.matched_image) if self.matched_image is not None else None,
+            'tags': asdict(self.tags) if self.tags is not None else None,
+            'tag_ids': self.tag_ids,
+            'performer_ids': self.performer_ids,
+            'studio_id': self.studio_id,
+        }
+
+    def restore(self, checkpoint: dict, completed_stages: set):
+        """
+        Pick up the intermediate results of an earlier run.
+
+        :param checkpoint: Intermediate results made by checkpoint.
+        :param completed_stages: Names of the stages those results cover.
+        """
+        if checkpoint.get('matched_image') is not None:
+            self.matched_image = MatchResult(**checkpoint['matched_image'])
+        if checkpoint.get('tags') is not None:
+            self.tags = Tags(**checkpoint['tags'])
+
+        self.tag_ids = checkpoint.get('tag_ids', [])
+        self.performer_ids = checkpoint.get('performer_ids', [])
+        self.studio_id = checkpoint.get('studio_id')
+        self.completed_stages = completed_stages
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, List, Optional, Union
+from metrics import METRICS, TRACER
+from .Stage import Stage
+
+# Marker sent down a queue to tell a worker that no more jobs will follow.
+_DONE = object()
+
+class Pipeline:
+    """
+    Runs jobs through a list of stages connected by bounded queues.
+
+    Every stage has its own pool of workers, so a slow stage only holds up the jobs
+    that are waiting for it while the other stages keep working. The bounded queues
+    apply back pressure all the way to the job source. The time every stage works on
+    a job and the jobs queued for and worked on by every stage are measured, and
+    traced per job when the job has an id.
+    """
+
+    def __init__(self, stages: List[Stage], on_complete: Optional[Callable[[Any], Awaitable[None]]] = None, on_error: Optional[Callable[[Any, Stage, Exception], Awaitable[None]]] = None, on_stage_complete: Optional[Callable[[Any, Stage], Awaitable[None]]] = None, skip: Optional[Callable[[Any, Stage], bool]] = None):
+        """
+        Construct a new Pipeline object.
+
+        :param stages: Stages to run each job through, in order.
+        :param on_complete: Called with each job that made it through every stage. (optional)
+        :param on_error: Called with the job, the stage and the exception when a stage fails. The job is dropped afterwards. (optional)
+        :param on_stage_complete: Called with the job and the stage every time a stage finished a job. (optional)
+        :param skip: Tells whether a job can skip a stage, e.g. because an earlier run already did it. (optional)
+        """
+        if len(stages) == 0:
+            raise Exception("A pipeline needs at least one stage.")
+
+        self.logger = logging.getLogger(__name__)
+        self.stages = stages
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_stage_complete = on_stage_complete
+        self.skip = skip
+
+    async def run(self, jobs: Union[Iterable, AsyncIterable]):
+        """
+        Feed jobs into the pipeline and wait until every job has left it.
+
+        :param jobs: Iterable or async iterable of jobs.
+        """
+        queues = [asyncio.Queue(maxsize=stage.queue_size or stage.workers * 2) for stage in self.stages]
+        for stage, queue in zip(self.stages, queues):
+            METRICS.stage_queued.track(stage.name, function=queue.qsize)
+
+        stage_tasks = [asyncio.create_task(self._run_stage(index, queues)) for index in range(len(self.stages))]
+
+        try:
+            if hasattr(jobs, '__aiter__'):
+                async for job in jobs:
+                    await queues[0].put(job)
+            else:
+                for job in jobs:
+                    await queues[0].put(job)
+        finally:
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(_DONE)
+
+            await asyncio.gather(*stage_tasks)
+
+    async def _run_stage(self, index: int, queues: List[asyncio.Queue]):
+        stage = self.stages[index]
+        next_queue = queues[index + 1] if index + 1 < len(queues) else None
+
+        await asyncio.gather(*[self._worker(stage, queues[index], next_queue) for _ in range(stage.workers)])
+
+        # every worker of this stage has finished, so the next stage can be shut down too
+        if next_queue is not None:
+            for _ in range(self.stages[index + 1].workers):
+                await next_queue.put(_DONE)
+
+    async def _worker(self, stage: Stage, queue: asyncio.Queue, next_queue: Optional[asyncio.Queue]):
+        while True:
+            job = await queue.get()
+            if job is _DONE:
+                return
+
+            if self.skip is None or not self.skip(job, stage):
+                try:
+                    await self._run_handler(stage, job)
+                except Exception as e:
+                    await self._call_hook(self.on_error, job, stage, e)
+                    continue
+
+                await self._call_hook(self.on_stage_complete, job, stage)
+
+            if next_queue is not None:
+                await next_queue.put(job)
+            else:
+                await self._call_hook(self.on_complete, job)
+
+    async def _run_handler(self, stage: Stage, job):
+        METRICS.stage_in_flight.inc(stage.name)
+        started = time.perf_counter()
+        TRACER.set_image(getattr(job, 'id', None))
+
+        try:
+            with TRACER.span(stage.name, 'stage'):
+                await stage.handler(job)
+        finally:
+            METRICS.stage_seconds.observe(stage.name, value=time.perf_counter() - started)
+            METRICS.stage_in_flight.dec(stage.name)
+
+    async def _call_hook(self, hook, *args):
+        if hook is None:
+            return
+
+        # a failing hook must never take a worker down with it, otherwise the pipeline stalls
+        try:
+            await hook(*args)
+        except Exception as e:
+            self.logger.error(f"Pipeline hook failed: {str(e)}")
@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+@dataclass
+class Stage:
+    """
+    A single step of a pipeline.
+
+    :param name: Name of the stage, used for logging.
+    :param handler: Coroutine function called with each job that reaches this stage.
+    :param workers: Number of jobs this stage works on at the same time.
+    :param queue_size: Maximum number of jobs waiting for this stage. (Default workers * 2)
+    """
+    name: str
+    handler: Callable[[Any], Awaitable[None]]
+    workers: int = 1
+    queue_size: int = 0
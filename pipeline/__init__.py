@@ -0,0 +1,3 @@
+from .Stage import Stage
+from .Pipeline import Pipeline
+from .ImageJob import ImageJob
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from typing import Optional
+from booru.Tags import Tags
+from utils import format_tag
+from .StashAPI import StashAPI
+
+class EntityResolver:
+    """
+    Resolves booru tags to stash tag, performer and studio ids.
+
+    Existing entities are loaded once with `load` and looked up in memory by name or alias.
+    Names that are not in memory are looked up in one batched request, and whatever is still
+    missing is created in batched requests. An entity is only created once, however many
+    images ask for it at the same time.
+    """
+
+    def __init__(self, stash_api: StashAPI):
+        """
+        Construct a new EntityResolver object.
+
+        :param stash_api: Stash API used to load and create entities.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.stash_api = stash_api
+        self.tags = {}
+        self.performers = {}
+        self.studios = {}
+        self._pending = {}
+        self._loading = None
+
+    def load(self, page_size: int = 1000):
+        """
+        Load every existing tag, performer and studio from stash into memory.
+
+        :param page_size: Number of entities to fetch per request.
+        """
+        self.logger.info("Loading existing tags, performers and studios from stash...")
+
+        for tag in self.stash_api.get_all_tags(page_size):
+            self._add(self.tags, tag, tag['aliases'])
+
+        for performer in self.stash_api.get_all_performers(page_size):
+            self._add(self.performers, performer, performer['alias_list'])
+
+        for studio in self.stash_api.get_all_studios(page_size):
+            self._add(self.studios, studio, studio['aliases'])
+
+        self.logger.info(f"Loaded {len(self.tags)} tag, {len(self.performers)} performer and {len(self.studios)} studio names.")
+
+    def start_loading(self, page_size: int = 1000):
+        """
+        Run `load` in the background. `resolve` waits for it to finish.
+
+        :param page_size: Number of entities to fetch per request.
+        """
+        self._loading = asyncio.create_task(asyncio.to_thread(self.load, page_size))
+
+    async def resolve(self, tags: Tags):
+        """
+        Find or create the stash entities for a set of booru tags.
+
+        Returns the tag ids, performer ids and studio id (or None) to assign to the image.
+
+        :param tags: Booru tags of the image.
+        """
+        if self._loading is not None:
+            try:
+                await asyncio.shield(self._loading)
+            except Exception as e:
+                # whatever did not make it into the index is looked up on demand instead
+                if self._loading is not None:
+                    self.logger.warning(f"Failed to load tags, performers and studios from stash: {str(e)}")
+                    self._loading = None
+
+        # (formatted name, aliases) for every entity the image needs
+        copyrights = [(format_tag(tag), [tag]) for tag in tags.copyright if tag]
+        characters = [(format_tag(tag), [tag] if tag.lower() != format_tag(tag).lower() else []) for tag in tags.character if tag]
+        artists = [(format_tag(tag), []) for tag in tags.artist if tag and tag not in ['banned_artist']]
+
+        await self._lookup(copyrights, characters, artists)
+
+        # copyright tags have to exist first as performers are tagged and disambiguated with them
+        copyright_tags = await self._create_missing([
+            ('tags', self.tags, copyrights, lambda name, aliases: {'tag_name': name, 'aliases': aliases}),
+        ])
+
+        await self._create_missing([
+            ('performers', self.performers, characters, lambda name, aliases: {
+                'name': name,
+                'disambiguation': copyright_tags[0]['name'] if len(copyright_tags) > 0 else "",
+                'tag_ids': [tag['id'] for tag in copyright_tags],
+                'alias_list': aliases
+            }),
+            ('studios', self.studios, artists, lambda name, aliases: {'studio_name': name}),
+        ])
+
+        performer_ids = [self._find(self.performers, name, aliases)['id'] for name, aliases in characters]
+        studio_ids = [self._find(self.studios, name, aliases)['id'] for name, aliases in artists]
+
+        return [tag['id'] for tag in copyright_tags], performer_ids, studio_ids[0] if len(studio_ids) > 0 else None
+
+    async def _lookup(self, copyrights: list, characters: list, artists: list):
+        # entities created since the index was loaded (or everything when it was not loaded) are found here
+        waits = []
+        lookups = {}
+
+        for kind, index, entries in [('tags', self.tags, copyrights), ('performers', self.performers, characters), ('studios', self.studios, artists)]:
+            lookups[kind] = {}
+            for name, aliases in entries:
+                if self._find(index, name, aliases) is not None or (kind, name.lower()) in self._pending:
+                    continue
+
+                pending_key = ('find', kind, name.lower())
+                future = self._pending.get(pending_key)
+
+                if future is None:
+                    future = asyncio.get_running_loop().create_future()
+                    self._pending[pending_key] = future
+                    lookups[kind][name] = (pending_key, future, index)
+
+                waits.append(future)
+
+        if any(lookups.values()):
+            try:
+                found = await asyncio.to_thread(self.stash_api.find_entities_by_names, *[list(lookups[kind]) for kind in ['tags', 'performers', 'studios']])
+            except Exception as e:
+                for entries in lookups.values():
+                    for pending_key, future, index in entries.values():
+                        self._pending.pop(pending_key, None)
+                        future.set_exception(e)
+            else:
+                # an ambiguous name only fails the images that need it
+                for kind, entries in lookups.items():
+                    for name, (pending_key, future, index) in entries.items():
+                        self._pending.pop(pending_key, None)
+
+                        if len(found[kind][name]) > 1:
+                            future.set_exception(Exception(f"Multiple {kind} found for {name}."))
+                            continue
+                        elif len(found[kind][name]) == 1:
+                            self._add(index, found[kind][name][0], [])
+
+                        future.set_result(None)
+
+        await asyncio.gather(*waits)
+
+    async def _create_missing(self, groups: list):
+        """
+        Create the entities that are still missing and wait for the ones other images are creating.
+
+        Returns the entities of the first group, in order.
+        """
+        waits = []
+        creates = {}
+
+        for kind, index, entries, make_input in groups:
+            creates[kind] = []
+            for name, aliases in entries:
+                if self._find(index, name, aliases) is not None:
+                    continue
+
+                pending_key = (kind, name.lower())
+                future = self._pending.get(pending_key)
+
+                if future is None:
+                    future = asyncio.get_running_loop().create_future()
+                    self._pending[pending_key] = future
+                    creates[kind].append((pending_key, future, index, aliases, make_input(name, aliases)))
+
+                waits.append(future)
+
+        if any(creates.values()):
+            try:
+                created = await asyncio.to_thread(
+                    self.stash_api.create_entities,
+                    **{kind: [input for *_, input in entries] for kind, entries in creates.items()}
+                )
+            except Exception as e:
+                # everyone waiting on these entities gets the error, the next image will try again
+                for entries in creates.values():
+                    for pending_key, future, *_ in entries:
+                        self._pending.pop(pending_key, None)
+                        future.set_exception(e)
+            else:
+                for kind, entries in creates.items():
+                    for (pending_key, future, index, aliases, _), entity in zip(entries, created[kind]):
+                        self._add(index, entity, aliases)
+                        self._pending.pop(pending_key, None)
+                        future.set_result(entity)
+
+        await asyncio.gather(*waits)
+
+        kind, index, entries, _ = groups[0]
+        return [self._find(index, name, aliases) for name, aliases in entries]
+
+    def _find(self, index: dict, name: str, aliases: list[str]) -> Optional[dict]:
+        for key in [name] + aliases:
+            entity = index.get(key.lower())
+            if entity is not None:
+                return entity
+
+        return None
+
+    def _add(self, index: dict, entity: dict, aliases: Optional[list[str]]):
+        entity = {'id': entity['id'], 'name': entity['name']}
+
+        # names always win over aliases of other entities
+        index[entity['name'].lower()] = entity
+        for alias in aliases or []:
+            index.setdefault(alias.lower(), entity)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+from .StashAPI import StashAPI
+
+class ImageUpdateBuffer:
+    """
+    Write-behind buffer for image updates.
+
+    Images that get the same tags, performers and studio are grouped and written in a single request
+    once a group is full or has waited long enough. Within the request images are only written
+    together when they also get the same urls, see StashAPI.bulk_update_images. Callers are told
+    about the outcome of each image only after its group has been written.
+    """
+
+    def __init__(self, stash_api: StashAPI, on_flushed: Callable[[list], Awaitable[None]], on_failed: Callable[[list, Exception], Awaitable[None]], max_size: int = 50, max_delay: float = 5.0):
+        """
+        Construct a new ImageUpdateBuffer object.
+
+        :param stash_api: Stash API used to write the updates.
+        :param on_flushed: Called with the contexts of the images that were written.
+        :param on_failed: Called with the contexts of the images that could not be written and the error.
+        :param max_size: Number of images in a group that triggers a write.
+        :param max_delay: Seconds a group may wait before it is written, more than 0.
+        """
+        # the timer checks the groups every max_delay / 2 seconds, it would never sleep
+        if max_delay <= 0:
+            raise Exception(f"max_delay must be more than 0 seconds, not {max_delay}")
+
+        self.logger = logging.getLogger(__name__)
+        self.stash_api = stash_api
+        self.on_flushed = on_flushed
+        self.on_failed = on_failed
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.groups = {}
+        self._write_lock = asyncio.Lock()
+        self._flushes = set()
+        self._timer = None
+
+    def start(self):
+        """
+        Start writing groups that have waited longer than max_delay in the background.
+        """
+        self._timer = asyncio.create_task(self._flush_expired())
+
+    async def add(self, image_id: int, tag_ids: list[int], performer_ids: list[int], studio_id: Optional[int], urls: list[str], context: Any = None):
+        """
+        Queue an image update.
+
+        :param image_id: Id of the image.
+        :param tag_ids: List of tag ids for the image.
+        :param performer_ids: List of performer ids for the image.
+        :param studio_id: Studio id for the image. (optional)
+        :param urls: List of urls for the image.
+        :param context: Handed back to on_flushed or on_failed once the image has been written.
+        """
+        key = (tuple(sorted(tag_ids)), tuple(sorted(performer_ids)), studio_id)
+        group = self.groups.setdefault(key, {'created': time.monotonic(), 'images': []})
+        group['images'].append((image_id, urls, context))
+
+        if len(group['images']) >= self.max_size:
+            self._start_flush(key)
+
+    async def close(self):
+        """
+        Stop the background timer and write everything that is still buffered.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        for key in list(self.groups):
+            self._start_flush(key)
+
+        await asyncio.gather(*self._flushes)
+
+    async def _flush_expired(self):
+        while True:
+            await asyncio.sleep(self.max_delay / 2)
+
+            now = time.monotonic()
+            for key, group in list(self.groups.items()):
+                if now - group['created'] >= self.max_delay:
+                    self._start_flush(key)
+
+    def _start_flush(self, key):
+        group = self.groups.pop(key)
+        task = asyncio.create_task(self._flush(key, group['images']))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, key, images: list):
+        tag_ids, performer_ids, studio_id = key
+        contexts = [context for _, _, context in images]
+
+        # stash serialises writes anyway, so only one flush is sent at a time
+        async with self._write_lock:
+            self.logger.info(f"Writing tags for {len(images)} images to stash...")
+            try:
+                await asyncio.to_thread(
+                    self.stash_api.bulk_update_images,
+                    [image_id for image_id, _, _ in images],
+                    list(tag_ids),
+                    list(performer_ids),
+                    studio_id,
+                    {image_id: urls for image_id, urls, _ in images}
+                )
+            except Exception as e:
+                await self._call_hook(self.on_failed, contexts, e)
+                return
+
+        await self._call_hook(self.on_flushed, contexts)
+
+    async def _call_hook(self, hook, *args):
+        # a failing hook must not fail the flush, close() would raise out of the cleanup of the run
+        try:
+            await hook(*args)
+        except Exception as e:
+            self.logger.error(f"Image update hook failed: {str(e)}")
@@ -1,20 +1,35 @@
 from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
-from gql.transport.exceptions import TransportQueryError
+from gql.transport.exceptions import TransportQueryError, TransportServerError
 import requests
 import logging
 from .ImageFetchType import ImageFetchType
-from typing import Optional
-from utils import str_list_to_str, int_list_to_str
+from typing import Callable, Optional
+from graphql import build_client_schema
+from utils import SqliteCache, str_list_to_str, int_list_to_str
 import backoff
+from metrics import METRICS, TRACER
+import threading
+import asyncio
 from gql.dsl import DSLQuery, DSLSchema, dsl_gql, DSLMutation, DSLInlineFragment
+from net import RateLimiter, RateLimitedAdapter
+
+# errors of long paged reads that are worth retrying: stash rejected the query, answered with a 5xx or
+# could not be reached. Programming errors such as a bad filter are raised right away.
+PAGE_ERRORS = (TransportQueryError, TransportServerError, requests.exceptions.RequestException)
 
 class StashAPI:
     """
     API wrapper for Stash.
+
+    The schema is introspected by check_api. Stash's schema is large, so it is kept on disk by stash
+    version and build and only introspected again after stash was updated.
     """
+
+    # the key already changes with every stash build, the expiry only clears out old versions
+    SCHEMA_TTL = 90 * 86400
     
-    def __init__(self, url, api_key, username, password):
+    def __init__(self, url, api_key, username, password, rate_limiter: Optional[RateLimiter] = None, schema_cache: Optional[str] = None):
         """
         Construct a new StashAPI object.
 
@@ -22,6 +37,8 @@ class StashAPI:
         :param api_key: API key for the Stash instance.
         :param username: Username for the Stash instance.
         :param password: Password for the Stash instance.
+        :param rate_limiter: Rate limiter every request to the Stash instance waits for. (optional)
+        :param schema_cache: Path of the SQLite database to keep the introspected schema in. (optional)
         """
         self.logger = logging.getLogger(__name__)
         self.url = url
@@ -37,15 +54,19 @@ class StashAPI:
             "username": self.username,
             "password": self.password,
         }
-        self.request_session = requests.Session()
+        self.rate_limiter = rate_limiter
+        self.schema_cache = schema_cache
+        self.request_session = self._mount_rate_limiter(requests.Session())
         self.transport = RequestsHTTPTransport(url=self.graphql_url, headers=self.headers)
-        self.client = Client(transport=self.transport, fetch_schema_from_transport=True)
+        self.client = Client(transport=self.transport)
+        # set by check_api once the schema is known
+        self.ds = None
 
-        with self.client as session:
-            assert self.client.schema is not None
-            self.ds = DSLSchema(self.client.schema)
+        # gql sessions can not be shared between threads, so every thread gets its own.
+        self._local = threading.local()
 
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def add_performer(self, name:str, disambiguation: Optional[str] = None, tag_ids: Optional[list[int]] = None, alias_list: Optional[list[str]] = None):
         """
         Add a performer to stash.
@@ -56,24 +77,10 @@ class StashAPI:
         :param alias_list: List of aliases for the performer. (optional)
 
         """
-        input = {
-            "name": name,
-        }
-        
-        if disambiguation is not None:
-            input["disambiguation"] = disambiguation
-
-        input['tag_ids'] = [self.default_tag_id]
-        if tag_ids is not None:
-            input['tag_ids'].extend(tag_ids)
-
-        if alias_list is not None:
-            input["alias_list"] = alias_list
-
         query = dsl_gql(
             DSLMutation(
                 self.ds.Mutation.performerCreate.args(
-                    input=input
+                    input=self._performer_input(name, disambiguation, tag_ids, alias_list)
                 ).select(
                     self.ds.Performer.id,
                     self.ds.Performer.name
@@ -81,9 +88,10 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
     
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def get_performer_by_name(self, name: str):
         """
         Get a performer by name.
@@ -110,9 +118,10 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
 
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def add_studio(self, studio_name: str):
         """
         Add a studio to stash.
@@ -123,10 +132,7 @@ class StashAPI:
         query = dsl_gql(
             DSLMutation(
                 self.ds.Mutation.studioCreate.args(
-                    input={
-                        "name": studio_name,
-                        "details": "stash-booru-tagger"
-                    }
+                    input=self._studio_input(studio_name)
                 ).select(
                     self.ds.Studio.id,
                     self.ds.Studio.name
@@ -134,9 +140,10 @@ class StashAPI:
             )
         )
         
-        return self.client.execute(query)
+        return self._execute(query)
     
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def get_studio_by_name(self, studio_name: str):
         """
         Get a studio by name.
@@ -163,9 +170,10 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
 
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def add_tag(self, tag_name: str, aliases: Optional[list[str]] = None, parent_ids: Optional[list[int]] = None):
         """
         Add a tag to stash.
@@ -174,21 +182,11 @@ class StashAPI:
         :param aliases: List of aliases for the tag. (optional)
         :param parent_ids: List of parent tag ids for the tag. (optional)
         """
-        
-        input = {
-            "name": tag_name,
-        }
-
-        if aliases is not None:
-            input["aliases"] = aliases
-
-        if parent_ids is not None:
-            input["parent_ids"] = parent_ids
 
         query = dsl_gql(
             DSLMutation(
                 self.ds.Mutation.tagCreate.args(
-                    input=input
+                    input=self._tag_input(tag_name, aliases, parent_ids)
                 ).select(
                     self.ds.Tag.id,
                     self.ds.Tag.name
@@ -196,9 +194,10 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
 
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def get_tag_by_name(self, tag_name: str):
         """
         Get a tag by name.
@@ -225,15 +224,233 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
+
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
+    def find_entities_by_names(self, tag_names: Optional[list[str]] = None, performer_names: Optional[list[str]] = None, studio_names: Optional[list[str]] = None):
+        """
+        Look up tags, performers and studios by name in a single request.
+
+        Returns a dict with "tags", "performers" and "studios" keys, each mapping the requested names to the list of entities with that name.
+
+        :param tag_names: Names of the tags to look up. (optional)
+        :param performer_names: Names of the performers to look up. (optional)
+        :param studio_names: Names of the studios to look up. (optional)
+        """
+        # DSL fields collect the arguments given to them, so every alias needs fields of its own
+        lookups = [
+            ("tags", tag_names or [], "findTags", "tag_filter", lambda: self.ds.FindTagsResultType.tags.select(self.ds.Tag.id, self.ds.Tag.name)),
+            ("performers", performer_names or [], "findPerformers", "performer_filter", lambda: self.ds.FindPerformersResultType.performers.select(self.ds.Performer.id, self.ds.Performer.name)),
+            ("studios", studio_names or [], "findStudios", "studio_filter", lambda: self.ds.FindStudiosResultType.studios.select(self.ds.Studio.id, self.ds.Studio.name)),
+        ]
+
+        fields = []
+        for kind, names, find_name, filter_name, list_field in lookups:
+            for i, name in enumerate(names):
+                fields.append(
+                    getattr(self.ds.Query, find_name).alias(f"{kind}{i}").args(
+                        **{
+                            filter_name: {
+                                "name": {
+                                    "value": name,
+                                    "modifier": "EQUALS"
+                                }
+                            }
+                        }
+                    ).select(
+                        list_field()
+                    )
+                )
+
+        entities = {kind: {} for kind, *_ in lookups}
+        if len(fields) == 0:
+            return entities
+
+        result = self._execute(dsl_gql(DSLQuery(*fields)))
+
+        for kind, names, *_ in lookups:
+            for i, name in enumerate(names):
+                entities[kind][name] = result[f"{kind}{i}"][kind]
+
+        return entities
+
+    @TRACER.traced('stash')
+    def create_entities(self, tags: Optional[list[dict]] = None, performers: Optional[list[dict]] = None, studios: Optional[list[dict]] = None):
+        """
+        Create tags, performers and studios in a single request.
+
+        Returns a dict with "tags", "performers" and "studios" keys, each holding the created entities in the order they were given.
+        Not retried on failure, as a partially applied request would otherwise create duplicates.
+
+        :param tags: Keyword arguments for `add_tag`, one dict per tag. (optional)
+        :param performers: Keyword arguments for `add_performer`, one dict per performer. (optional)
+        :param studios: Keyword arguments for `add_studio`, one dict per studio. (optional)
+        """
+        # DSL fields collect the arguments given to them, so every alias needs a field of its own
+        creates = [
+            ("tags", [self._tag_input(**tag) for tag in tags or []], "tagCreate", (self.ds.Tag.id, self.ds.Tag.name)),
+            ("performers", [self._performer_input(**performer) for performer in performers or []], "performerCreate", (self.ds.Performer.id, self.ds.Performer.name)),
+            ("studios", [self._studio_input(**studio) for studio in studios or []], "studioCreate", (self.ds.Studio.id, self.ds.Studio.name)),
+        ]
+
+        fields = []
+        for kind, inputs, create_name, selection in creates:
+            for i, input in enumerate(inputs):
+                fields.append(
+                    getattr(self.ds.Mutation, create_name).alias(f"{kind}{i}").args(
+                        input=input
+                    ).select(
+                        *selection
+                    )
+                )
+
+        entities = {kind: [] for kind, *_ in creates}
+        if len(fields) == 0:
+            return entities
+
+        result = self._execute(dsl_gql(DSLMutation(*fields)))
+
+        for kind, inputs, *_ in creates:
+            entities[kind] = [result[f"{kind}{i}"] for i in range(len(inputs))]
+
+        return entities
+
+    def get_all_tags(self, page_size: int = 1000):
+        """
+        Get every tag in stash, one page at a time.
+
+        :param page_size: Number of tags to fetch per request.
+        """
+        return self._find_all(
+            self.ds.Query.findTags,
+            self.ds.FindTagsResultType.count,
+            self.ds.FindTagsResultType.tags.select(
+                self.ds.Tag.id,
+                self.ds.Tag.name,
+                self.ds.Tag.aliases
+            ),
+            'findTags',
+            'tags',
+            page_size
+        )
+
+    def get_all_performers(self, page_size: int = 1000):
+        """
+        Get every performer in stash, one page at a time.
+
+        :param page_size: Number of performers to fetch per request.
+        """
+        return self._find_all(
+            self.ds.Query.findPerformers,
+            self.ds.FindPerformersResultType.count,
+            self.ds.FindPerformersResultType.performers.select(
+                self.ds.Performer.id,
+                self.ds.Performer.name,
+                self.ds.Performer.alias_list
+            ),
+            'findPerformers',
+            'performers',
+            page_size
+        )
+
+    def get_all_studios(self, page_size: int = 1000):
+        """
+        Get every studio in stash, one page at a time.
+
+        :param page_size: Number of studios to fetch per request.
+        """
+        return self._find_all(
+            self.ds.Query.findStudios,
+            self.ds.FindStudiosResultType.count,
+            self.ds.FindStudiosResultType.studios.select(
+                self.ds.Studio.id,
+                self.ds.Studio.name,
+                self.ds.Studio.aliases
+            ),
+            'findStudios',
+            'studios',
+            page_size
+        )
+
+    def _performer_input(self, name: str, disambiguation: Optional[str] = None, tag_ids: Optional[list[int]] = None, alias_list: Optional[list[str]] = None):
+        input = {
+            "name": name,
+        }
+        
+        if disambiguation is not None:
+            input["disambiguation"] = disambiguation
+
+        input['tag_ids'] = [self.default_tag_id]
+        if tag_ids is not None:
+            input['tag_ids'].extend(tag_ids)
+
+        if alias_list is not None:
+            input["alias_list"] = alias_list
 
-    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3)
+        return input
+
+    def _studio_input(self, studio_name: str):
+        return {
+            "name": studio_name,
+            "details": "stash-booru-tagger"
+        }
+
+    def _tag_input(self, tag_name: str, aliases: Optional[list[str]] = None, parent_ids: Optional[list[int]] = None):
+        input = {
+            "name": tag_name,
+        }
+
+        if aliases is not None:
+            input["aliases"] = aliases
+
+        if parent_ids is not None:
+            input["parent_ids"] = parent_ids
+
+        return input
+
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
+    def _find_page(self, find_field, count_field, list_field, page: int, page_size: int):
+        query = dsl_gql(
+            DSLQuery(
+                find_field.args(
+                    filter={
+                        "page": page,
+                        "per_page": page_size,
+                        "sort": "id",
+                        "direction": "ASC"
+                    }
+                ).select(
+                    count_field,
+                    list_field
+                )
+            )
+        )
+
+        return self._execute(query)
+
+    def _find_all(self, find_field, count_field, list_field, result_name: str, list_name: str, page_size: int):
+        items = []
+        page = 1
+
+        while True:
+            result = self._find_page(find_field, count_field, list_field, page, page_size)[result_name]
+            items.extend(result[list_name])
+
+            if len(result[list_name]) == 0 or len(items) >= result['count']:
+                return items
+
+            page += 1
+
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
     def update_image(self, image_id: int, tag_ids: Optional[list[int]] = None, performer_ids: Optional[list[int]] = None, studio_id: Optional[int] = None, urls: Optional[list[str]] = None):
         """
         Update an image in stash.
 
         :param image_id: Id of the image.
-        :param tag_ids: List of tag ids for the image. (optional)
+        :param tag_ids: List of tag ids for the image. The stash-booru-tagger tag is always added. (optional)
         :param performer_ids: List of performer ids for the image. (optional)
         :param studio_id: Studio id for the image. (optional)
         :param urls: List of urls for the image. (optional)
@@ -243,8 +460,10 @@ class StashAPI:
             "id": image_id
         }
 
+        # the default tag marks the image as tagged, see get_images(exclude_tagged=True)
+        input["tag_ids"] = [self.default_tag_id]
         if tag_ids is not None:
-            input["tag_ids"] = tag_ids
+            input["tag_ids"].extend(tag_ids)
 
         if performer_ids is not None:
             input["performer_ids"] = performer_ids
@@ -265,8 +484,120 @@ class StashAPI:
             )
         )
 
-        return self.client.execute(query)
+        return self._execute(query)
+
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, TransportQueryError, max_tries=3, on_backoff=METRICS.count_retry)
+    def bulk_update_images(self, image_ids: list[int], tag_ids: Optional[list[int]] = None, performer_ids: Optional[list[int]] = None, studio_id: Optional[int] = None, image_urls: Optional[dict] = None):
+        """
+        Give many images the same tags, performers and studio in a single request.
+
+        The urls are set in the same bulkImageUpdate, so images with the same urls, e.g. near-duplicates
+        matched to the same post, are written together. Stash writes every mutation of the request on
+        its own, so images with urls of their own still cost one write each.
+
+        :param image_ids: Ids of the images.
+        :param tag_ids: List of tag ids for the images. The stash-booru-tagger tag is always added. (optional)
+        :param performer_ids: List of performer ids for the images. (optional)
+        :param studio_id: Studio id for the images. (optional)
+        :param image_urls: Dict of image id to the list of urls for that image. (optional)
+        """
+
+        image_urls = image_urls or {}
+
+        # one bulkImageUpdate for every distinct list of urls, images without urls keep theirs
+        groups = {}
+        for image_id in image_ids:
+            urls = image_urls.get(image_id)
+            groups.setdefault(tuple(urls) if urls is not None else None, []).append(image_id)
+
+        fields = []
+        for i, (urls, ids) in enumerate(groups.items()):
+            input = {
+                "ids": ids
+            }
+
+            # the default tag marks the image as tagged, see get_images(exclude_tagged=True)
+            input["tag_ids"] = {
+                "ids": [self.default_tag_id] + (tag_ids or []),
+                "mode": "SET"
+            }
+
+            if performer_ids is not None:
+                input["performer_ids"] = {
+                    "ids": performer_ids,
+                    "mode": "SET"
+                }
+
+            if studio_id is not None:
+                input["studio_id"] = studio_id
+
+            if urls is not None:
+                input["urls"] = {
+                    "values": list(urls),
+                    "mode": "SET"
+                }
+
+            fields.append(
+                self.ds.Mutation.bulkImageUpdate.alias(f"update{i}").args(
+                    input=input
+                ).select(
+                    self.ds.Image.id
+                )
+            )
+
+        return self._execute(dsl_gql(DSLMutation(*fields)))
+
+    def _load_schema(self, session, version: dict):
+        """
+        Load the schema of this stash build from the cache, or introspect it and cache it.
+
+        :param session: Open session of the client.
+        :param version: Version and build hash of stash, as returned by the version query.
+        """
+        cache = SqliteCache(self.schema_cache, 'stash_schema') if self.schema_cache is not None else None
+        key = f"{self.graphql_url} {version.get('version')} {version.get('hash')}"
+
+        try:
+            introspection = cache.get(key) if cache is not None else None
+
+            if introspection is not None:
+                self.logger.debug(f"Using the cached schema of stash {version.get('version')}.")
+                self.client.introspection = introspection
+                self.client.schema = build_client_schema(introspection)
+            else:
+                self.logger.debug(f"Introspecting the schema of stash {version.get('version')}...")
+                session.fetch_schema()
+
+                if cache is not None:
+                    cache.put(key, self.client.introspection, self.SCHEMA_TTL)
+                    cache.purge_expired()
+        finally:
+            if cache is not None:
+                cache.close()
+
+        self.ds = DSLSchema(self.client.schema)
+
+    def _execute(self, query):
+        session = getattr(self._local, 'session', None)
 
+        if session is None:
+            client = Client(transport=RequestsHTTPTransport(url=self.graphql_url, headers=self.headers), schema=self.client.schema)
+            session = client.connect_sync()
+            self._mount_rate_limiter(client.transport.session)
+            self._local.session = session
+
+        return session.execute(query)
+
+    def _mount_rate_limiter(self, session: requests.Session):
+        if self.rate_limiter is not None:
+            adapter = RateLimitedAdapter(self.rate_limiter)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+        return session
+
+    @TRACER.traced('stash')
     def load_image(self, image_url: str):
         """
         Downloads an image from stash.
@@ -282,136 +613,226 @@ class StashAPI:
         
         return image_dl_response.content
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3)
-    def get_images(self, type: ImageFetchType, id: Optional[int] = None):
+    async def get_images(self, type: ImageFetchType, id: Optional[int] = None, page_size: int = 100, on_count: Optional[Callable[[int], None]] = None, exclude_tagged: bool = False, created_after: Optional[str] = None, updated_after: Optional[str] = None, image_filter: Optional[dict] = None, include_fingerprints: bool = False, id_range: Optional[tuple[int, int]] = None):
         """
-        Fetch images from stash.
-        
+        Fetch images from stash, one page at a time.
+
+        This is an async generator. The next page is requested while the current one is being consumed,
+        so only about two pages are ever held in memory.
+
         :param type: Type of image fetch.
         :param id: Id of the image gallery or single image. (optional)
+        :param page_size: Number of images to fetch per request.
+        :param on_count: Called with the total number of matching images once the first page has arrived. (optional)
+        :param exclude_tagged: Skip images that already have the stash-booru-tagger tag. (optional)
+        :param created_after: Only fetch images created after this timestamp. (optional)
+        :param updated_after: Only fetch images updated after this timestamp. (optional)
+        :param image_filter: Extra ImageFilterType criteria the images have to match. (optional)
+        :param include_fingerprints: Also fetch the fingerprints (e.g. phash) stash computed for the image files. (optional)
+        :param id_range: Only fetch images with an id from the first up to, but not including, the second. (optional)
         """
         match type:
             case ImageFetchType.ALL_IMAGES:
-                return self._get_all_images()
+                self.logger.info("Fetching all images...")
+                fetch_filter = {}
             case ImageFetchType.IMAGE_GALLERY:
                 if id is None:
                     raise Exception("Image gallery id required for fetching image gallery.")
-                return self._get_image_gallery(id)
+                fetch_filter = {
+                    "galleries": {
+                        "value": id,
+                        "modifier": "INCLUDES"
+                    }
+                }
             case ImageFetchType.SINGLE_IMAGE:
                 if id is None:
                     raise Exception("Image id required for fetching single image.")
-                return self._get_single_image(id)
+                fetch_filter = {
+                    "id": {
+                        "value": id,
+                        "modifier": "EQUALS"
+                    }
+                }
             case other:
                 raise Exception(f"Invalid image fetch type: {type}")
-            
-    def _get_all_images(self):
-        self.logger.info("Fetching all images...")
 
-        query = dsl_gql(
-            DSLQuery(
-                self.ds.Query.findImages.args(
-                    filter={
-                        "per_page": -1
-                    }
-                ).select(
-                    self.ds.FindImagesResultType.count,
-                    self.ds.FindImagesResultType.images.select(
-                        self.ds.Image.id,
-                        self.ds.Image.paths.select(
-                            self.ds.ImagePathsType.image
+        # let stash skip the images it does not need to send instead of filtering them out here
+        filters = [fetch_filter, image_filter]
+
+        if exclude_tagged:
+            filters.append({
+                "tags": {
+                    "value": [self.default_tag_id],
+                    "modifier": "EXCLUDES"
+                }
+            })
+
+        if created_after is not None:
+            filters.append({
+                "created_at": {
+                    "value": created_after,
+                    "modifier": "GREATER_THAN"
+                }
+            })
+
+        if updated_after is not None:
+            filters.append({
+                "updated_at": {
+                    "value": updated_after,
+                    "modifier": "GREATER_THAN"
+                }
+            })
+
+        if id_range is not None:
+            filters.append({
+                "id": {
+                    "value": id_range[0],
+                    "value2": id_range[1] - 1,
+                    "modifier": "BETWEEN"
+                }
+            })
+
+        image_filter = self._and_filters(filters)
+
+        # pages are walked by id rather than by page number so images changing underneath us are never skipped
+        paginate = type != ImageFetchType.SINGLE_IMAGE
+        next_page = asyncio.create_task(asyncio.to_thread(self._get_images_page, image_filter, 0 if paginate else None, page_size, include_fingerprints))
+
+        try:
+            result = await next_page
+            if on_count is not None:
+                on_count(result['count'])
+
+            while True:
+                images = result['images']
+
+                if not paginate or len(images) < page_size:
+                    for image in images:
+                        yield image
+                    return
+
+                next_page = asyncio.create_task(asyncio.to_thread(self._get_images_page, image_filter, int(images[-1]['id']), page_size, include_fingerprints))
+                for image in images:
+                    yield image
+
+                result = await next_page
+        finally:
+            next_page.cancel()
+
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, PAGE_ERRORS, max_tries=3, on_backoff=METRICS.count_retry)
+    def _get_images_page(self, image_filter: dict, after_id: Optional[int], page_size: int, include_fingerprints: bool = False):
+        if after_id is not None:
+            image_filter = self._and_filters([image_filter, {
+                "id": {
+                    "value": after_id,
+                    "modifier": "GREATER_THAN"
+                }
+            }])
+
+        image_fields = [
+            self.ds.Image.id,
+            self.ds.Image.created_at,
+            self.ds.Image.paths.select(
+                self.ds.ImagePathsType.image,
+                self.ds.ImagePathsType.thumbnail
+            )
+        ]
+
+        if include_fingerprints:
+            image_fields.append(
+                self.ds.Image.visual_files.select(
+                    DSLInlineFragment().on(self.ds.ImageFile).select(
+                        self.ds.ImageFile.fingerprints.select(
+                            self.ds.Fingerprint.type,
+                            self.ds.Fingerprint.value
                         )
                     )
                 )
             )
-        )
-
-        result = self.client.execute(query)
-        return result['findImages']['images']
-    
-    def _get_image_gallery(self, gallery_id: int):
 
         query = dsl_gql(
             DSLQuery(
                 self.ds.Query.findImages.args(
-                    image_filter={
-                        "galleries": {
-                            "value": gallery_id,
-                            "modifier": "INCLUDES"
-                        }
-                    },
+                    image_filter=image_filter,
                     filter={
-                        "per_page": -1
+                        "per_page": page_size,
+                        "sort": "id",
+                        "direction": "ASC"
                     }
                 ).select(
                     self.ds.FindImagesResultType.count,
                     self.ds.FindImagesResultType.images.select(
-                        self.ds.Image.id,
-                        self.ds.Image.paths.select(
-                            self.ds.ImagePathsType.image
-                        )
+                        *image_fields
                     )
                 )
             )
         )
 
-        result = self.client.execute(query)
-        return result['findImages']['images']
-    
-    def _get_single_image(self, image_id: int):
+        return self._execute(query)['findImages']
 
+    @TRACER.traced('stash')
+    @backoff.on_exception(backoff.expo, PAGE_ERRORS, max_tries=3, on_backoff=METRICS.count_retry)
+    def get_max_image_id(self) -> int:
+        """
+        Get the highest image id in stash, or 0 if there are no images.
+        """
         query = dsl_gql(
             DSLQuery(
                 self.ds.Query.findImages.args(
-                    image_filter={
-                        "id": {
-                            "value": image_id,
-                            "modifier": "EQUALS"
-                        }
-                    },
                     filter={
-                        "per_page": -1
+                        "per_page": 1,
+                        "sort": "id",
+                        "direction": "DESC"
                     }
                 ).select(
-                    self.ds.FindImagesResultType.count,
                     self.ds.FindImagesResultType.images.select(
-                        self.ds.Image.id,
-                        self.ds.Image.paths.select(
-                            self.ds.ImagePathsType.image
-                        )
+                        self.ds.Image.id
                     )
                 )
             )
         )
 
-        result = self.client.execute(query)
-        return result['findImages']['images']
-    
+        images = self._execute(query)['findImages']['images']
+        return int(images[0]['id']) if len(images) > 0 else 0
+
+    def _and_filters(self, filters: list[Optional[dict]]):
+        combined = {}
+
+        for image_filter in filters:
+            if not image_filter:
+                continue
+
+            # criteria on the same field can not share one filter object, so they are chained with AND
+            if combined.keys() & image_filter.keys():
+                combined = {**combined, "AND": self._and_filters([combined.get("AND"), image_filter])}
+            else:
+                combined = {**combined, **image_filter}
+
+        return combined
+
     def create_default_tag(self):
         tag = self.get_tag_by_name("stash-booru-tagger")
 
         if tag['findTags']['count'] == 0:
-            tag = self.add_default_tag("stash-booru-tagger", [])
-            return tag['id']
+            tag = self.add_tag("stash-booru-tagger")
+            return tag['tagCreate']['id']
         else:
             return tag['findTags']['tags'][0]['id']
     
+    @TRACER.traced('stash')
     def check_api(self):
         self.logger.info("Checking API...")
 
-        query = dsl_gql(
-            DSLQuery(
-                self.ds.Query.version.select(
-                    self.ds.Version.version
-                )
-            )
-        )
-
-        result = self.client.execute(query)
-        self.logger.debug(f"API version: {result['version']['version']}")
+        # the version is queried without the schema, it tells which schema to load
+        with self.client as session:
+            version = session.execute(gql("query { version { version hash } }"))['version']
+            self.logger.debug(f"API version: {version['version']}")
+            self._load_schema(session, version)
 
         self.default_tag_id = self.create_default_tag()
 
-        self.request_session = requests.Session()
+        self.request_session = self._mount_rate_limiter(requests.Session())
         stash_login_response = self.request_session.post(self.login_url, data=self.login_data)
         if stash_login_response.status_code != 200:
             raise Exception(f"Failed to login to stash. Status code: {stash_login_response.status_code}")
@@ -1,2 +1,4 @@
 from .StashAPI import StashAPI
-from .ImageFetchType import ImageFetchType
\ No newline at end of file
+from .ImageFetchType import ImageFetchType
+from .EntityResolver import EntityResolver
+from .ImageUpdateBuffer import ImageUpdateBuffer
\ No newline at end of file
@@ -0,0 +1,188 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+# Marker that tells the writer thread to commit what it has and stop.
+_STOP = object()
+
+class RunState:
+    """
+    Keeps track of which images have been processed and which have failed, and journals the
+    stages images in progress have finished so an interrupted run can resume them. Watch mode also
+    keeps the watermark it polls stash from here.
+
+    Both sets of image ids and the journal are loaded into memory when the state is opened, so
+    checks never touch the database. Writes are handed to a dedicated writer thread that commits them in
+    batches, instead of one transaction per image.
+    """
+
+    def __init__(self, path: str = 'tagger.db', commit_interval: float = 1.0, max_batch: int = 1000):
+        """
+        Open the run state stored in a SQLite database.
+
+        :param path: Path of the SQLite database.
+        :param commit_interval: Seconds the writer collects writes before committing them.
+        :param max_batch: Number of writes that are committed at once at most.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+
+        con = self._connect()
+        self._create_tables(con)
+
+        self.processed = set()
+        self.failed = set()
+        for image_id, failed in con.execute('SELECT id, 0 FROM processed_images UNION ALL SELECT id, 1 FROM failed_images'):
+            (self.failed if failed else self.processed).add(image_id)
+
+        # only images that are in progress or failed have a journal entry, so it stays small
+        self.journal = {}
+        for image_id, stage, data in con.execute('SELECT id, stage, data FROM image_journal'):
+            self.journal[image_id] = (stage, json.loads(data))
+
+        self.watermarks = dict(con.execute('SELECT name, value FROM watermarks'))
+        con.close()
+
+        self.logger.debug(f"Loaded {len(self.processed)} processed and {len(self.failed)} failed images, {len(self.journal)} images can be resumed.")
+
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='run-state-writer', daemon=True)
+        self._writer.start()
+
+    def image_is_processed(self, image_id) -> bool:
+        return int(image_id) in self.processed
+
+    def image_is_failed(self, image_id) -> bool:
+        return int(image_id) in self.failed
+
+    def add_processed_image(self, image_id):
+        self.processed.add(int(image_id))
+        self._writes.put(('INSERT OR IGNORE INTO processed_images (id) VALUES (?)', (int(image_id),)))
+        self.delete_journal(image_id)
+
+    def add_failed_image(self, image_id, reason: str = None):
+        self.failed.add(int(image_id))
+        self._writes.put(('INSERT OR REPLACE INTO failed_images (id, reason) VALUES (?, ?)', (int(image_id), reason)))
+
+    def delete_processed_image(self, image_id):
+        self.processed.discard(int(image_id))
+        self._writes.put(('DELETE FROM processed_images WHERE id = ?', (int(image_id),)))
+
+    def delete_failed_image(self, image_id):
+        self.failed.discard(int(image_id))
+        self._writes.put(('DELETE FROM failed_images WHERE id = ?', (int(image_id),)))
+
+    def get_journal(self, image_id):
+        """
+        Get the last stage an earlier run finished for an image and the results it had by then, or None.
+
+        :param image_id: Id of the image.
+        """
+        return self.journal.get(int(image_id))
+
+    def add_journal(self, image_id, stage: str, data: dict):
+        """
+        Record that a stage finished for an image.
+
+        :param image_id: Id of the image.
+        :param stage: Name of the stage.
+        :param data: Results of the image so far, anything json can serialise.
+        """
+        self.journal[int(image_id)] = (stage, data)
+        self._writes.put(('INSERT OR REPLACE INTO image_journal (id, stage, data, updated_at) VALUES (?, ?, ?, ?)', (int(image_id), stage, json.dumps(data), time.time())))
+
+    def delete_journal(self, image_id):
+        if self.journal.pop(int(image_id), None) is not None:
+            self._writes.put(('DELETE FROM image_journal WHERE id = ?', (int(image_id),)))
+
+    def get_watermark(self, name: str):
+        """
+        Get a watermark a previous run left, or None.
+
+        :param name: Name of the watermark.
+        """
+        return self.watermarks.get(name)
+
+    def set_watermark(self, name: str, value: str):
+        self.watermarks[name] = value
+        self._writes.put(('INSERT OR REPLACE INTO watermarks (name, value) VALUES (?, ?)', (name, value)))
+
+    def close(self):
+        """
+        Commit every outstanding write and stop the writer thread.
+        """
+        self._writes.put(_STOP)
+        self._writer.join()
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL lets readers carry on while the writer commits, NORMAL only syncs on checkpoints
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        con.execute('PRAGMA busy_timeout=5000')
+        return con
+
+    def _create_tables(self, con):
+        # create the tables if they don't exist
+        con.execute('''
+            CREATE TABLE IF NOT EXISTS processed_images (
+                id INTEGER PRIMARY KEY
+            );
+        ''')
+
+        con.execute('''
+            CREATE TABLE IF NOT EXISTS failed_images (
+                id INTEGER PRIMARY KEY,
+                reason TEXT
+            );
+        ''')
+
+        con.execute('''
+            CREATE TABLE IF NOT EXISTS image_journal (
+                id INTEGER PRIMARY KEY,
+                stage TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''')
+
+        con.execute('''
+            CREATE TABLE IF NOT EXISTS watermarks (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+
+        con.commit()
+
+    def _write_loop(self):
+        con = self._connect()
+        stopping = False
+
+        while not stopping:
+            writes = [self._writes.get()]
+            deadline = time.monotonic() + self.commit_interval
+
+            while len(writes) < self.max_batch and writes[-1] is not _STOP:
+                try:
+                    writes.append(self._writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            if writes[-1] is _STOP:
+                stopping = True
+                writes.pop()
+
+            try:
+                with con:
+                    for write in writes:
+                        con.execute(*write)
+            except sqlite3.Error as e:
+                self.logger.warning(f"Unable to keep track of {len(writes)} images: {str(e)}")
+
+        con.close()
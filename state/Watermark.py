@@ -0,0 +1,75 @@
+from datetime import datetime
+from typing import Callable, Optional
+
+class Watermark:
+    """
+    Creation time in stash up to which every image has been processed or has failed.
+
+    Images are polled from stash by id, so they do not arrive in the order they were created.
+    The watermark only moves past an image once it is done and no image created before it is
+    still in progress, and not at all while a poll is still queuing images. Images created at
+    the same time as one still in progress stay behind the watermark, so polling images created
+    after it never skips one, even after a restart.
+    """
+
+    def __init__(self, value: Optional[str] = None, on_advance: Optional[Callable[[str], None]] = None):
+        """
+        Construct a new Watermark object.
+
+        :param value: Timestamp to start from, as stash formats it, or None to start with every image. (optional)
+        :param on_advance: Called with the new timestamp every time the watermark moves. (optional)
+        """
+        self.value = value
+        self.on_advance = on_advance
+        self.polling = False
+        # image id -> [created at, timestamp as stash sent it, done]
+        self.images = {}
+
+    def is_tracked(self, image_id) -> bool:
+        """
+        Whether an image has been queued and is still ahead of the watermark.
+        """
+        return int(image_id) in self.images
+
+    def add_image(self, image_id, created_at: str, done: bool = False):
+        self.images[int(image_id)] = [self._parse(created_at), created_at, done]
+
+    def finish_image(self, image_id):
+        image = self.images.get(int(image_id))
+
+        if image is not None:
+            image[2] = True
+            self._advance()
+
+    def start_polling(self):
+        self.polling = True
+
+    def finish_polling(self):
+        self.polling = False
+        self._advance()
+
+    def _advance(self):
+        # a poll that is still queuing can yet bring images created before the ones that are done
+        if self.polling or len(self.images) == 0:
+            return
+
+        pending = [created for created, _, done in self.images.values() if not done]
+        limit = min(pending) if len(pending) > 0 else None
+        passed = [image_id for image_id, (created, _, done) in self.images.items() if done and (limit is None or created < limit)]
+
+        if len(passed) == 0:
+            return
+
+        newest = max((self.images.pop(image_id) for image_id in passed), key=lambda image: image[0])
+
+        if self.value is None or newest[0] > self._parse(self.value):
+            self.value = newest[1]
+
+            if self.on_advance is not None:
+                self.on_advance(self.value)
+
+    @staticmethod
+    def _parse(timestamp: str) -> datetime:
+        # stash sends RFC 3339 timestamps, a watermark given by hand may be a date in local time
+        value = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        return value if value.tzinfo is not None else value.astimezone()
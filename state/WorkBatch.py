@@ -0,0 +1,40 @@
+from typing import Callable, Optional
+
+class WorkBatch:
+    """
+    A range of image ids worked on as one unit, or every image when the range is None.
+
+    The batch is done once all of its images have been queued and every queued image has been
+    processed or has failed.
+    """
+
+    def __init__(self, id_range: Optional[tuple[int, int]] = None, on_done: Optional[Callable[['WorkBatch'], None]] = None):
+        """
+        Construct a new WorkBatch object.
+
+        :param id_range: First image id of the batch and the first id after it. (optional)
+        :param on_done: Called with the batch once it is done. (optional)
+        """
+        self.id_range = id_range
+        self.on_done = on_done
+        self.pending = 0
+        self.queued = False
+
+    def start_image(self):
+        self.pending += 1
+
+    def finish_image(self):
+        self.pending -= 1
+        self._check_done()
+
+    def finish_queueing(self):
+        self.queued = True
+        self._check_done()
+
+    def _check_done(self):
+        if self.queued and self.pending == 0 and self.on_done is not None:
+            on_done, self.on_done = self.on_done, None
+            on_done(self)
+
+    def __str__(self) -> str:
+        return "all images" if self.id_range is None else f"images {self.id_range[0]}-{self.id_range[1] - 1}"
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+class WorkStore:
+    """
+    Work queue shared by several tagger processes, made of batches of image ids in a SQLite database.
+
+    A worker claims a batch under a lease, renews the lease while it works on the batch and marks
+    the batch done afterwards. A batch the worker failed on is released to the others and not
+    claimed by it again. Batches of workers that stopped are released, or picked up by another
+    worker once their lease ran out.
+
+    Every worker writes to the same database, so a call can wait up to the busy timeout for the
+    others. The calls run on a thread of their own, one at a time, and never hold up the event loop.
+    """
+
+    def __init__(self, path: str, worker_id: str, batch_size: int = 1000, lease_seconds: float = 300, shard: Optional[tuple[int, int]] = None):
+        """
+        Open the work store, creating its table if needed.
+
+        :param path: Path of the SQLite database every worker uses.
+        :param worker_id: Name of this worker, unique between the workers.
+        :param batch_size: Number of image ids in a batch.
+        :param lease_seconds: Seconds a claimed batch stays with this worker without being renewed.
+        :param shard: Only claim the batches of shard index out of count. (optional)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.shard = shard
+        self._renewer = None
+        self._released = set()
+        self._thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='work-store')
+
+        # transactions are started by hand, so a claim can take the write lock up front. After this
+        # the connection is only used from the work store thread.
+        self.con = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA busy_timeout=30000')
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS work_batches (
+                start_id INTEGER PRIMARY KEY,
+                end_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_expires REAL,
+                claims INTEGER NOT NULL DEFAULT 0
+            );
+        ''')
+
+    async def add_batches(self, max_id: int):
+        """
+        Add the batches up to an image id that are not in the store yet.
+
+        :param max_id: Highest image id to cover.
+        """
+        await self._run(self._add_batches, max_id)
+
+    async def claim(self) -> Optional[tuple[int, int]]:
+        """
+        Claim a pending batch or one whose lease ran out, returns its id range or None if there is none.
+        """
+        return await self._run(self._claim)
+
+    async def is_finished(self) -> bool:
+        """
+        Whether every batch is done or left to the other workers, otherwise other workers still hold some of them.
+        """
+        return await self._run(self._is_finished)
+
+    def complete(self, start_id: int):
+        """
+        Mark a batch done. The update is written in the background, after the calls made before it.
+
+        :param start_id: First image id of the batch.
+        """
+        self._thread.submit(self._complete, start_id).add_done_callback(self._log_failure)
+
+    def release(self, start_id: int):
+        """
+        Hand a batch back to the other workers, this worker does not claim it again. The update is
+        written in the background, after the calls made before it.
+
+        :param start_id: First image id of the batch.
+        """
+        self._released.add(start_id)
+        self._thread.submit(self._release, start_id).add_done_callback(self._log_failure)
+
+    async def renew(self):
+        """
+        Extend the leases of every batch this worker holds.
+        """
+        await self._run(self._renew)
+
+    def start(self):
+        """
+        Renew the leases in the background until the store is closed.
+        """
+        self._renewer = asyncio.create_task(self._renew_leases())
+
+    async def close(self):
+        """
+        Stop renewing and hand the batches this worker did not finish back to the other workers.
+        """
+        if self._renewer is not None:
+            self._renewer.cancel()
+            self._renewer = None
+
+        try:
+            await self._run(self._close)
+        finally:
+            self._thread.shutdown(wait=False)
+
+    def _add_batches(self, max_id: int):
+        with self._transaction():
+            self.con.executemany(
+                'INSERT OR IGNORE INTO work_batches (start_id, end_id) VALUES (?, ?)',
+                ((start, start + self.batch_size) for start in range(0, max_id + 1, self.batch_size))
+            )
+
+    def _claim(self) -> Optional[tuple[int, int]]:
+        now = time.time()
+
+        with self._transaction():
+            claimable = self.con.execute(
+                "SELECT start_id, end_id FROM work_batches WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) ORDER BY start_id",
+                (now,)
+            ).fetchall()
+
+            for start_id, end_id in claimable:
+                if start_id in self._released:
+                    continue
+
+                if self.shard is not None and (start_id // self.batch_size) % self.shard[1] != self.shard[0]:
+                    continue
+
+                self.con.execute(
+                    "UPDATE work_batches SET state = 'leased', owner = ?, lease_expires = ?, claims = claims + 1 WHERE start_id = ?",
+                    (self.worker_id, now + self.lease_seconds, start_id)
+                )
+                return start_id, end_id
+
+        return None
+
+    def _is_finished(self) -> bool:
+        unfinished = self.con.execute("SELECT start_id FROM work_batches WHERE state != 'done'").fetchall()
+        return all(start_id in self._released for start_id, in unfinished)
+
+    def _complete(self, start_id: int):
+        with self._transaction():
+            self.con.execute("UPDATE work_batches SET state = 'done', owner = NULL, lease_expires = NULL WHERE start_id = ? AND owner = ?", (start_id, self.worker_id))
+
+    def _release(self, start_id: int):
+        with self._transaction():
+            self.con.execute("UPDATE work_batches SET state = 'pending', owner = NULL, lease_expires = NULL WHERE start_id = ? AND owner = ?", (start_id, self.worker_id))
+
+    def _renew(self):
+        with self._transaction():
+            self.con.execute("UPDATE work_batches SET lease_expires = ? WHERE state = 'leased' AND owner = ?", (time.time() + self.lease_seconds, self.worker_id))
+
+    def _close(self):
+        with self._transaction():
+            self.con.execute("UPDATE work_batches SET state = 'pending', owner = NULL, lease_expires = NULL WHERE state = 'leased' AND owner = ?", (self.worker_id,))
+
+        self.con.close()
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+
+            try:
+                await self.renew()
+            except sqlite3.Error as e:
+                self.logger.warning(f"Unable to renew leases: {str(e)}")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._thread, function, *args)
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.warning(f"Unable to update the work store: {str(future.exception())}")
+
+    @contextmanager
+    def _transaction(self):
+        self.con.execute('BEGIN IMMEDIATE')
+
+        try:
+            yield
+        except BaseException:
+            self.con.execute('ROLLBACK')
+            raise
+
+        self.con.execute('COMMIT')
@@ -0,0 +1,4 @@
+from .RunState import RunState
+from .WorkBatch import WorkBatch
+from .WorkStore import WorkStore
+from .Watermark import Watermark
\ No newline at end of file
@@ -0,0 +1,68 @@
+class BKTree:
+    """
+    BK-tree over integer hashes using the Hamming distance.
+
+    Finds every hash within a distance of a query hash without comparing the query against
+    every hash in the tree.
+    """
+
+    def __init__(self):
+        # a node is [hash, value, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, key: int, value):
+        """
+        Add a hash to the tree.
+
+        :param key: Hash to add.
+        :param value: Value stored with the hash.
+        """
+        self.size += 1
+
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = (node[0] ^ key).bit_count()
+            child = node[2].get(distance)
+
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                return
+
+            node = child
+
+    def find(self, key: int, max_distance: int) -> list:
+        """
+        Find every hash within max_distance of a hash.
+
+        Returns a list of (distance, hash, value) tuples, nearest first.
+
+        :param key: Hash to search for.
+        :param max_distance: Maximum Hamming distance of the results.
+        """
+        if self.root is None:
+            return []
+
+        found = []
+        nodes = [self.root]
+
+        while nodes:
+            node = nodes.pop()
+            distance = (node[0] ^ key).bit_count()
+
+            if distance <= max_distance:
+                found.append((distance, node[0], node[1]))
+
+            # by the triangle inequality only children in this range can hold results
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+
+        return sorted(found, key=lambda result: result[0])
+
+    def __len__(self):
+        return self.size
@@ -13,5 +13,8 @@ class ProgressCounter:
     def set_total(self, total):
         self.total = total
 
+    def add_total(self, total):
+        self.total += total
+
     def __str__(self):
         return f"{self.current}/{self.total}"
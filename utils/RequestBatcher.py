@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+class RequestBatcher:
+    """
+    Collects single lookups made at about the same time and resolves them with one batched request.
+
+    A batch is sent once it is full or its first lookup has waited max_delay. Every caller gets
+    back only its own result, lookups of the same key in one batch share it.
+    """
+
+    def __init__(self, load: Callable[[list], Awaitable[dict]], max_size: int = 100, max_delay: float = 0.1):
+        """
+        Construct a new RequestBatcher object.
+
+        :param load: Loads a batch of keys and returns the results by key, keys without a result are left out.
+        :param max_size: Number of keys that triggers a batch.
+        :param max_delay: Seconds the first key of a batch waits for more keys.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.load = load
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._batch = {}
+        self._timer = None
+        self._loads = set()
+
+    async def get(self, key: Hashable) -> Any:
+        """
+        Get the result for a key, or None if the batch had no result for it.
+
+        :param key: Key to look up.
+        """
+        future = self._batch.get(key)
+
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._batch[key] = future
+
+            if len(self._batch) >= self.max_size:
+                self._send()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._send)
+
+        return await asyncio.shield(future)
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._batch = self._batch, {}
+        task = asyncio.create_task(self._load(batch))
+        self._loads.add(task)
+        task.add_done_callback(self._loads.discard)
+
+    async def _load(self, batch: dict):
+        self.logger.debug(f"Loading a batch of {len(batch)} keys...")
+
+        try:
+            results = await self.load(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
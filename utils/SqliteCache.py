@@ -0,0 +1,75 @@
+import json
+import sqlite3
+import threading
+import time
+
+class SqliteCache:
+    """
+    Small persistent key/value cache with an expiry time per entry, stored in a SQLite table.
+
+    Values are stored as JSON. The database can be busy with writes of other caches in the same
+    file, so callers on the event loop use it from worker threads, the connection is shared
+    behind a lock.
+    """
+
+    def __init__(self, path: str, table: str):
+        """
+        Open a cache table, creating it if needed.
+
+        :param path: Path of the SQLite database.
+        :param table: Name of the table that holds the cache.
+        """
+        self.table = table
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('PRAGMA busy_timeout=5000')
+        self.con.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+        ''')
+        self.con.commit()
+
+    def get(self, key: str):
+        """
+        Get a cached value, or None if there is none or it has expired.
+
+        :param key: Key of the value.
+        """
+        with self._lock:
+            row = self.con.execute(f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)).fetchone()
+
+        if row is None or row[1] < time.time():
+            return None
+
+        return json.loads(row[0])
+
+    def put(self, key: str, value, ttl: float):
+        """
+        Cache a value.
+
+        :param key: Key of the value.
+        :param value: Value to cache, anything json can serialise.
+        :param ttl: Seconds until the value expires.
+        """
+        value = json.dumps(value)
+
+        with self._lock:
+            self.con.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+            self.con.commit()
+
+    def purge_expired(self):
+        """
+        Delete every expired value.
+        """
+        with self._lock:
+            self.con.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (time.time(),))
+            self.con.commit()
+
+    def close(self):
+        with self._lock:
+            self.con.close()
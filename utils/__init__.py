@@ -1,2 +1,5 @@
 from .ProgressCounter import ProgressCounter
+from .SqliteCache import SqliteCache
+from .BKTree import BKTree
+from .RequestBatcher import RequestBatcher
 from .utils import *
\ No newline at end of file